@@ -0,0 +1,76 @@
+"""Benchmark the outlier filter against the row-wise implementation.
+
+The stations flagged by `cws_qc.get_outlier_stations` are checked to be the same as
+those of the original implementation, which computes the z-scores of each timestamp
+with `pandas.DataFrame.apply` and `statsmodels.robust.scale.qn_scale`, and the time
+spent by both is printed.
+
+Usage: python benchmarks/outlier_stations.py [num_timestamps] [num_stations]
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from statsmodels.robust import scale
+
+from uhi_drivers_lausanne import cws_qc, settings
+
+
+def get_ts_df(num_timestamps, num_stations, *, decimals=None, seed=0):
+    """Get hourly measurements of stations with outliers and missing values."""
+    rng = np.random.default_rng(seed)
+    arr = rng.normal(20, 3, size=(num_timestamps, num_stations))
+    arr[:, : num_stations // 20] += 15
+    if decimals is not None:
+        arr = arr.round(decimals)
+    arr[rng.random(arr.shape) < 0.2] = np.nan
+    return pd.DataFrame(
+        arr,
+        index=pd.date_range("2023-08-15", periods=num_timestamps, freq="h"),
+        columns=[f"station-{i}" for i in range(num_stations)],
+    )
+
+
+def get_apply_outlier_stations(ts_df):
+    """Get the outlier stations computing the z-scores row by row."""
+
+    def z_score(x):
+        return (x - x.median()) / scale.qn_scale(x.dropna())
+
+    nonnan_df = ~ts_df.isna()
+    low_z = norm.ppf(settings.OUTLIER_LOW_ALPHA)
+    high_z = norm.ppf(settings.OUTLIER_HIGH_ALPHA)
+    outlier_df = (
+        ~ts_df.apply(z_score, axis="columns").apply(
+            lambda z: z.between(low_z, high_z, inclusive="neither"), axis="columns"
+        )
+        & nonnan_df
+    )
+    prop_outlier_ser = outlier_df.sum() / nonnan_df.sum()
+    return prop_outlier_ser > settings.STATION_OUTLIER_THRESHOLD
+
+
+def main(num_timestamps=2000, num_stations=1000):
+    """Run the benchmark with continuous and rounded measurements."""
+    for decimals in [None, 1]:
+        ts_df = get_ts_df(num_timestamps, num_stations, decimals=decimals)
+        start = time.perf_counter()
+        apply_ser = get_apply_outlier_stations(ts_df)
+        apply_time = time.perf_counter() - start
+        start = time.perf_counter()
+        outlier_ser = cws_qc.get_outlier_stations(ts_df)
+        outlier_time = time.perf_counter() - start
+        pd.testing.assert_series_equal(outlier_ser, apply_ser, check_names=False)
+        print(
+            f"{num_timestamps} timestamps x {num_stations} stations "
+            f"({'continuous' if decimals is None else f'{decimals} decimals'}): "
+            f"apply {apply_time:.2f} s, get_outlier_stations {outlier_time:.2f} s "
+            f"({apply_time / outlier_time:.1f}x), same flags"
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,71 @@
+"""Benchmark the UHI data frame against the timestamp-wise implementation.
+
+The data frame returned by `regr_utils.get_uhi_df` is checked to be exactly the same
+as that of the original implementation, which subtracts the minimum temperature of
+each timestamp with `groupby("time").apply`, and the time spent by both is printed.
+
+Usage: python benchmarks/uhi.py [num_timestamps] [num_stations]
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from uhi_drivers_lausanne import regr_utils
+
+
+def get_ts_df(num_timestamps, num_stations, *, seed=0):
+    """Get hourly measurements of stations in long format, with missing values."""
+    rng = np.random.default_rng(seed)
+    ts_df = pd.DataFrame(
+        {
+            "time": np.repeat(
+                pd.date_range("2023-08-15", periods=num_timestamps, freq="h"),
+                num_stations,
+            ),
+            "station_id": np.tile(
+                [f"station-{i}" for i in range(num_stations)], num_timestamps
+            ),
+            "T": rng.normal(20, 3, num_timestamps * num_stations).round(2),
+        }
+    )
+    ts_df.loc[rng.random(len(ts_df)) < 0.1, "T"] = np.nan
+    return ts_df
+
+
+def get_apply_uhi_df(ts_df):
+    """Get the UHI data frame subtracting the minimum temperature of each timestamp."""
+    return (
+        ts_df.drop("time", axis="columns")
+        .groupby(ts_df["time"])
+        .apply(
+            lambda group_df: group_df.assign(
+                **{"UHI": group_df["T"] - group_df["T"].min()}
+            ).drop("T", axis="columns")
+        )
+        .droplevel(-1)
+        .reset_index()
+    )
+
+
+def main(num_timestamps=2000, num_stations=300):
+    """Run the benchmark."""
+    ts_df = get_ts_df(num_timestamps, num_stations)
+    start = time.perf_counter()
+    apply_uhi_df = get_apply_uhi_df(ts_df)
+    apply_time = time.perf_counter() - start
+    start = time.perf_counter()
+    uhi_df = regr_utils.get_uhi_df(ts_df)
+    uhi_time = time.perf_counter() - start
+    pd.testing.assert_frame_equal(uhi_df, apply_uhi_df, check_exact=True)
+    print(
+        f"{len(ts_df)} rows ({num_timestamps} timestamps x {num_stations} stations): "
+        f"apply {apply_time:.2f} s, get_uhi_df {uhi_time:.2f} s "
+        f"({apply_time / uhi_time:.1f}x), same output"
+    )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
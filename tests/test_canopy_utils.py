@@ -0,0 +1,334 @@
+"""Tests for the canopy utils."""
+
+import functools
+import threading
+import time
+import zipfile
+from http import server
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from rasterio import transform
+from shapely import geometry
+
+pdal = pytest.importorskip("pdal")
+
+from uhi_drivers_lausanne import canopy_utils, stac_utils  # noqa: E402
+
+CRS = "epsg:2056"
+URL_COL = "url"
+STATION_ID_COL = "station_id"
+LIDAR_TREE_VALUES = [3]
+TILE_SIZE = 100
+NUM_TILE_ROWS, NUM_TILE_COLS = 2, 2
+BUFFER_DIST = 30
+DST_RES = 1
+WEST, SOUTH = 2_538_000, 1_152_000
+
+
+def _write_lidar_zip(dst_dir, name, west, south, rng):
+    # random ground and vegetation points within the tile
+    num_points = 20_000
+    points = np.zeros(
+        num_points,
+        dtype=[("X", float), ("Y", float), ("Z", float), ("Classification", np.uint8)],
+    )
+    points["X"] = west + rng.random(num_points) * TILE_SIZE
+    points["Y"] = south + rng.random(num_points) * TILE_SIZE
+    points["Z"] = 400 + rng.random(num_points) * 20
+    points["Classification"] = rng.choice([2, 3, 6], num_points)
+    lidar_filepath = dst_dir / f"{name}.las"
+    pdal.Writer.las(filename=str(lidar_filepath)).pipeline(points).execute()
+    with zipfile.ZipFile(dst_dir / f"{name}.zip", "w") as z:
+        z.write(lidar_filepath, lidar_filepath.name)
+    lidar_filepath.unlink()
+
+
+class LidarRequestHandler(server.SimpleHTTPRequestHandler):
+    """Request handler that records the requests and the concurrent downloads."""
+
+    def do_GET(self):
+        """Serve a file, recording the request."""
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            self.server.num_active += 1
+            self.server.max_active = max(self.server.max_active, self.server.num_active)
+        try:
+            # slow down the downloads so that they overlap
+            time.sleep(self.server.delay)
+            super().do_GET()
+        finally:
+            with self.server.lock:
+                self.server.num_active -= 1
+
+    def log_message(self, *args):
+        """Do not log the requests."""
+
+
+@pytest.fixture
+def lidar_server(tmp_path):
+    """HTTP server of zipped LiDAR tiles, served from a background thread."""
+    tile_dir = tmp_path / "tiles"
+    tile_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for i in range(NUM_TILE_ROWS):
+        for j in range(NUM_TILE_COLS):
+            _write_lidar_zip(
+                tile_dir,
+                f"tile-{i}-{j}",
+                WEST + j * TILE_SIZE,
+                SOUTH + i * TILE_SIZE,
+                rng,
+            )
+    httpd = server.ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        functools.partial(LidarRequestHandler, directory=str(tile_dir)),
+    )
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.num_active = 0
+    httpd.max_active = 0
+    httpd.delay = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.base_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    yield httpd
+    httpd.shutdown()
+    thread.join()
+    httpd.server_close()
+
+
+@pytest.fixture
+def tile_stations_gdf(lidar_server):
+    """Intersection of the tiles and the buffered stations."""
+    tile_gdf = gpd.GeoDataFrame(
+        {
+            URL_COL: [
+                f"{lidar_server.base_url}/tile-{i}-{j}.zip"
+                for i in range(NUM_TILE_ROWS)
+                for j in range(NUM_TILE_COLS)
+            ]
+        },
+        geometry=[
+            geometry.box(
+                WEST + j * TILE_SIZE,
+                SOUTH + i * TILE_SIZE,
+                WEST + (j + 1) * TILE_SIZE,
+                SOUTH + (i + 1) * TILE_SIZE,
+            )
+            for i in range(NUM_TILE_ROWS)
+            for j in range(NUM_TILE_COLS)
+        ],
+        crs=CRS,
+    )
+    # stations within a tile, across two tiles and across the four tiles
+    return tile_gdf.overlay(
+        _get_buffered_station_gser().reset_index(), how="intersection"
+    )
+
+
+def _get_buffered_station_gser():
+    return gpd.GeoSeries(
+        [
+            geometry.Point(WEST + 40, SOUTH + 40),
+            geometry.Point(WEST + 100, SOUTH + 150),
+            geometry.Point(WEST + 95, SOUTH + 105),
+        ],
+        index=pd.Index(["a", "b", "c"], name=STATION_ID_COL),
+        crs=CRS,
+    ).buffer(BUFFER_DIST)
+
+
+def _open_tree_canopy_arr(dst_filepath):
+    buffered_station_gser = _get_buffered_station_gser()
+    arr_side = int(2 * BUFFER_DIST / DST_RES)
+    tree_canopy_arr = canopy_utils.open_tree_canopy_arr(
+        str(dst_filepath),
+        buffered_station_gser.index,
+        arr_side,
+        station_id_col=STATION_ID_COL,
+    )
+    transform_dict = {
+        station_id: transform.from_bounds(*geom.bounds, arr_side, arr_side)
+        for station_id, geom in buffered_station_gser.items()
+    }
+    return tree_canopy_arr, transform_dict
+
+
+def _process_lidar_tiles(tile_stations_gdf, dst_filepath, **kwargs):
+    tree_canopy_arr, transform_dict = _open_tree_canopy_arr(dst_filepath)
+    return canopy_utils.process_lidar_tiles(
+        tile_stations_gdf,
+        tree_canopy_arr,
+        transform_dict,
+        LIDAR_TREE_VALUES,
+        DST_RES,
+        STATION_ID_COL,
+        url_col=URL_COL,
+        **{"max_workers": 2, **kwargs},
+    )
+
+
+@pytest.fixture
+def reference_arr(tile_stations_gdf, tmp_path):
+    """Tree canopy array processed in a single, uninterrupted run."""
+    return _process_lidar_tiles(tile_stations_gdf, tmp_path / "reference.zarr")[:]
+
+
+@pytest.mark.parametrize("checkpoint", [True, False])
+def test_process_lidar_tiles_interrupted_merge(
+    tile_stations_gdf, reference_arr, lidar_server, tmp_path, monkeypatch, checkpoint
+):
+    """Test that a tile whose merge is interrupted is not summed twice on resume."""
+    assert reference_arr.any()
+    dst_filepath = tmp_path / "tree-canopy.zarr"
+    checkpoint_dir = str(tmp_path / "checkpoints") if checkpoint else None
+    merge_lidar_arrays = canopy_utils.merge_lidar_arrays
+    num_merges = 0
+
+    def interrupted_merge_lidar_arrays(tree_canopy_arr, arrays, *args):
+        # write the arrays of the first station of the second tile only
+        nonlocal num_merges
+        num_merges += 1
+        if num_merges < 2:
+            return merge_lidar_arrays(tree_canopy_arr, arrays, *args)
+        merge_lidar_arrays(
+            tree_canopy_arr, arrays[:1], *[arg[:1] for arg in args[:2]], args[2]
+        )
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(canopy_utils, "merge_lidar_arrays", interrupted_merge_lidar_arrays)
+        with pytest.raises(KeyboardInterrupt):
+            _process_lidar_tiles(
+                tile_stations_gdf, dst_filepath, checkpoint_dir=checkpoint_dir
+            )
+    tree_canopy_arr, _ = _open_tree_canopy_arr(dst_filepath)
+    merging_tile = tree_canopy_arr.attrs[canopy_utils.MERGING_TILE_ATTR]
+    assert merging_tile is not None
+    assert len(tree_canopy_arr.attrs[canopy_utils.MERGED_TILES_ATTR]) == 1
+
+    num_requests = len(lidar_server.requests)
+    if checkpoint:
+        # the stations of the interrupted tile are rebuilt from the checkpoints
+        tree_canopy_arr = _process_lidar_tiles(
+            tile_stations_gdf, dst_filepath, checkpoint_dir=checkpoint_dir
+        )
+        assert len(lidar_server.requests) - num_requests == 2
+    else:
+        # all the tiles are merged again
+        with pytest.warns(UserWarning, match="merged again"):
+            tree_canopy_arr = _process_lidar_tiles(tile_stations_gdf, dst_filepath)
+        assert len(lidar_server.requests) - num_requests == 4
+    np.testing.assert_array_equal(tree_canopy_arr[:], reference_arr)
+    assert tree_canopy_arr.attrs[canopy_utils.MERGING_TILE_ATTR] is None
+    assert sorted(tree_canopy_arr.attrs[canopy_utils.MERGED_TILES_ATTR]) == sorted(
+        tile_stations_gdf[URL_COL].unique()
+    )
+
+
+def test_download_lidar(lidar_server, tmp_path):
+    """Test that the zip is extracted and removed, unless it is served from a cache."""
+    lidar_url = f"{lidar_server.base_url}/tile-0-0.zip"
+    dst_dir = tmp_path / "dst"
+    dst_dir.mkdir()
+    lidar_filepath = canopy_utils.download_lidar(lidar_url, str(dst_dir))
+    assert lidar_filepath == str(dst_dir / "tile-0-0.las")
+    assert [child.name for child in dst_dir.iterdir()] == ["tile-0-0.las"]
+
+    cache = stac_utils.AssetCache(str(tmp_path / "cache"))
+    for i in range(2):
+        cache_dst_dir = tmp_path / f"cache-dst-{i}"
+        cache_dst_dir.mkdir()
+        with open(
+            canopy_utils.download_lidar(lidar_url, str(cache_dst_dir), cache=cache),
+            "rb",
+        ) as src, open(lidar_filepath, "rb") as expected_src:
+            assert src.read() == expected_src.read()
+    # the second download is served from the cache
+    assert lidar_server.requests == ["/tile-0-0.zip"] * 2
+
+
+def test_process_lidar_tiles_resume(
+    tile_stations_gdf, reference_arr, lidar_server, tmp_path, monkeypatch
+):
+    """Test that an interrupted run resumes from the tiles left and the checkpoints."""
+    dst_filepath = tmp_path / "tree-canopy.zarr"
+    checkpoint_dir = str(tmp_path / "checkpoints")
+    merge_tile = canopy_utils._merge_tile
+    num_merges = 0
+
+    def interrupted_merge_tile(*args):
+        # interrupt the run after the second tile has been merged
+        nonlocal num_merges
+        merge_tile(*args)
+        num_merges += 1
+        if num_merges == 2:
+            raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(canopy_utils, "_merge_tile", interrupted_merge_tile)
+        with pytest.raises(KeyboardInterrupt):
+            _process_lidar_tiles(
+                tile_stations_gdf, dst_filepath, checkpoint_dir=checkpoint_dir
+            )
+    # only the tiles left are downloaded
+    num_requests = len(lidar_server.requests)
+    tree_canopy_arr = _process_lidar_tiles(
+        tile_stations_gdf, dst_filepath, checkpoint_dir=checkpoint_dir
+    )
+    assert len(lidar_server.requests) - num_requests == 2
+    np.testing.assert_array_equal(tree_canopy_arr[:], reference_arr)
+
+    # a new array is built from the checkpoints only
+    num_requests = len(lidar_server.requests)
+    tree_canopy_arr = _process_lidar_tiles(
+        tile_stations_gdf, tmp_path / "rebuilt.zarr", checkpoint_dir=checkpoint_dir
+    )
+    assert len(lidar_server.requests) == num_requests
+    np.testing.assert_array_equal(tree_canopy_arr[:], reference_arr)
+
+
+def test_process_lidar_tiles_concurrency(
+    tile_stations_gdf, reference_arr, lidar_server, tmp_path, monkeypatch
+):
+    """Test that the downloads and tiles in flight are bounded."""
+    lidar_server.delay = 0.2
+    download_lidar = canopy_utils.download_lidar
+    merge_tile = canopy_utils._merge_tile
+    lock = threading.Lock()
+    num_started = 0
+    num_merged = 0
+    max_in_flight = 0
+
+    def counted_download_lidar(*args, **kwargs):
+        nonlocal num_started, max_in_flight
+        with lock:
+            num_started += 1
+            max_in_flight = max(max_in_flight, num_started - num_merged)
+        return download_lidar(*args, **kwargs)
+
+    def counted_merge_tile(*args):
+        nonlocal num_merged
+        merge_tile(*args)
+        with lock:
+            num_merged += 1
+
+    monkeypatch.setattr(canopy_utils, "download_lidar", counted_download_lidar)
+    monkeypatch.setattr(canopy_utils, "_merge_tile", counted_merge_tile)
+    num_requests = len(lidar_server.requests)
+    tree_canopy_arr = _process_lidar_tiles(
+        tile_stations_gdf,
+        tmp_path / "tree-canopy.zarr",
+        max_workers=2,
+        max_downloads=2,
+        max_in_flight=3,
+    )
+    np.testing.assert_array_equal(tree_canopy_arr[:], reference_arr)
+    assert len(lidar_server.requests) - num_requests == num_merged == 4
+    # tiles are downloaded concurrently, but no more than `max_downloads` at once and
+    # no more than `max_in_flight` tiles are downloaded or processed at any time
+    assert lidar_server.max_active == 2
+    assert max_in_flight == 3
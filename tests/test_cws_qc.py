@@ -0,0 +1,120 @@
+"""Tests for the CWS quality control."""
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import norm
+from statsmodels.robust import scale
+
+from uhi_drivers_lausanne import cws_qc, settings, ts_utils
+
+
+def _get_ts_df(num_timestamps, num_stations, *, decimals=None, nan_prop=0.2, seed=0):
+    # measurements of stations with a few outliers and missing values, optionally
+    # rounded (as the measurements of the CWS) so that there are ties
+    rng = np.random.default_rng(seed)
+    arr = rng.normal(20, 3, size=(num_timestamps, num_stations))
+    arr[:, :3] += 15
+    if decimals is not None:
+        arr = arr.round(decimals)
+    arr[rng.random(arr.shape) < nan_prop] = np.nan
+    return pd.DataFrame(
+        arr,
+        index=pd.date_range("2023-08-15", periods=num_timestamps, freq="h"),
+        columns=[f"station-{i}" for i in range(num_stations)],
+    )
+
+
+def _get_reference_outlier_stations(ts_df):
+    # the implementation that computes the z-scores row by row
+    def z_score(x):
+        return (x - x.median()) / scale.qn_scale(x.dropna())
+
+    nonnan_df = ~ts_df.isna()
+    low_z = norm.ppf(settings.OUTLIER_LOW_ALPHA)
+    high_z = norm.ppf(settings.OUTLIER_HIGH_ALPHA)
+    outlier_df = (
+        ~ts_df.apply(z_score, axis="columns").apply(
+            lambda z: z.between(low_z, high_z, inclusive="neither"), axis="columns"
+        )
+        & nonnan_df
+    )
+    prop_outlier_ser = outlier_df.sum() / nonnan_df.sum()
+    return prop_outlier_ser > settings.STATION_OUTLIER_THRESHOLD
+
+
+@pytest.mark.parametrize("decimals", [None, 1])
+@pytest.mark.parametrize("num_stations", [40, 129, 400])
+def test_nanqn_scale(decimals, num_stations):
+    """Test the Qn scale of each row against statsmodels, row by row."""
+    # the NaN proportion spreads the valid counts of the rows around the brute-force
+    # maximum count
+    arr = _get_ts_df(
+        60, num_stations, decimals=decimals, nan_prop=0.3, seed=num_stations
+    ).to_numpy()
+    arr[0] = np.nan
+    arr[1, 1:] = np.nan
+    arr[2, :] = 20
+    qn_arr = cws_qc._nanqn_scale(arr)
+    assert np.isnan(qn_arr[:2]).all()
+    np.testing.assert_array_equal(
+        qn_arr[2:],
+        [scale.qn_scale(row[~np.isnan(row)]) for row in arr[2:]],
+    )
+
+
+@pytest.mark.parametrize("decimals", [None, 1])
+@pytest.mark.parametrize("num_stations", [50, 300])
+def test_get_outlier_stations(decimals, num_stations):
+    """Test the outlier stations against the reference implementation."""
+    ts_df = _get_ts_df(100, num_stations, decimals=decimals)
+    outlier_ser = cws_qc.get_outlier_stations(ts_df, chunksize=32)
+    pd.testing.assert_series_equal(
+        outlier_ser, _get_reference_outlier_stations(ts_df), check_names=False
+    )
+    assert outlier_ser.iloc[:3].all()
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("elev_adjust", [False, True])
+def test_run_qc(compact, elev_adjust):
+    """Test that the QC flags are the same as those of the separate filters."""
+    # measurements that follow a daily cycle, with stations with many missing values
+    # and stations that do not follow the cycle (e.g., indoors)
+    ts_df = _get_ts_df(200, 60, decimals=1)
+    ts_df = ts_df.add(15 * np.sin(2 * np.pi * np.arange(len(ts_df)) / 24), axis="index")
+    ts_df.iloc[: len(ts_df) // 2, 3:6] = np.nan
+    ts_df.iloc[:, 6:9] = 22 + np.random.default_rng(1).normal(0, 0.5, (len(ts_df), 3))
+    if compact:
+        ts_df = ts_utils.CompactTSArray.from_df(ts_df)
+    qc_kws = dict(high_alpha=0.95, unreliable_threshold=0.3, chunksize=64)
+    if elev_adjust:
+        station_elevation_ser = pd.Series(
+            np.linspace(400, 900, ts_df.shape[1]), index=ts_df.columns
+        )
+        qc_kws["station_elevation_ser"] = station_elevation_ser
+        adjusted_ts_df = cws_qc.elevation_adjustment(ts_df, station_elevation_ser)
+    else:
+        adjusted_ts_df = ts_df
+
+    qc_df, timing_ser = cws_qc.run_qc(ts_df, **qc_kws)
+    pd.testing.assert_frame_equal(
+        qc_df,
+        pd.DataFrame(
+            {
+                "outlier": cws_qc.get_outlier_stations(
+                    adjusted_ts_df, high_alpha=0.95, chunksize=64
+                ),
+                "indoor": cws_qc.get_indoor_stations(adjusted_ts_df, chunksize=64),
+                "unreliable": cws_qc.get_unreliable_stations(
+                    adjusted_ts_df, unreliable_threshold=0.3
+                ),
+            }
+        ),
+        check_names=False,
+    )
+    assert qc_df.iloc[:3]["outlier"].all()
+    assert qc_df.iloc[3:6]["unreliable"].all()
+    assert qc_df.iloc[6:9]["indoor"].all()
+    assert not qc_df.iloc[9:].any(axis=None)
+    assert (timing_ser >= 0).all()
@@ -0,0 +1,106 @@
+"""Tests for the feature utils."""
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+from shapely import geometry
+
+from uhi_drivers_lausanne import feature_utils
+
+
+def _get_station_gser(station_ids):
+    return gpd.GeoSeries(
+        [
+            geometry.Point(2_538_000 + 10 * i, 1_152_000)
+            for i in range(len(station_ids))
+        ],
+        index=pd.Index(station_ids, name="station_id"),
+        crs="epsg:2056",
+    )
+
+
+def _get_compute_tree_features(buffer_dists, calls):
+    def compute_tree_features(station_gser):
+        calls.append(list(station_gser.index))
+        return pd.DataFrame(
+            {
+                f"tree_{buffer_dist}": station_gser.x + buffer_dist
+                for buffer_dist in buffer_dists
+            },
+            index=station_gser.index,
+        )
+
+    return compute_tree_features
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Feature store in a temporary directory."""
+    return feature_utils.FeatureStore(str(tmp_path))
+
+
+def test_compute_incremental(store, tmp_path):
+    """Test that only the missing stations are computed."""
+    calls = []
+    compute_features = _get_compute_tree_features([10, 30], calls)
+    fingerprint = feature_utils.get_fingerprint({"buffer_dists": [10, 30]})
+    store.compute("tree", _get_station_gser(["a", "b"]), compute_features)
+    features_df = feature_utils.FeatureStore(str(tmp_path)).compute(
+        "tree",
+        _get_station_gser(["a", "b", "c"]),
+        compute_features,
+        fingerprint=fingerprint,
+    )
+    # a store without a fingerprint is stale once a fingerprint is given
+    assert calls == [["a", "b"], ["a", "b", "c"]]
+
+    features_df = feature_utils.FeatureStore(str(tmp_path)).compute(
+        "tree",
+        _get_station_gser(["a", "b", "c", "d"]),
+        compute_features,
+        fingerprint=fingerprint,
+    )
+    assert calls[2:] == [["d"]]
+    assert list(features_df.columns) == ["tree_10", "tree_30"]
+    assert features_df.notna().all(axis=None)
+
+
+def test_compute_fingerprint_change(store, tmp_path):
+    """Test that all the stations are computed again when the fingerprint changes."""
+    calls = []
+    store.compute(
+        "tree",
+        _get_station_gser(["a", "b"]),
+        _get_compute_tree_features([10, 30], calls),
+        fingerprint=feature_utils.get_fingerprint({"buffer_dists": [10, 30]}),
+    )
+    # change the buffer distances and add a station, in a new session
+    features_df = feature_utils.FeatureStore(str(tmp_path)).compute(
+        "tree",
+        _get_station_gser(["a", "b", "c"]),
+        _get_compute_tree_features([10, 60], calls),
+        fingerprint=feature_utils.get_fingerprint({"buffer_dists": [10, 60]}),
+    )
+    assert calls == [["a", "b"], ["a", "b", "c"]]
+    assert list(features_df.columns) == ["tree_10", "tree_60"]
+    assert features_df.notna().all(axis=None)
+
+
+def test_get_fingerprint_inputs(tmp_path):
+    """Test that the fingerprint changes with the content of the inputs."""
+    input_dir = tmp_path / "canopy.zarr"
+    input_dir.mkdir()
+    (input_dir / "0.0").write_bytes(b"\x00\x01")
+    fingerprint = feature_utils.get_fingerprint(
+        {"res": 1}, input_filepaths=[str(input_dir)]
+    )
+    assert fingerprint == feature_utils.get_fingerprint(
+        {"res": 1}, input_filepaths=[str(input_dir)]
+    )
+    assert fingerprint != feature_utils.get_fingerprint(
+        {"res": 2}, input_filepaths=[str(input_dir)]
+    )
+    (input_dir / "0.0").write_bytes(b"\x00\x02")
+    assert fingerprint != feature_utils.get_fingerprint(
+        {"res": 1}, input_filepaths=[str(input_dir)]
+    )
@@ -0,0 +1,42 @@
+"""Tests for the grid utils."""
+
+import numpy as np
+import rasterio as rio
+import shapely
+from rasterio import transform
+
+from uhi_drivers_lausanne import grid_utils
+
+
+def test_compute_buffer_features_extent(tmp_path):
+    """Test chunks that intersect the extent without containing any cell center."""
+    layer_filepath = str(tmp_path / "layer.tif")
+    with rio.open(
+        layer_filepath,
+        "w",
+        driver="GTiff",
+        height=100,
+        width=100,
+        count=1,
+        dtype="uint8",
+        crs="epsg:2056",
+        transform=transform.from_origin(2_538_000, 1_152_100, 1, 1),
+    ) as dst:
+        dst.write(np.ones((100, 100), dtype="uint8"), 1)
+
+    # the extent reaches into the chunks of the right half of the grid (whose first
+    # cell centers are at x=2_538_055) without containing any of their cell centers
+    feature_stack = grid_utils.open_feature_stack(
+        str(tmp_path / "features.zarr"),
+        (2_538_000, 1_152_000, 2_538_100, 1_152_100),
+        10,
+        "epsg:2056",
+        extent_geom=shapely.box(2_538_000, 1_152_000, 2_538_051, 1_152_100),
+        chunksize=5,
+    )
+    grid_utils.compute_buffer_features(
+        feature_stack, "bldg_area", layer_filepath, [10], max_workers=1
+    )
+    feature_arr = feature_stack["bldg_area_10"][:]
+    assert np.isnan(feature_arr[:, 5:]).all()
+    assert (feature_arr[:, :5] > 0).all()
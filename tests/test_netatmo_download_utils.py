@@ -0,0 +1,184 @@
+"""Tests for the Netatmo download utils."""
+
+import asyncio
+import collections
+import threading
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from uhi_drivers_lausanne import netatmo_download_utils, netatmo_utils
+
+BOUNDS = (6.5, 46.4, 6.8, 46.6)
+START_DT, END_DT = "2023-08-15", "2023-08-16"
+NUM_STATIONS = 3
+# number of API requests accepted with the first access token, before it expires
+TOKEN_LIFETIME = 2
+
+
+def _get_station_records():
+    return [
+        {
+            "_id": f"70:ee:50:00:00:{i:02x}",
+            "place": {"location": [6.6 + i / 100, 46.5, 400]},
+            "module_types": {
+                f"02:00:00:00:00:{i:02x}": netatmo_download_utils.OUTDOOR_MODULE_TYPE,
+                f"05:00:00:00:00:{i:02x}": "NAModule3",
+            },
+            "measures": {},
+        }
+        for i in range(NUM_STATIONS)
+    ]
+
+
+def _get_temperature(device_id, ts):
+    return 20 + int(device_id[-2:], 16) + (ts % 86400) / 86400
+
+
+class MockNetatmoAPI:
+    """Mock Netatmo API with rate limiting, server errors and expiring tokens."""
+
+    def __init__(self):
+        """Initialize the request counts and the tokens."""
+        self.counts = collections.Counter()
+        self.token_num = 0
+        self.num_authorized = 0
+        self.app = web.Application()
+        self.app.router.add_post("/oauth2/token", self.token)
+        self.app.router.add_get("/api/getpublicdata", self.public_data)
+        self.app.router.add_get("/api/getmeasure", self.measure)
+
+    async def token(self, request):
+        """Issue a new access token, rotating the refresh token."""
+        data = await request.post()
+        assert data["grant_type"] == "refresh_token"
+        assert data["refresh_token"] == f"refresh-{self.token_num}"
+        self.counts["token"] += 1
+        self.token_num += 1
+        return web.json_response(
+            {
+                "access_token": f"access-{self.token_num}",
+                "refresh_token": f"refresh-{self.token_num}",
+            }
+        )
+
+    def _is_authorized(self, request):
+        self.num_authorized += 1
+        if self.token_num == 1 and self.num_authorized > TOKEN_LIFETIME:
+            # the first token expires after a few requests
+            return False
+        return request.headers["Authorization"] == f"Bearer access-{self.token_num}"
+
+    async def public_data(self, request):
+        """Get the stations of the region."""
+        self.counts["getpublicdata"] += 1
+        if not self._is_authorized(request):
+            return web.Response(status=403)
+        return web.json_response({"body": _get_station_records(), "status": "ok"})
+
+    async def measure(self, request):
+        """Get the measurements of a station, failing the first attempt of each."""
+        self.counts["getmeasure"] += 1
+        if not self._is_authorized(request):
+            return web.Response(status=403)
+        query = request.query
+        key = (query["device_id"], query["date_begin"])
+        self.counts[key] += 1
+        if self.counts[key] == 1:
+            # rate limited or unavailable on the first attempt
+            return web.Response(status=429 if len(self.counts) % 2 else 503)
+        begin_ts, end_ts = int(query["date_begin"]), int(query["date_end"])
+        return web.json_response(
+            {
+                "body": {
+                    str(ts): [_get_temperature(query["device_id"], ts)]
+                    for ts in range(begin_ts, end_ts + 1, 3600)
+                },
+                "status": "ok",
+            }
+        )
+
+
+@pytest.fixture
+def mock_api():
+    """Mock Netatmo API served from a background thread."""
+    mock_api = MockNetatmoAPI()
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(mock_api.app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    mock_api.base_url = f"http://127.0.0.1:{port}"
+    yield mock_api
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+def test_download_filepaths(mock_api, tmp_path):
+    """Test the download with retries, token refresh and cached reruns."""
+    token_provider = netatmo_download_utils.RefreshTokenProvider(
+        "refresh-0",
+        "client-id",
+        "client-secret",
+        token_url=f"{mock_api.base_url}/oauth2/token",
+    )
+    download_kws = dict(
+        cache_dir=str(tmp_path / "cache"),
+        base_url=f"{mock_api.base_url}/api",
+        rate=1000,
+        capacity=100,
+        max_retries=3,
+        backoff=0.01,
+    )
+    snapshot_filepaths = netatmo_download_utils.download_filepaths(
+        BOUNDS, START_DT, END_DT, token_provider, **download_kws
+    )
+    # the expired token is refreshed once, and every measure request is retried once
+    assert mock_api.counts["token"] == 2
+    assert token_provider.refresh_token == "refresh-2"
+    assert all(
+        count == 2 for key, count in mock_api.counts.items() if isinstance(key, tuple)
+    )
+
+    # a snapshot per hour, with the measurements of all the stations
+    assert len(snapshot_filepaths) == 25
+    ts_df, station_gser = netatmo_utils.process_filepaths(snapshot_filepaths)
+    assert len(station_gser) == NUM_STATIONS
+    temperature_ser = ts_df.loc["temperature", "value"]
+    assert len(temperature_ser) == 25 * NUM_STATIONS
+    for (device_id, time), temperature in temperature_ser.items():
+        assert temperature == pytest.approx(
+            _get_temperature(device_id, int(time.timestamp()))
+        )
+
+    # reruns are served from the cache, without requesting a token
+    counts = mock_api.counts.copy()
+    assert (
+        netatmo_download_utils.download_filepaths(
+            BOUNDS, START_DT, END_DT, token_provider, **download_kws
+        )
+        == snapshot_filepaths
+    )
+    assert mock_api.counts == counts
+
+
+def test_download_filepaths_invalid_token(mock_api, tmp_path):
+    """Test that requests with an invalid (non-refreshable) token are not retried."""
+    with pytest.raises(aiohttp.ClientResponseError, match="403"):
+        netatmo_download_utils.download_filepaths(
+            BOUNDS,
+            START_DT,
+            END_DT,
+            "invalid",
+            cache_dir=str(tmp_path / "cache"),
+            base_url=f"{mock_api.base_url}/api",
+            max_retries=3,
+            backoff=0.01,
+        )
+    assert mock_api.counts["getpublicdata"] == 1
@@ -0,0 +1,85 @@
+"""Tests for the Netatmo utils."""
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from geopandas import testing as gpd_testing
+
+from uhi_drivers_lausanne import netatmo_utils
+
+NUM_STATIONS = 5
+NUM_SNAPSHOTS = 6
+
+
+def _get_station_record(i, ts, rng):
+    # stations with temperature and humidity, some of them with rain and wind modules,
+    # and a station that moves after the first snapshot
+    measures = {
+        f"70:ee:50:00:00:{i:02x}": {"res": {str(ts): [rng.normal(1013, 5)]}},
+        f"02:00:00:00:00:{i:02x}": {
+            "res": {str(ts): [rng.normal(20, 3), int(rng.integers(30, 90))]},
+            "type": ["temperature", "humidity"],
+        },
+    }
+    module_types = {f"02:00:00:00:00:{i:02x}": "NAModule1"}
+    if i % 2:
+        measures[f"05:00:00:00:00:{i:02x}"] = {"rain_live": float(rng.random() * 2)}
+        module_types[f"05:00:00:00:00:{i:02x}"] = "NAModule3"
+    if i % 3 == 0:
+        measures[f"06:00:00:00:00:{i:02x}"] = {
+            "wind_strength": int(rng.integers(0, 20)),
+            "wind_angle": int(rng.integers(0, 360)),
+        }
+        module_types[f"06:00:00:00:00:{i:02x}"] = "NAModule2"
+    location = [6.6 + i / 100, 46.5 + (ts > 1692057600) / 100]
+    return {
+        "_id": f"70:ee:50:00:00:{i:02x}",
+        "place": {"location": location, "altitude": 400},
+        "module_types": module_types,
+        "measures": measures,
+    }
+
+
+@pytest.fixture
+def data_filepaths(tmp_path):
+    """JSON dumps of snapshots of the stations, not all of them in every snapshot."""
+    rng = np.random.default_rng(0)
+    data_filepaths = []
+    for j in range(NUM_SNAPSHOTS):
+        ts = 1692057600 + 3600 * j
+        response_json = {
+            "body": [
+                _get_station_record(i, ts, rng)
+                for i in range(NUM_STATIONS)
+                if (i + j) % 4
+            ],
+            "status": "ok",
+            "time_server": ts,
+        }
+        data_filepath = tmp_path / f"{ts}.json"
+        data_filepath.write_text(json.dumps(response_json))
+        data_filepaths.append(str(data_filepath))
+    return data_filepaths
+
+
+@pytest.mark.parametrize("row_group_size", [1, 7, 1000])
+def test_stream_filepaths(data_filepaths, tmp_path, row_group_size):
+    """Test that the streamed data is the same as the processed one."""
+    ts_df, station_gser = netatmo_utils.process_filepaths(data_filepaths)
+    dst_filepath = str(tmp_path / "ts-df.parquet")
+    stream_station_gser = netatmo_utils.stream_filepaths(
+        data_filepaths, dst_filepath, row_group_size=row_group_size, max_workers=2
+    )
+    gpd_testing.assert_geoseries_equal(stream_station_gser.sort_index(), station_gser)
+    pd.testing.assert_frame_equal(netatmo_utils.read_ts_df(dst_filepath), ts_df)
+
+    # filters are pushed down to the Parquet reader
+    station_ids = list(station_gser.index[1:3])
+    pd.testing.assert_frame_equal(
+        netatmo_utils.read_ts_df(
+            dst_filepath, variables=["temperature"], station_ids=station_ids
+        ),
+        ts_df.loc[["temperature"], station_ids, :],
+    )
@@ -0,0 +1,141 @@
+"""Tests for the official stations utils."""
+
+import io
+from os import path
+
+import boto3
+import numpy as np
+import pandas as pd
+import pytest
+from moto import mock_aws
+
+from uhi_drivers_lausanne import official_stations_utils
+
+BUCKET_NAME = "weather-data"
+IDAWEB_KEY = "idaweb/order.txt"
+VAUDAIR_KEY = "vaudair/data.xlsx"
+# IDAWEB exports repeat the header before the data of each station
+IDAWEB_TXT = (
+    "stn;time;tre200h0\n"
+    "PUY;202308150000;20.1\n"
+    "PUY;202308150100;19.5\n"
+    "\n"
+    "stn;time;tre200h0\n"
+    "LSN;202308150000;22.3\n"
+    "LSN;202308150100;-\n"
+)
+
+
+def _get_vaudair_xlsx():
+    # each sheet has two rows of metadata (e.g., units) before the measurements
+    def get_sheet_df(times, values):
+        return pd.DataFrame(
+            [["°C", "°C"], ["1h", "1h"]] + values,
+            index=["unit", "period"] + times,
+            columns=["AVAN", "ECH"],
+        )
+
+    xlsx = io.BytesIO()
+    with pd.ExcelWriter(xlsx) as writer:
+        get_sheet_df(
+            ["2023-08-15 00:00", "2023-08-15 01:00"], [[20.5, 21.0], [20.1, 20.7]]
+        ).to_excel(writer, sheet_name="2023-08-15")
+        get_sheet_df(["2023-08-16 00:00"], [[22.4, 23.2]]).to_excel(
+            writer, sheet_name="2023-08-16"
+        )
+    return xlsx.getvalue()
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    """Mock S3 client with IDAWEB and Vaud'air objects."""
+    for env_var in ["AWS_PROFILE", "S3_ENDPOINT_URL"]:
+        monkeypatch.delenv(env_var, raising=False)
+    with mock_aws():
+        s3_client = boto3.client(
+            "s3",
+            region_name="us-east-1",
+            aws_access_key_id="testing",
+            aws_secret_access_key="testing",
+        )
+        s3_client.create_bucket(Bucket=BUCKET_NAME)
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=IDAWEB_KEY, Body=IDAWEB_TXT)
+        s3_client.put_object(
+            Bucket=BUCKET_NAME, Key=VAUDAIR_KEY, Body=_get_vaudair_xlsx()
+        )
+        yield s3_client
+
+
+@pytest.fixture
+def spaces_client(s3_client, tmp_path):
+    """Spaces client of the mock bucket, with a cache directory."""
+    return official_stations_utils.SpacesClient(
+        BUCKET_NAME,
+        access_key_id="testing",
+        secret_access_key="testing",
+        region_name="us-east-1",
+        cache_dir=str(tmp_path),
+    )
+
+
+def test_fetch_many(spaces_client):
+    """Test concurrent fetching of (repeated) keys."""
+    # repeated keys are downloaded concurrently into the same cache directory
+    keys = [IDAWEB_KEY, VAUDAIR_KEY, IDAWEB_KEY, IDAWEB_KEY]
+    filepath_dict = spaces_client.fetch_many(keys, max_workers=4)
+    assert set(filepath_dict) == set(keys)
+    with open(filepath_dict[IDAWEB_KEY]) as src:
+        assert src.read() == IDAWEB_TXT
+    with open(filepath_dict[VAUDAIR_KEY], "rb") as src:
+        assert src.read()[:2] == b"PK"
+    # keep the extension so that readers can infer the file format
+    assert path.splitext(filepath_dict[VAUDAIR_KEY])[1] == ".xlsx"
+    # cached objects are not downloaded again
+    assert spaces_client.fetch_many(keys) == filepath_dict
+
+
+def test_fetch_etag_invalidation(s3_client, spaces_client):
+    """Test that objects are downloaded again when their ETag changes."""
+    filepath = spaces_client.fetch(IDAWEB_KEY)
+    assert spaces_client.fetch(IDAWEB_KEY) == filepath
+
+    # overwriting the object changes its ETag, so that it is downloaded again and the
+    # stale version is removed
+    new_txt = IDAWEB_TXT.replace("20.1", "20.2")
+    s3_client.put_object(Bucket=BUCKET_NAME, Key=IDAWEB_KEY, Body=new_txt)
+    new_filepath = spaces_client.fetch(IDAWEB_KEY)
+    assert new_filepath != filepath
+    assert not path.exists(filepath)
+    with open(new_filepath) as src:
+        assert src.read() == new_txt
+
+
+def test_get_idaweb_df(spaces_client, monkeypatch):
+    """Test the parsing of IDAWEB text files."""
+    # parse in small chunks so that the header rows fall in different chunks
+    monkeypatch.setattr(official_stations_utils.settings, "IDAWEB_CHUNKSIZE", 2)
+    idaweb_df = spaces_client.get_idaweb_df(IDAWEB_KEY)
+    pd.testing.assert_frame_equal(
+        idaweb_df,
+        pd.DataFrame(
+            {"LSN": [22.3, np.nan], "PUY": [20.1, 19.5]},
+            index=pd.to_datetime(["2023-08-15 00:00", "2023-08-15 01:00"]).rename(
+                "time"
+            ),
+        ).rename_axis(columns="stn"),
+    )
+
+
+@pytest.mark.parametrize("sheet_name", [None, "2023-08-15"])
+def test_get_vaudair_df(spaces_client, sheet_name):
+    """Test the parsing of Vaud'air Excel files, with all or a single sheet."""
+    vaudair_df = spaces_client.get_vaudair_df(VAUDAIR_KEY, sheet_name=sheet_name)
+    expected_df = pd.DataFrame(
+        {"AVAN": [20.5, 20.1, 22.4], "ECH": [21.0, 20.7, 23.2]},
+        index=pd.to_datetime(
+            ["2023-08-15 00:00", "2023-08-15 01:00", "2023-08-16 00:00"]
+        ).rename("time"),
+    )
+    if sheet_name is not None:
+        expected_df = expected_df.iloc[:2]
+    pd.testing.assert_frame_equal(vaudair_df, expected_df)
@@ -0,0 +1,172 @@
+"""Tests for the regression utils."""
+
+from os import path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from uhi_drivers_lausanne import regr_utils, ts_utils
+
+STATION_INDEX_NAME = "station_id"
+TZ = "Europe/Zurich"
+
+
+def _get_wide_ts_df(tz):
+    # ten-minute measurements of three stations around a day, with missing values
+    rng = np.random.default_rng(0)
+    index = pd.date_range(
+        "2023-08-14 20:00", "2023-08-16 04:00", freq="10min", tz=tz, name="time"
+    )
+    arr = rng.normal(20, 3, size=(len(index), 3))
+    arr[rng.random(arr.shape) < 0.2] = np.nan
+    arr[:30, 2] = np.nan
+    return pd.DataFrame(arr, index=index, columns=["AVAN", "ECH", "PUY"])
+
+
+def _get_reference_long_ts_df(ts_df_filepath, start_dt, end_dt):
+    # the implementation that reads the whole wide data frame and resamples it
+    if path.splitext(ts_df_filepath)[1] == ".csv":
+        ts_df = pd.read_csv(ts_df_filepath)
+        ts_df["time"] = pd.to_datetime(ts_df["time"])
+        ts_df = ts_df.set_index("time")
+    else:
+        ts_df = ts_utils.read_wide_ts_df(ts_df_filepath)
+    ts_df = ts_df.resample("H").mean()
+    if start_dt is not None:
+        ts_df = ts_df.loc[start_dt:]
+    if end_dt is not None:
+        ts_df = ts_df.loc[:end_dt]
+    return (
+        ts_df.stack(dropna=True)
+        .rename_axis(["time", STATION_INDEX_NAME])
+        .reset_index(name="T")
+    )
+
+
+def _sort_long_ts_df(ts_df):
+    ts_df = ts_df.sort_values(["time", STATION_INDEX_NAME]).reset_index(drop=True)
+    ts_df[STATION_INDEX_NAME] = ts_df[STATION_INDEX_NAME].astype(str)
+    return ts_df
+
+
+@pytest.mark.parametrize("file_format", ["csv", "parquet"])
+@pytest.mark.parametrize(
+    "tz, start_dt, end_dt",
+    [
+        (None, None, None),
+        (None, "2023-08-15", "2023-08-15"),
+        (None, "2023-08-15 01:30", pd.Timestamp("2023-08-15 10:00")),
+        (TZ, None, None),
+        (TZ, "2023-08-15", "2023-08-16"),
+        (TZ, "2023-08-15 01:30", "2023-08-15 10:00"),
+        (
+            TZ,
+            pd.Timestamp("2023-08-15", tz="UTC"),
+            pd.Timestamp("2023-08-15 10:00", tz=TZ),
+        ),
+    ],
+)
+def test_get_long_ts_df(tmp_path, file_format, tz, start_dt, end_dt):
+    """Test the hourly long time series against the reference implementation."""
+    wide_ts_df = _get_wide_ts_df(tz)
+    if file_format == "csv":
+        ts_df_filepath = str(tmp_path / "ts-df.csv")
+        wide_ts_df.to_csv(ts_df_filepath)
+    else:
+        ts_df_filepath = str(tmp_path / "ts-df")
+        ts_utils.write_ts_df(wide_ts_df, ts_df_filepath, source="cws")
+
+    # parse the CSV files in small chunks so that hours span several chunks
+    long_ts_df = regr_utils.get_long_ts_df(
+        [ts_df_filepath],
+        STATION_INDEX_NAME,
+        start_dt=start_dt,
+        end_dt=end_dt,
+        chunksize=7,
+        max_workers=1,
+    )
+    pd.testing.assert_frame_equal(
+        _sort_long_ts_df(long_ts_df),
+        _sort_long_ts_df(_get_reference_long_ts_df(ts_df_filepath, start_dt, end_dt)),
+    )
+
+
+def _get_long_ts_df(num_timestamps, num_stations, *, seed=0):
+    # hourly measurements of official and CWS stations, with missing values
+    rng = np.random.default_rng(seed)
+    ts_df = pd.DataFrame(
+        {
+            "time": np.repeat(
+                pd.date_range("2023-08-15", periods=num_timestamps, freq="h", tz=TZ),
+                num_stations,
+            ),
+            STATION_INDEX_NAME: np.tile(
+                [f"station-{i}" for i in range(num_stations)], num_timestamps
+            ),
+            "T": rng.normal(20, 3, num_timestamps * num_stations).round(2),
+            "source": np.tile(
+                np.where(np.arange(num_stations) % 4, "cws", "official"),
+                num_timestamps,
+            ),
+        }
+    )
+    ts_df.loc[rng.random(len(ts_df)) < 0.1, "T"] = np.nan
+    # shuffle the rows so that timestamps are not contiguous
+    return ts_df.sample(frac=1, random_state=seed)
+
+
+def _get_reference_uhi_df(ts_df):
+    # the implementation that subtracts the minimum temperature timestamp by timestamp
+    return (
+        ts_df.drop("time", axis="columns")
+        .groupby(ts_df["time"])
+        .apply(
+            lambda group_df: group_df.assign(
+                **{"UHI": group_df["T"] - group_df["T"].min()}
+            ).drop("T", axis="columns")
+        )
+        .droplevel(-1)
+        .reset_index()
+    )
+
+
+def test_get_uhi_df():
+    """Test the UHI data frame against the reference implementation."""
+    ts_df = _get_long_ts_df(50, 20)
+    pd.testing.assert_frame_equal(
+        regr_utils.get_uhi_df(ts_df), _get_reference_uhi_df(ts_df), check_exact=True
+    )
+
+
+@pytest.mark.parametrize(
+    "get_uhi_ser_kws, get_reference",
+    [
+        ({}, lambda group_ser, _: group_ser.min()),
+        (
+            {"reference": "rural", "rural_stations": ["station-1", "station-2"]},
+            lambda group_ser, group_df: group_ser[
+                group_df[STATION_INDEX_NAME].isin(["station-1", "station-2"])
+            ].mean(),
+        ),
+        (
+            {"reference": "percentile", "q": 0.1},
+            lambda group_ser, _: group_ser.quantile(0.1),
+        ),
+    ],
+)
+@pytest.mark.parametrize("by", [None, "source"])
+def test_get_uhi_ser(get_uhi_ser_kws, get_reference, by):
+    """Test the UHI series against a reference computed group by group."""
+    ts_df = _get_long_ts_df(50, 20)
+    keys = ["time"] if by is None else ["time", by]
+    reference_ser = pd.concat(
+        [
+            group_df["T"] - get_reference(group_df["T"], group_df)
+            for _, group_df in ts_df.groupby(keys)
+        ]
+    )
+    pd.testing.assert_series_equal(
+        regr_utils.get_uhi_ser(ts_df, by=by, **get_uhi_ser_kws),
+        reference_ser.reindex(ts_df.index).rename("UHI"),
+    )
@@ -0,0 +1,484 @@
+"""Building utils."""
+import os
+from concurrent import futures
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import shapely
+import tqdm
+from rasterio import features, windows
+
+from uhi_drivers_lausanne import grid_utils, profile_utils, settings, stac_utils
+
+
+def _get_layers(geoms: np.ndarray) -> np.ndarray:
+    """Assign geometries to layers so that geometries of a layer do not intersect.
+
+    Parameters
+    ----------
+    geoms : numpy.ndarray
+        Array of geometries.
+
+    Returns
+    -------
+    layers : numpy.ndarray
+        Layer of each geometry, assigned greedily (i.e., each geometry gets the lowest
+        layer that is not used by any of the previous geometries that it intersects).
+
+    """
+    geom_ilocs, other_ilocs = shapely.STRtree(geoms).query(
+        geoms, predicate="intersects"
+    )
+    layers = np.zeros(len(geoms), dtype=int)
+    # pairs are sorted by the first index
+    bounds = np.searchsorted(geom_ilocs, np.arange(len(geoms) + 1))
+    for i in range(len(geoms)):
+        others = other_ilocs[bounds[i] : bounds[i + 1]]
+        used_layers = set(layers[others[others < i]])
+        layer = 0
+        while layer in used_layers:
+            layer += 1
+        layers[i] = layer
+    return layers
+
+
+def _get_tile_height_sums(
+    surface3d_url: str,
+    alti3d_url: str,
+    bldg_geoms: np.ndarray,
+    cache: stac_utils.AssetCache | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Get the sum and count of the height pixels of each building within a tile.
+
+    Parameters
+    ----------
+    surface3d_url, alti3d_url : str
+        URLs of the swissSURFACE3D Raster and swissALTI3D tiles.
+    bldg_geoms : numpy.ndarray
+        Array of building footprints that intersect the tile.
+    cache : stac_utils.AssetCache, optional
+        Cache of remote assets from which the tiles are served. If None, the tiles are
+        read from their URLs.
+
+    Returns
+    -------
+    height_sums, pixel_counts : numpy.ndarray
+        Sum of the height values and number of valid pixels of each building.
+
+    """
+    if cache is not None:
+        surface3d_url = cache.get(surface3d_url)
+        alti3d_url = cache.get(alti3d_url)
+    with rio.open(surface3d_url) as src_surface3d, rio.open(alti3d_url) as src_alti3d:
+        element_arr = src_surface3d.read(1, masked=True) - src_alti3d.read(
+            1, masked=True
+        )
+        out_shape = src_surface3d.shape
+        t = src_surface3d.transform
+    nodata_mask = np.ma.getmaskarray(element_arr)
+    element_arr = element_arr.data.astype("float64")
+
+    height_sums = np.zeros(len(bldg_geoms) + 1)
+    pixel_counts = np.zeros(len(bldg_geoms) + 1, dtype="int64")
+    # a label raster can only hold one building per pixel, so overlapping footprints
+    # are rasterized in separate layers
+    layers = _get_layers(bldg_geoms)
+    for layer in np.unique(layers):
+        (layer_ilocs,) = np.nonzero(layers == layer)
+        # rasterize the footprints into a label raster (zero is the background), using
+        # the same pixel-center rule as `rasterstats.zonal_stats`
+        label_arr = features.rasterize(
+            zip(bldg_geoms[layer_ilocs], layer_ilocs + 1),
+            out_shape=out_shape,
+            transform=t,
+            fill=0,
+            dtype="int32",
+        )
+        valid_mask = (label_arr > 0) & ~nodata_mask
+        labels = label_arr[valid_mask]
+        height_sums += np.bincount(
+            labels, weights=element_arr[valid_mask], minlength=len(bldg_geoms) + 1
+        )
+        pixel_counts += np.bincount(labels, minlength=len(bldg_geoms) + 1)
+    return height_sums[1:], pixel_counts[1:]
+
+
+@profile_utils.profiled
+def get_bldg_height_df(
+    bldg_gser: gpd.GeoSeries,
+    tile_gdf: gpd.GeoDataFrame,
+    *,
+    surface3d_col: str | None = None,
+    alti3d_col: str | None = None,
+    cache: stac_utils.AssetCache | None = None,
+    max_workers: int | None = None,
+) -> pd.DataFrame:
+    """Get the height of each building from the swissSURFACE3D and swissALTI3D tiles.
+
+    The height of a building is the mean difference between the surface (swissSURFACE3D
+    Raster) and terrain (swissALTI3D) elevations of the pixels whose center lies within
+    its footprint. Footprints are rasterized once per tile into a label raster (one per
+    layer of non-overlapping footprints), and the sum and count of the heights of each
+    building are accumulated over all the tiles that it intersects, so that the mean of
+    buildings that span several tiles is exact.
+
+    Parameters
+    ----------
+    bldg_gser : geopandas.GeoSeries
+        Building footprints, in the same CRS as the tiles.
+    tile_gdf : geopandas.GeoDataFrame
+        Geo-data frame of tiles, in the same CRS as `bldg_gser`, with the URLs of the
+        swissSURFACE3D Raster and swissALTI3D tiles.
+    surface3d_col, alti3d_col : str, optional
+        Columns of `tile_gdf` with the URLs of the swissSURFACE3D Raster and
+        swissALTI3D tiles respectively. If None, the values from
+        `stac_utils.SWISSSURFACE3D_RASTER_COLLECTION` and
+        `stac_utils.SWISSALTI3D_COLLECTION` are used.
+    cache : stac_utils.AssetCache, optional
+        Cache of remote assets from which the tiles are served. If None, the tiles are
+        read from their URLs.
+    max_workers : int, optional
+        Maximum number of processes used to process tiles. If None, it will default to
+        the number of processors on the machine.
+
+    Returns
+    -------
+    bldg_height_df : pandas.DataFrame
+        Data frame with the sum, count and mean of the height pixels of each building
+        (index) that intersects at least one tile. Buildings without any valid pixel
+        have a NaN mean.
+
+    """
+    if surface3d_col is None:
+        surface3d_col = stac_utils.SWISSSURFACE3D_RASTER_COLLECTION
+    if alti3d_col is None:
+        alti3d_col = stac_utils.SWISSALTI3D_COLLECTION
+    if max_workers is None:
+        max_workers = os.cpu_count()
+
+    # bulk query of the building footprints that intersect each tile (the spatial
+    # index of geopandas is an STRtree)
+    tile_ilocs, bldg_ilocs = bldg_gser.sindex.query(
+        tile_gdf["geometry"], predicate="intersects"
+    )
+    bldg_geoms = bldg_gser.values
+    height_sums = np.zeros(len(bldg_gser))
+    pixel_counts = np.zeros(len(bldg_gser), dtype="int64")
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        future_to_bldg_ilocs = {}
+        for tile_iloc in np.unique(tile_ilocs):
+            _bldg_ilocs = bldg_ilocs[tile_ilocs == tile_iloc]
+            future = executor.submit(
+                _get_tile_height_sums,
+                tile_gdf[surface3d_col].iloc[tile_iloc],
+                tile_gdf[alti3d_col].iloc[tile_iloc],
+                bldg_geoms[_bldg_ilocs],
+                cache,
+            )
+            future_to_bldg_ilocs[future] = _bldg_ilocs
+        for future in tqdm.tqdm(
+            futures.as_completed(future_to_bldg_ilocs),
+            total=len(future_to_bldg_ilocs),
+        ):
+            _bldg_ilocs = future_to_bldg_ilocs[future]
+            tile_height_sums, tile_pixel_counts = future.result()
+            # each building appears at most once per tile, so there are no repeated
+            # indices in the in-place additions
+            height_sums[_bldg_ilocs] += tile_height_sums
+            pixel_counts[_bldg_ilocs] += tile_pixel_counts
+
+    intersects = np.isin(np.arange(len(bldg_gser)), bldg_ilocs)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.DataFrame(
+            {
+                "sum": height_sums,
+                "count": pixel_counts,
+                "mean": height_sums / pixel_counts,
+            },
+            index=bldg_gser.index,
+        )[intersects]
+
+
+def _get_chunk_buffer_sums(
+    station_geoms: np.ndarray,
+    bldg_geoms: np.ndarray,
+    bldg_heights: np.ndarray,
+    pair_station_ilocs: np.ndarray,
+    pair_bldg_ilocs: np.ndarray,
+    buffer_dists: list,
+) -> np.ndarray:
+    """Get the building sums within the buffers of a chunk of stations.
+
+    Parameters
+    ----------
+    station_geoms : numpy.ndarray
+        Array of station points.
+    bldg_geoms : numpy.ndarray
+        Array of building footprints within the largest buffer of any station.
+    bldg_heights : numpy.ndarray
+        Height of each building in `bldg_geoms`, NaN if unknown.
+    pair_station_ilocs, pair_bldg_ilocs : numpy.ndarray
+        Positions (in `station_geoms` and `bldg_geoms` respectively) of the
+        station-building pairs that intersect the largest buffer.
+    buffer_dists : list of numeric
+        Sorted buffer distances.
+
+    Returns
+    -------
+    sum_arr : numpy.ndarray
+        Array of shape (stations, buffer distances, 4) with the clipped building area,
+        the clipped area times the height, the number of buildings and the clipped
+        area of the buildings of known height within each buffer.
+
+    """
+    bldg_areas = shapely.area(bldg_geoms)
+    known_height = ~np.isnan(bldg_heights)
+    bldg_heights = np.where(known_height, bldg_heights, 0)
+    sum_arr = np.zeros((len(station_geoms), len(buffer_dists), 4))
+    # buffers are nested, so the pairs that intersect a buffer are a subset of those
+    # that intersect the next larger one, i.e., the candidate pairs shrink as the
+    # buffers get smaller
+    for i in reversed(range(len(buffer_dists))):
+        buffer_geoms = shapely.buffer(station_geoms, buffer_dists[i], quad_segs=16)
+        shapely.prepare(buffer_geoms)
+        pair_buffer_geoms = buffer_geoms[pair_station_ilocs]
+        pair_bldg_geoms = bldg_geoms[pair_bldg_ilocs]
+        if i < len(buffer_dists) - 1:
+            intersects = shapely.intersects(pair_buffer_geoms, pair_bldg_geoms)
+            pair_station_ilocs = pair_station_ilocs[intersects]
+            pair_bldg_ilocs = pair_bldg_ilocs[intersects]
+            pair_buffer_geoms = pair_buffer_geoms[intersects]
+            pair_bldg_geoms = pair_bldg_geoms[intersects]
+        # only the footprints that cross the buffer boundary need to be clipped
+        pair_areas = bldg_areas[pair_bldg_ilocs]
+        crosses = ~shapely.contains_properly(pair_buffer_geoms, pair_bldg_geoms)
+        pair_areas[crosses] = shapely.area(
+            shapely.intersection(pair_buffer_geoms[crosses], pair_bldg_geoms[crosses])
+        )
+        for j, weights in enumerate(
+            [
+                pair_areas,
+                pair_areas * bldg_heights[pair_bldg_ilocs],
+                pair_areas > 0,
+                pair_areas * known_height[pair_bldg_ilocs],
+            ]
+        ):
+            sum_arr[:, i, j] = np.bincount(
+                pair_station_ilocs, weights=weights, minlength=len(station_geoms)
+            )
+    return sum_arr
+
+
+@profile_utils.profiled
+def get_buffer_features_df(
+    station_gser: gpd.GeoSeries,
+    bldg_gser: gpd.GeoSeries,
+    bldg_height_ser: pd.Series,
+    buffer_dists: list,
+    *,
+    chunksize: int | None = None,
+    max_workers: int | None = None,
+) -> pd.DataFrame:
+    """Get the building density and height features within buffers around stations.
+
+    For each buffer distance, the features are the fraction of the buffer covered by
+    buildings ("bldg_area"), the building volume per unit of buffer area
+    ("bldg_volume"), the number of buildings ("bldg_count") and their area-weighted
+    mean height ("bldg_height"). Footprints are clipped to the (polygonal) buffers, so
+    that buildings that cross the buffer boundary only count their area within it.
+
+    The spatial index of the footprints is built once and queried in bulk with the
+    largest buffer of all the stations. The candidate pairs are then processed in
+    chunks of stations, in parallel, and all the (nested) buffer distances are
+    computed in the same pass.
+
+    Parameters
+    ----------
+    station_gser : geopandas.GeoSeries
+        Station locations, in the same (projected) CRS as `bldg_gser`.
+    bldg_gser : geopandas.GeoSeries
+        Building footprints.
+    bldg_height_ser : pandas.Series
+        Height of each building of `bldg_gser`, in the same order. Buildings with NaN
+        height count for the area features but not for the height features.
+    buffer_dists : list of numeric
+        Buffer distances, in the units of the CRS.
+    chunksize : int, optional
+        Number of stations processed at once. If None, the value from
+        `settings.BLDG_CHUNKSIZE` is used.
+    max_workers : int, optional
+        Maximum number of processes used to process chunks. If None, it will default
+        to the number of processors on the machine.
+
+    Returns
+    -------
+    buffer_features_df : pandas.DataFrame
+        Wide data frame with the features (columns, e.g., "bldg_area_10") of each
+        station (index). Stations without buildings within a buffer have zero area,
+        volume and count and NaN height.
+
+    """
+    if chunksize is None:
+        chunksize = settings.BLDG_CHUNKSIZE
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    buffer_dists = sorted(buffer_dists)
+
+    station_geoms = station_gser.values
+    bldg_geoms = bldg_gser.values
+    # OSM footprints may be invalid, which would make the clipping fail
+    invalid = ~shapely.is_valid(bldg_geoms)
+    if invalid.any():
+        bldg_geoms = bldg_geoms.copy()
+        bldg_geoms[invalid] = shapely.make_valid(bldg_geoms[invalid])
+    bldg_heights = bldg_height_ser.to_numpy(dtype=float)
+
+    # bulk query of the footprints that intersect the largest buffer of each station,
+    # with the pairs sorted by station so that chunks are contiguous
+    station_ilocs, bldg_ilocs = shapely.STRtree(bldg_geoms).query(
+        shapely.buffer(station_geoms, buffer_dists[-1], quad_segs=16),
+        predicate="intersects",
+    )
+    order = np.argsort(station_ilocs, kind="stable")
+    station_ilocs, bldg_ilocs = station_ilocs[order], bldg_ilocs[order]
+    starts = np.arange(0, len(station_geoms), chunksize)
+    bounds = np.searchsorted(station_ilocs, np.append(starts, len(station_geoms)))
+    profile_utils.add_counts(stations=len(station_geoms), pairs=len(station_ilocs))
+
+    sum_arr = np.zeros((len(station_geoms), len(buffer_dists), 4))
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        future_to_start = {}
+        for start, pair_start, pair_end in zip(starts, bounds[:-1], bounds[1:]):
+            # only send the footprints of the chunk to the worker
+            chunk_bldg_ilocs, pair_bldg_ilocs = np.unique(
+                bldg_ilocs[pair_start:pair_end], return_inverse=True
+            )
+            future = executor.submit(
+                _get_chunk_buffer_sums,
+                station_geoms[start : start + chunksize],
+                bldg_geoms[chunk_bldg_ilocs],
+                bldg_heights[chunk_bldg_ilocs],
+                station_ilocs[pair_start:pair_end] - start,
+                pair_bldg_ilocs,
+                buffer_dists,
+            )
+            future_to_start[future] = start
+        for future in tqdm.tqdm(
+            futures.as_completed(future_to_start), total=len(future_to_start)
+        ):
+            start = future_to_start[future]
+            sum_arr[start : start + chunksize] = future.result()
+
+    buffer_areas = np.pi * np.array(buffer_dists, dtype=float) ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        feature_arrs = {
+            "bldg_area": sum_arr[:, :, 0] / buffer_areas,
+            "bldg_volume": sum_arr[:, :, 1] / buffer_areas,
+            "bldg_count": sum_arr[:, :, 2].astype(int),
+            "bldg_height": sum_arr[:, :, 1] / sum_arr[:, :, 3],
+        }
+    return pd.DataFrame(
+        {
+            f"{feature}_{buffer_dist}": feature_arr[:, i]
+            for i, buffer_dist in enumerate(buffer_dists)
+            for feature, feature_arr in feature_arrs.items()
+        },
+        index=station_gser.index,
+    )
+
+
+@profile_utils.profiled
+def rasterize_bldg_layers(
+    bldg_gser: gpd.GeoSeries,
+    bldg_height_ser: pd.Series,
+    bounds: tuple,
+    area_filepath: str,
+    volume_filepath: str,
+    *,
+    res: float = 1,
+    window_size: int = 1024,
+) -> None:
+    """Rasterize the building footprints and heights, e.g., for the grid mode.
+
+    The mean of the area raster within a buffer is the fraction of the buffer covered
+    by buildings, and the mean of the volume raster is the building volume per unit
+    of buffer area, i.e., the "bldg_area" and "bldg_volume" features of
+    `get_buffer_features_df` (see `grid_utils.compute_buffer_features`). The rasters
+    are written window by window, so that memory use is bounded.
+
+    Parameters
+    ----------
+    bldg_gser : geopandas.GeoSeries
+        Building footprints, in a projected CRS.
+    bldg_height_ser : pandas.Series
+        Height of each building of `bldg_gser`, in the same order. Buildings with NaN
+        height have zero volume.
+    bounds : tuple
+        Bounds of the rasters (minx, miny, maxx, maxy), in the CRS of `bldg_gser`.
+    area_filepath, volume_filepath : str
+        Paths to the area (one for the pixels whose center is within a footprint,
+        zero elsewhere) and volume (height of the building of each pixel) rasters.
+    res : numeric, default 1
+        Resolution of the rasters, in the units of the CRS.
+    window_size : int, default 1024
+        Side (in pixels) of the windows rasterized at once.
+
+    """
+    grid_transform, (height, width) = grid_utils.get_grid(bounds, res)
+    bldg_geoms = bldg_gser.values
+    bldg_heights = np.nan_to_num(bldg_height_ser.to_numpy(dtype=float))
+    tree = shapely.STRtree(bldg_geoms)
+    profile_kws = dict(
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=1,
+        crs=bldg_gser.crs,
+        transform=grid_transform,
+        tiled=True,
+        compress="deflate",
+    )
+    with rio.open(
+        area_filepath, "w", dtype="uint8", **profile_kws
+    ) as area_dst, rio.open(
+        volume_filepath, "w", dtype="float32", predictor=3, **profile_kws
+    ) as volume_dst:
+        for row_start in range(0, height, window_size):
+            for col_start in range(0, width, window_size):
+                window = windows.Window(
+                    col_start,
+                    row_start,
+                    min(window_size, width - col_start),
+                    min(window_size, height - row_start),
+                )
+                bldg_ilocs = tree.query(
+                    shapely.box(*windows.bounds(window, grid_transform))
+                )
+                if len(bldg_ilocs) == 0:
+                    continue
+                rasterize_kws = dict(
+                    out_shape=(window.height, window.width),
+                    transform=windows.transform(window, grid_transform),
+                    fill=0,
+                )
+                area_dst.write(
+                    features.rasterize(
+                        bldg_geoms[bldg_ilocs],
+                        default_value=1,
+                        dtype="uint8",
+                        **rasterize_kws,
+                    ),
+                    1,
+                    window=window,
+                )
+                volume_dst.write(
+                    features.rasterize(
+                        zip(bldg_geoms[bldg_ilocs], bldg_heights[bldg_ilocs]),
+                        dtype="float32",
+                        **rasterize_kws,
+                    ),
+                    1,
+                    window=window,
+                )
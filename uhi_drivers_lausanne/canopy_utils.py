@@ -1,68 +1,845 @@
 """Canopy utils."""
-import glob
-import io
+import hashlib
+import os
+import shutil
 import tempfile
+import warnings
 import zipfile
+from concurrent import futures
 from os import path
-from urllib import request
+from urllib import parse, request
 
-import detectree as dtr
+import geopandas as gpd
 import numpy as np
+import pandas as pd
 import pdal
-from rasterio import transform
+import rasterio as rio
+import shapely
+import tqdm
+import xarray as xr
+import zarr
+from numcodecs import Blosc
+from rasterio import transform, windows
 
+from uhi_drivers_lausanne import grid_utils, profile_utils, settings, stac_utils
 
-def get_lidar_arrays(lidar_url, gser, lidar_values, dst_res):
-    """Get lidar arrays."""
+TREE_CANOPY_NAME = "tree_canopy"
+# attribute of the tree canopy array listing the URLs of the tiles merged into it
+MERGED_TILES_ATTR = "merged_tiles"
+# attribute of the tree canopy array with the URL of the tile being merged into it, if
+# any
+MERGING_TILE_ATTR = "merging_tile"
+
+
+def download_lidar(
+    lidar_url: str, dst_dir: str, *, cache: stac_utils.AssetCache | None = None
+) -> str:
+    """Download a zipped LiDAR file and extract it.
+
+    The zip file is streamed to disk rather than read into memory, and removed once
+    the LiDAR file has been extracted (unless it is served from `cache`).
+
+    Parameters
+    ----------
+    lidar_url : str
+        URL of the zip file containing a single LiDAR (.las) file.
+    dst_dir : str
+        Directory where the LiDAR file is extracted.
+    cache : stac_utils.AssetCache, optional
+        Cache of remote assets from which the zip file is served. If None, the zip
+        file is downloaded.
+
+    Returns
+    -------
+    lidar_filepath : str
+        Path to the extracted LiDAR file.
+
+    """
+    if cache is None:
+        zip_filepath = path.join(dst_dir, path.basename(parse.urlparse(lidar_url).path))
+        with request.urlopen(lidar_url) as src, open(zip_filepath, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+    else:
+        zip_filepath = cache.get(lidar_url)
+    with zipfile.ZipFile(zip_filepath) as z:
+        # we know that there is only one file in the zip, i.e., the .las file
+        lidar_filepath = z.extract(z.namelist()[0], dst_dir)
+    if cache is None:
+        os.remove(zip_filepath)
+    return lidar_filepath
+
+
+def _get_lidar_arrays(lidar_filepath, gser, lidar_values, dst_res, chunksize):
+    """Get lidar arrays from a local LiDAR file."""
+    if chunksize is None:
+        chunksize = settings.LIDAR_CHUNKSIZE
+
+    geoms = gser.to_numpy()
+    shapely.prepare(geoms)
+    shapes = []
+    transforms = []
+    for geom in geoms:
+        west, south, east, north = geom.bounds
+        # # it is probably better to use `ceil` to make sure that we span the max
+        # # possible extent, but we cannot exceed the maximum width/height allocated
+        # # in the data array
+        # width = int(min(np.ceil((east - west) / dst_res), max_width))
+        # height = int(min(np.ceil((north - south) / dst_res), max_height))
+        width = int(np.round((east - west) / dst_res))
+        height = int(np.round((north - south) / dst_res))
+        shapes.append((height, width))
+        transforms.append(
+            transform.from_bounds(west, south, east, north, width, height)
+        )
+    count_arrs = [np.zeros(height * width, dtype=np.uint32) for height, width in shapes]
+
+    # stream the points of the classes of interest in chunks and count them in the
+    # pixels of each geometry, i.e., without writing the cropped points to disk
+    pipeline = pdal.Reader(lidar_filepath) | pdal.Filter.expression(
+        expression=" || ".join([f"Classification == {value}" for value in lidar_values])
+    )
+    for points in pipeline.iterator(chunk_size=chunksize):
+        x = points["X"]
+        y = points["Y"]
+        for geom, (height, width), t, count_arr in zip(
+            geoms, shapes, transforms, count_arrs
+        ):
+            west, south, east, north = geom.bounds
+            in_bounds = (x >= west) & (x <= east) & (y >= south) & (y <= north)
+            geom_x = x[in_bounds]
+            geom_y = y[in_bounds]
+            in_geom = shapely.intersects_xy(geom, geom_x, geom_y)
+            # pixel of each point as in `rasterio.transform.rowcol`, i.e., flooring the
+            # inverse transform (the transforms are not rotated)
+            rows = np.floor((geom_y[in_geom] - t.f) / t.e).astype(np.int64)
+            cols = np.floor((geom_x[in_geom] - t.c) / t.a).astype(np.int64)
+            in_arr = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+            count_arr += np.bincount(
+                rows[in_arr] * width + cols[in_arr], minlength=height * width
+            ).astype(np.uint32)
+
+    return [
+        count_arr.reshape(shape) for count_arr, shape in zip(count_arrs, shapes)
+    ], transforms
+
+
+def get_lidar_arrays(
+    lidar_url, gser, lidar_values, dst_res, *, cache=None, chunksize=None
+):
+    """Get lidar arrays.
+
+    The LiDAR points of the classes of interest are streamed in chunks and counted in
+    the pixels of a grid of resolution `dst_res` over the bounds of each geometry.
+
+    Parameters
+    ----------
+    lidar_url : str
+        URL of the zip file containing a single LiDAR (.las) file.
+    gser : geopandas.GeoSeries
+        Geometries over which the points are counted, in the CRS of the LiDAR data.
+    lidar_values : list of int
+        LiDAR classification values to rasterize.
+    dst_res : numeric
+        Resolution of the rasterized LiDAR arrays.
+    cache : stac_utils.AssetCache, optional
+        Cache of remote assets from which the zip file is served. If None, the zip
+        file is downloaded.
+    chunksize : int, optional
+        Number of LiDAR points read at once. If None, the value from
+        `settings.LIDAR_CHUNKSIZE` is used.
+
+    Returns
+    -------
+    arrays, transforms : list
+        Arrays with the count of points in each pixel and their transforms, for each
+        geometry of `gser`.
+
+    """
     with tempfile.TemporaryDirectory() as tmp_dir:
-        with zipfile.ZipFile(io.BytesIO(request.urlopen(lidar_url).read())) as z:
-            # we know that there is only one file in the zip, i.e., the .las file
-            lidar_filepath = z.extract(z.namelist()[0], tmp_dir)
-        pipeline = (
-            pdal.Reader(lidar_filepath)
-            | pdal.Filter.expression(
-                expression=" || ".join(
-                    [f"Classification == {value}" for value in lidar_values]
+        return _get_lidar_arrays(
+            download_lidar(lidar_url, tmp_dir, cache=cache),
+            gser,
+            lidar_values,
+            dst_res,
+            chunksize,
+        )
+
+
+def open_tree_canopy_arr(
+    dst_filepath: str,
+    station_ids,
+    arr_side: int,
+    *,
+    station_id_col: str,
+    notree_value: int = 0,
+    dtype: str = "uint8",
+) -> zarr.Array:
+    """Open the on-disk tree canopy array, creating it if it does not exist.
+
+    The array is stored as a Zarr group with a compressed chunk for each station, so
+    that tiles can be merged into it incrementally and that only the stations needed
+    are read afterwards (see `open_tree_canopy_da`). If the store already exists (e.g.,
+    from an interrupted run), it is opened so that the tiles merged so far are kept
+    (see `process_lidar_tiles`).
+
+    Parameters
+    ----------
+    dst_filepath : str
+        Path to the Zarr store.
+    station_ids : list-like
+        Station ids, i.e., labels of the first dimension of the array.
+    arr_side : int
+        Side of the array of each station (in pixels).
+    station_id_col : str
+        Name of the station id dimension.
+    notree_value : int, default 0
+        Value of the pixels without tree canopy, used as fill value.
+    dtype : str, default "uint8"
+        Integer data type of the array.
+
+    Returns
+    -------
+    tree_canopy_arr : zarr.Array
+        Tree canopy array, with the station id as first dimension.
+
+    """
+    station_ids = np.asarray(station_ids).astype(str)
+    shape = (len(station_ids), arr_side, arr_side)
+    group = zarr.open_group(dst_filepath, mode="a")
+    if TREE_CANOPY_NAME in group:
+        tree_canopy_arr = group[TREE_CANOPY_NAME]
+        if (
+            tree_canopy_arr.shape != shape
+            or tree_canopy_arr.dtype != dtype
+            or not np.array_equal(group[station_id_col][:], station_ids)
+        ):
+            raise ValueError(
+                f"The tree canopy array at {dst_filepath} does not match the stations,"
+                " array side or data type provided."
+            )
+        return tree_canopy_arr
+
+    # the `_ARRAY_DIMENSIONS` attributes make the store readable by xarray
+    station_id_arr = group.array(station_id_col, station_ids, overwrite=True)
+    station_id_arr.attrs["_ARRAY_DIMENSIONS"] = [station_id_col]
+    tree_canopy_arr = group.create(
+        TREE_CANOPY_NAME,
+        shape=shape,
+        chunks=(1, arr_side, arr_side),
+        dtype=dtype,
+        fill_value=notree_value,
+        compressor=Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE),
+    )
+    tree_canopy_arr.attrs.update(
+        {
+            "_ARRAY_DIMENSIONS": [station_id_col, "i", "j"],
+            MERGED_TILES_ATTR: [],
+            MERGING_TILE_ATTR: None,
+        }
+    )
+    return tree_canopy_arr
+
+
+def open_tree_canopy_da(filepath: str) -> xr.DataArray:
+    """Open the tree canopy array as a lazily-loaded data array.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the Zarr store, as created by `open_tree_canopy_arr`.
+
+    Returns
+    -------
+    tree_canopy_da : xarray.DataArray
+        Tree canopy data array, with the station id as first dimension. The station
+        chunks are only read from disk when the data array is sliced.
+
+    """
+    # do not mask the fill value, which is the no tree value rather than nodata
+    return xr.open_dataarray(
+        filepath, engine="zarr", consolidated=False, mask_and_scale=False
+    )
+
+
+def _get_station_index(tree_canopy_arr):
+    station_id_col = tree_canopy_arr.attrs["_ARRAY_DIMENSIONS"][0]
+    return pd.Index(zarr.open_group(tree_canopy_arr.store, mode="r")[station_id_col][:])
+
+
+def merge_lidar_arrays(
+    tree_canopy_arr, arrays, transforms, station_ids, transform_dict
+):
+    """Merge the lidar arrays of a tile into the tree canopy array.
+
+    Parameters
+    ----------
+    tree_canopy_arr : zarr.Array
+        Tree canopy array, as returned by `open_tree_canopy_arr`, modified in place.
+    arrays, transforms : list
+        Lidar arrays and their transforms, as returned by `get_lidar_arrays`.
+    station_ids : list-like
+        Station ids that correspond to each of the lidar arrays.
+    transform_dict : dict
+        Mapping of each station id to the transform of its array in `tree_canopy_arr`.
+
+    """
+    station_index = _get_station_index(tree_canopy_arr)
+    max_value = np.iinfo(tree_canopy_arr.dtype).max
+    for arr, t, station_id in zip(arrays, transforms, station_ids):
+        west, south, east, north = transform.array_bounds(*arr.shape, t)
+        row_start, col_start = transform.rowcol(transform_dict[station_id], west, north)
+        num_rows, num_cols = arr.shape
+        window = (
+            station_index.get_loc(str(station_id)),
+            slice(row_start, row_start + num_rows),
+            slice(col_start, col_start + num_cols),
+        )
+        # ACHTUNG: use the sum because tiles are not perfectly aligned with
+        # `tree_canopy_arr`, i.e., they are rhomboid-like, therefore we may write nodata
+        # values (i.e., zeros) from the difference of the rhomboid and its containing
+        # rectangle (i.e., the actual `arr.shape`), which may overlap an area of
+        # `tree_canopy_arr` that already had valid data from another tile. Taking
+        # advantage of the fact that nodata is zero, using the sum will ensure that we
+        # do not replace valid rasterized LiDAR values by zero and will not affect the
+        # valid data either given the neutrality of zero w.r.t. the sum operation. This
+        # also makes the result independent of the order in which tiles are merged.
+        # The sum is clipped so that it cannot overflow the (small) integer data type.
+        tree_canopy_arr[window] = np.minimum(
+            tree_canopy_arr[window].astype(np.int64) + arr, max_value
+        )
+
+
+def _merge_tile(
+    tree_canopy_arr, lidar_url, arrays, transforms, station_ids, transform_dict
+):
+    # since tiles are summed into the array, record the tile before writing it so that
+    # if the run is interrupted in between, the stations of the tile are rebuilt on
+    # resume (see `_rebuild_merging_tile`) rather than summing the tile twice
+    tree_canopy_arr.attrs[MERGING_TILE_ATTR] = lidar_url
+    merge_lidar_arrays(tree_canopy_arr, arrays, transforms, station_ids, transform_dict)
+    # mark the tile as merged in a single update of the attributes
+    tree_canopy_arr.attrs.update(
+        {
+            MERGED_TILES_ATTR: tree_canopy_arr.attrs[MERGED_TILES_ATTR] + [lidar_url],
+            MERGING_TILE_ATTR: None,
+        }
+    )
+
+
+def _get_checkpoint_filepath(
+    checkpoint_dir, lidar_url, gdf, station_id_col, lidar_values, dst_res
+):
+    # key the checkpoint by the content of its inputs, i.e., the tile, the stations
+    # (ids and clipped buffers) that intersect it and the rasterization parameters, so
+    # that a checkpoint is never reused for different stations, buffers or resolution
+    digest = hashlib.sha256()
+    digest.update(lidar_url.encode())
+    digest.update(repr((list(lidar_values), dst_res)).encode())
+    for station_id, wkb in zip(
+        gdf[station_id_col].astype(str), shapely.to_wkb(gdf["geometry"].values)
+    ):
+        digest.update(station_id.encode())
+        digest.update(wkb)
+    return path.join(
+        checkpoint_dir,
+        f"{path.basename(parse.urlparse(lidar_url).path)}-{digest.hexdigest()[:16]}"
+        ".npz",
+    )
+
+
+def _save_checkpoint(checkpoint_filepath, arrays, transforms, station_ids):
+    # write to a temporary file first so that an interrupted run never leaves a
+    # partially written checkpoint behind
+    tmp_filepath = f"{checkpoint_filepath}.tmp"
+    with open(tmp_filepath, "wb") as dst:
+        np.savez(
+            dst,
+            transforms=np.array([tuple(t)[:6] for t in transforms]),
+            # use a list so that string ids are not stored as (pickled) objects
+            station_ids=np.array(list(station_ids)),
+            **{f"arr_{i}": arr for i, arr in enumerate(arrays)},
+        )
+    os.replace(tmp_filepath, checkpoint_filepath)
+
+
+def _load_checkpoint(checkpoint_filepath):
+    with np.load(checkpoint_filepath) as npz:
+        station_ids = npz["station_ids"]
+        return (
+            [npz[f"arr_{i}"] for i in range(len(station_ids))],
+            [transform.Affine(*coeffs) for coeffs in npz["transforms"]],
+            station_ids,
+        )
+
+
+def _rebuild_merging_tile(
+    tree_canopy_arr,
+    tile_stations_gdf,
+    transform_dict,
+    lidar_values,
+    dst_res,
+    station_id_col,
+    url_col,
+    checkpoint_dir,
+):
+    """Rebuild the stations of a tile whose merge was interrupted."""
+    merging_tile = tree_canopy_arr.attrs[MERGING_TILE_ATTR]
+    merged_tiles = tree_canopy_arr.attrs[MERGED_TILES_ATTR]
+    # the chunks of the stations of the tile may include only some of its arrays, so
+    # they are reset and rebuilt from the checkpoints of all the tiles merged into them
+    rebuild_station_ids = tile_stations_gdf.loc[
+        tile_stations_gdf[url_col] == merging_tile, station_id_col
+    ].astype(str)
+    checkpoint_filepaths = []
+    if checkpoint_dir is not None:
+        for lidar_url, gdf in tile_stations_gdf.groupby(by=url_col):
+            is_merged = lidar_url == merging_tile or lidar_url in merged_tiles
+            tile_station_ids = gdf[station_id_col].astype(str)
+            if is_merged and tile_station_ids.isin(rebuild_station_ids).any():
+                checkpoint_filepaths.append(
+                    _get_checkpoint_filepath(
+                        checkpoint_dir,
+                        lidar_url,
+                        gdf,
+                        station_id_col,
+                        lidar_values,
+                        dst_res,
+                    )
                 )
+    if checkpoint_dir is not None and all(
+        path.exists(checkpoint_filepath) for checkpoint_filepath in checkpoint_filepaths
+    ):
+        station_index = _get_station_index(tree_canopy_arr)
+        for station_id in rebuild_station_ids:
+            station_i = station_index.get_loc(station_id)
+            tree_canopy_arr[station_i] = tree_canopy_arr.fill_value
+        for checkpoint_filepath in checkpoint_filepaths:
+            arrays, transforms, station_ids = _load_checkpoint(checkpoint_filepath)
+            rebuild_i = np.flatnonzero(
+                np.isin(station_ids.astype(str), rebuild_station_ids)
+            )
+            merge_lidar_arrays(
+                tree_canopy_arr,
+                [arrays[i] for i in rebuild_i],
+                [transforms[i] for i in rebuild_i],
+                station_ids[rebuild_i],
+                transform_dict,
             )
-            # | pdal.Filter.crop(polygon=geom.wkt)
-            # | pdal.Writer.gdal(
-            #     raster_filepath,
-            #     resolution=TARGET_CANOPY_RES,
-            #     nodata=0,
-            #     output_type="count",
-            #     origin_x=minx,
-            #     origin_y=miny,
-            #     width=width,
-            #     height=height,
-            #     default_srs=COLLECTION_DATA_CRS,
-            # )
-            | pdal.Filter.crop(polygon=[geom.wkt for geom in gser])
-            | pdal.Writer(path.join(tmp_dir, "geom-#.las"))
+        merged_tiles = merged_tiles + [merging_tile]
+    else:
+        warnings.warn(
+            f"The merge of {merging_tile} into the tree canopy array was interrupted "
+            "and the checkpoints to rebuild its stations are not available. All the "
+            "tiles will be merged again."
         )
-        _ = pipeline.execute()
-        arrays = []
-        transforms = []
-        for _lidar_filepath, geom in zip(
-            sorted(glob.glob(path.join(tmp_dir, "geom-*.las"))), gser
-        ):
-            west, south, east, north = geom.bounds
-            # # it is probably better to use `ceil` to make sure that we span the max
-            # # possible extent, but we cannot exceed the maximum width/height allocated
-            # # in the data array
-            # width = int(min(np.ceil((east - west) / dst_res), max_width))
-            # height = int(min(np.ceil((north - south) / dst_res), max_height))
-            width = int(np.round((east - west) / dst_res))
-            height = int(np.round((north - south) / dst_res))
-            t = transform.from_bounds(west, south, east, north, width, height)
-            arrays.append(
-                dtr.rasterize_lidar(
-                    _lidar_filepath,
-                    lidar_values,
-                    (height, width),
-                    t,
+        tree_canopy_arr[:] = tree_canopy_arr.fill_value
+        merged_tiles = []
+    # the rebuild starts over from the reset chunks, so that it can be interrupted too
+    tree_canopy_arr.attrs.update(
+        {MERGED_TILES_ATTR: merged_tiles, MERGING_TILE_ATTR: None}
+    )
+
+
+@profile_utils.profiled
+def process_lidar_tiles(
+    tile_stations_gdf: gpd.GeoDataFrame,
+    tree_canopy_arr: zarr.Array,
+    transform_dict: dict,
+    lidar_values: list,
+    dst_res: float,
+    station_id_col: str,
+    *,
+    url_col: str | None = None,
+    checkpoint_dir: str | None = None,
+    max_workers: int | None = None,
+    max_downloads: int | None = None,
+    max_in_flight: int | None = None,
+    cache: stac_utils.AssetCache | None = None,
+    chunksize: int | None = None,
+):
+    """Process the LiDAR tiles concurrently and merge them into a tree canopy array.
+
+    Tiles are downloaded by a thread pool and rasterized by a process pool, with at
+    most `max_in_flight` tiles being downloaded or processed at any time so that the
+    disk and memory used are bounded. Each finished tile is written to the on-disk
+    `tree_canopy_arr` and recorded in its attributes, so that interrupted runs resume
+    from the tiles left. The arrays of each finished tile can also be stored in
+    `checkpoint_dir`, so that they are merged without processing the tiles again.
+    Checkpoints are keyed by the tile, the stations that intersect it (ids and
+    geometries) and the rasterization parameters, so that they are only reused for the
+    same inputs. If a run is interrupted while a tile is being merged, its stations
+    are rebuilt from the checkpoints of the tiles that intersect them, or, if they are
+    not available, all the tiles are merged again.
+
+    Parameters
+    ----------
+    tile_stations_gdf : geopandas.GeoDataFrame
+        Geo-data frame of the intersection between the LiDAR tiles and the buffered
+        stations, in the CRS of the LiDAR data.
+    tree_canopy_arr : zarr.Array
+        Tree canopy array, as returned by `open_tree_canopy_arr`, modified in place.
+    transform_dict : dict
+        Mapping of each station id to the transform of its array in `tree_canopy_arr`.
+    lidar_values : list of int
+        LiDAR classification values to rasterize.
+    dst_res : numeric
+        Resolution of the rasterized LiDAR arrays.
+    station_id_col : str
+        Column of `tile_stations_gdf` with the station ids.
+    url_col : str, optional
+        Column of `tile_stations_gdf` with the tile URLs. If None, the value from
+        `stac_utils.SWISSSURFACE3D_COLLECTION` is used.
+    checkpoint_dir : str, optional
+        Directory where the arrays of each finished tile are stored. If None, no
+        checkpoints are stored.
+    max_workers : int, optional
+        Maximum number of processes used to rasterize tiles. If None, it will default
+        to the number of processors on the machine.
+    max_downloads : int, optional
+        Maximum number of concurrent downloads. If None, the value of `max_workers` is
+        used.
+    max_in_flight : int, optional
+        Maximum number of tiles being downloaded or processed at any time. If None,
+        twice the value of `max_workers` is used.
+    cache : stac_utils.AssetCache, optional
+        Cache of remote assets from which the tiles are served. If None, the tiles are
+        downloaded.
+    chunksize : int, optional
+        Number of LiDAR points read at once. If None, the value from
+        `settings.LIDAR_CHUNKSIZE` is used.
+
+    Returns
+    -------
+    tree_canopy_arr : zarr.Array
+        Tree canopy array.
+
+    """
+    if url_col is None:
+        url_col = stac_utils.SWISSSURFACE3D_COLLECTION
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    if max_downloads is None:
+        max_downloads = max_workers
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+
+    if tree_canopy_arr.attrs.get(MERGING_TILE_ATTR) is not None:
+        _rebuild_merging_tile(
+            tree_canopy_arr,
+            tile_stations_gdf,
+            transform_dict,
+            lidar_values,
+            dst_res,
+            station_id_col,
+            url_col,
+            checkpoint_dir,
+        )
+    merged_tiles = set(tree_canopy_arr.attrs[MERGED_TILES_ATTR])
+    pending_tiles = []
+    for lidar_url, gdf in tile_stations_gdf.groupby(by=url_col):
+        if lidar_url in merged_tiles:
+            continue
+        if checkpoint_dir is not None:
+            checkpoint_filepath = _get_checkpoint_filepath(
+                checkpoint_dir, lidar_url, gdf, station_id_col, lidar_values, dst_res
+            )
+            if path.exists(checkpoint_filepath):
+                _merge_tile(
+                    tree_canopy_arr,
+                    lidar_url,
+                    *_load_checkpoint(checkpoint_filepath),
+                    transform_dict,
                 )
+                continue
+        pending_tiles.append((lidar_url, gdf))
+    profile_utils.add_counts(
+        tiles=len(pending_tiles), stations=sum(len(gdf) for _, gdf in pending_tiles)
+    )
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, futures.ThreadPoolExecutor(
+        max_workers=max_downloads
+    ) as download_executor, futures.ProcessPoolExecutor(
+        max_workers=max_workers
+    ) as compute_executor, tqdm.tqdm(total=len(pending_tiles)) as pbar:
+        download_futures = {}
+        compute_futures = {}
+        while pending_tiles or download_futures or compute_futures:
+            while pending_tiles and (
+                len(download_futures) + len(compute_futures) < max_in_flight
+            ):
+                lidar_url, gdf = pending_tiles.pop()
+                # each tile is extracted into its own directory to avoid clashes
+                tile_dir = tempfile.mkdtemp(dir=tmp_dir)
+                download_futures[
+                    download_executor.submit(
+                        download_lidar, lidar_url, tile_dir, cache=cache
+                    )
+                ] = (lidar_url, gdf, tile_dir)
+            done, _ = futures.wait(
+                list(download_futures) + list(compute_futures),
+                return_when=futures.FIRST_COMPLETED,
             )
-            transforms.append(t)
+            for future in done:
+                if future in download_futures:
+                    lidar_url, gdf, tile_dir = download_futures.pop(future)
+                    compute_futures[
+                        compute_executor.submit(
+                            _get_lidar_arrays,
+                            future.result(),
+                            gdf["geometry"],
+                            lidar_values,
+                            dst_res,
+                            chunksize,
+                        )
+                    ] = (lidar_url, gdf, tile_dir)
+                else:
+                    lidar_url, gdf, tile_dir = compute_futures.pop(future)
+                    shutil.rmtree(tile_dir)
+                    arrays, transforms = future.result()
+                    station_ids = gdf[station_id_col].to_numpy()
+                    if checkpoint_dir is not None:
+                        _save_checkpoint(
+                            _get_checkpoint_filepath(
+                                checkpoint_dir,
+                                lidar_url,
+                                gdf,
+                                station_id_col,
+                                lidar_values,
+                                dst_res,
+                            ),
+                            arrays,
+                            transforms,
+                            station_ids,
+                        )
+                    _merge_tile(
+                        tree_canopy_arr,
+                        lidar_url,
+                        arrays,
+                        transforms,
+                        station_ids,
+                        transform_dict,
+                    )
+                    pbar.update()
+
+    return tree_canopy_arr
+
+
+@profile_utils.profiled
+def rasterize_lidar_tiles(
+    tile_gdf: gpd.GeoDataFrame,
+    dst_filepath: str,
+    bounds: tuple,
+    lidar_values: list,
+    dst_res: float,
+    *,
+    url_col: str | None = None,
+    cache: stac_utils.AssetCache | None = None,
+    max_workers: int | None = None,
+    chunksize: int | None = None,
+) -> None:
+    """Rasterize the LiDAR tiles over a whole extent, e.g., for the grid mode.
 
-    return arrays, transforms
+    Unlike `process_lidar_tiles`, which rasterizes the points around each station,
+    the points of each tile are counted in the pixels of a single raster over the
+    bounds (see `grid_utils.compute_buffer_features`). Tiles are processed in
+    parallel and each tile is written to the window of the raster that it covers, so
+    that memory use is bounded.
+
+    Parameters
+    ----------
+    tile_gdf : geopandas.GeoDataFrame
+        Geo-data frame of LiDAR tiles, in the CRS of the LiDAR data, as returned by
+        `SwissTopoClient.gdf_from_collection`.
+    dst_filepath : str
+        Path to the raster with the count of points in each pixel (capped at 255).
+    bounds : tuple
+        Bounds of the raster (minx, miny, maxx, maxy), in the CRS of the LiDAR data.
+    lidar_values : list of int
+        LiDAR classification values to rasterize.
+    dst_res : numeric
+        Resolution of the raster.
+    url_col : str, optional
+        Column of `tile_gdf` with the URL of each tile. If None, the value from
+        `stac_utils.SWISSSURFACE3D_COLLECTION` is used.
+    cache : stac_utils.AssetCache, optional
+        Cache of remote assets from which the tiles are served. If None, the tiles are
+        downloaded.
+    max_workers : int, optional
+        Maximum number of processes used to process tiles. If None, it will default to
+        the number of processors on the machine.
+    chunksize : int, optional
+        Number of LiDAR points read at once. If None, the value from
+        `settings.LIDAR_CHUNKSIZE` is used.
+
+    """
+    if url_col is None:
+        url_col = stac_utils.SWISSSURFACE3D_COLLECTION
+    if max_workers is None:
+        max_workers = os.cpu_count()
+
+    grid_transform, (height, width) = grid_utils.get_grid(bounds, dst_res)
+    full_window = windows.Window(0, 0, width, height)
+    tile_gdf = tile_gdf[tile_gdf.intersects(shapely.box(*bounds))]
+    profile_utils.add_counts(tiles=len(tile_gdf))
+    with rio.open(
+        dst_filepath,
+        "w+",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=1,
+        dtype="uint8",
+        crs=tile_gdf.crs,
+        transform=grid_transform,
+        tiled=True,
+        compress="deflate",
+    ) as dst, futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        future_to_window = {}
+        for lidar_url, tile_geom in tile_gdf[[url_col, "geometry"]].itertuples(
+            index=False
+        ):
+            # window of the pixels of the raster that the tile covers, snapped
+            # outwards so that the pixels of the tile are aligned with the raster
+            window = (
+                windows.from_bounds(*tile_geom.bounds, grid_transform)
+                .round_offsets(op="floor")
+                .round_lengths(op="ceil")
+                .intersection(full_window)
+            )
+            future = executor.submit(
+                get_lidar_arrays,
+                lidar_url,
+                gpd.GeoSeries(
+                    [shapely.box(*windows.bounds(window, grid_transform))],
+                    crs=tile_gdf.crs,
+                ),
+                lidar_values,
+                dst_res,
+                cache=cache,
+                chunksize=chunksize,
+            )
+            future_to_window[future] = window
+        for future in tqdm.tqdm(
+            futures.as_completed(future_to_window), total=len(future_to_window)
+        ):
+            window = future_to_window[future]
+            (count_arr,), _ = future.result()
+            # neighboring tiles may share the pixels along their boundary, so the
+            # counts are added rather than overwritten
+            dst.write(
+                np.minimum(
+                    dst.read(1, window=window).astype(np.uint32) + count_arr, 255
+                ).astype("uint8"),
+                1,
+                window=window,
+            )
+
+
+def get_ring_arr(pixel_radii: list) -> np.ndarray:
+    """Get the index of the smallest circular kernel that contains each pixel.
+
+    Kernels are centered at the center of an array of side twice the largest radius,
+    i.e., for a radius `r`, the kernel spans the `2 * r` pixels around the center
+    along each axis, and includes the pixels whose distance to the center is at most
+    `r`.
+
+    Parameters
+    ----------
+    pixel_radii : list of int
+        Sorted radii of the kernels (in pixels).
+
+    Returns
+    -------
+    ring_arr : numpy.ndarray
+        Array of side twice the largest radius with the index of the smallest kernel
+        that contains each pixel, or `len(pixel_radii)` for pixels outside all the
+        kernels.
+
+    """
+    largest_pixel_radius = pixel_radii[-1]
+    y, x = np.ogrid[
+        -largest_pixel_radius:largest_pixel_radius,
+        -largest_pixel_radius:largest_pixel_radius,
+    ]
+    ring_arr = np.full(
+        (2 * largest_pixel_radius, 2 * largest_pixel_radius), len(pixel_radii)
+    )
+    # assign the rings from the largest to the smallest kernel so that each pixel ends
+    # up with the smallest kernel that contains it
+    for i, pixel_radius in reversed(list(enumerate(pixel_radii))):
+        ring_arr[
+            (x * x + y * y <= pixel_radius * pixel_radius)
+            & (x >= -pixel_radius)
+            & (x < pixel_radius)
+            & (y >= -pixel_radius)
+            & (y < pixel_radius)
+        ] = i
+    return ring_arr
+
+
+@profile_utils.profiled
+def get_buffer_fractions(
+    canopy_arr,
+    buffer_dists: list,
+    res: float,
+    *,
+    threshold: float = 1,
+    chunksize: int = 1024,
+) -> np.ndarray:
+    """Get the fraction of tree canopy pixels within circular buffers.
+
+    The fractions for all the buffer distances are computed in a single pass: each
+    pixel is assigned once to the ring between two consecutive buffers, so that each
+    pixel is only counted in its ring and the counts are then accumulated from the
+    smallest to the largest buffer.
+
+    Parameters
+    ----------
+    canopy_arr : array-like
+        Tree canopy array with stations as first dimension and the stations at the
+        center of the two other dimensions, of side twice the largest buffer distance
+        (in pixels). It can be any array that supports slicing along the first
+        dimension (e.g., an xarray, dask or memory-mapped array), in which case only
+        `chunksize` stations are loaded into memory at a time.
+    buffer_dists : list of numeric
+        Sorted buffer distances.
+    res : numeric
+        Resolution of the canopy array, in the same units as `buffer_dists`.
+    threshold : numeric, default 1
+        Pixels with values greater than this threshold are considered tree canopy.
+    chunksize : int, default 1024
+        Number of stations processed at once.
+
+    Returns
+    -------
+    fraction_arr : numpy.ndarray
+        Array with the fraction of tree canopy pixels of each station (rows) within
+        each buffer distance (columns).
+
+    """
+    ring_arr = get_ring_arr([int(buffer_dist / res) for buffer_dist in buffer_dists])
+    # flat indices of the pixels of each ring
+    ring_pixels = [
+        np.flatnonzero(ring_arr == ring) for ring in range(len(buffer_dists))
+    ]
+    kernel_sizes = np.cumsum([len(pixels) for pixels in ring_pixels])
+
+    num_stations = canopy_arr.shape[0]
+    fraction_arr = np.empty((num_stations, len(buffer_dists)))
+    for start in range(0, num_stations, chunksize):
+        chunk_arr = np.asarray(canopy_arr[start : start + chunksize])
+        canopy_mask = chunk_arr.reshape(len(chunk_arr), -1) > threshold
+        # count the canopy pixels of each station in each ring, and accumulate them
+        # from the smallest to the largest buffer
+        fraction_arr[start : start + len(chunk_arr)] = (
+            np.cumsum(
+                np.column_stack(
+                    [canopy_mask[:, pixels].sum(axis=1) for pixels in ring_pixels]
+                ),
+                axis=1,
+            )
+            / kernel_sizes
+        )
+    return fraction_arr
@@ -3,45 +3,144 @@
 Based on Napoly et al., 2018 (https://doi.org/10.3389/feart.2018.00118)
 """
 
+import os
+import time
+import warnings
+from collections.abc import Iterable
+
+import geopandas as gpd
 import matplotlib as mpl
+import numpy as np
 import pandas as pd
 import seaborn as sns
+from scipy import sparse, spatial
 from scipy.stats import norm
-from statsmodels.robust import scale
 
-from uhi_drivers_lausanne import settings
+from uhi_drivers_lausanne import profile_utils, settings, ts_utils
+
+# maximum number of valid values in a timestamp for which the Qn scale is computed by
+# brute force (i.e., selecting the k-th order statistic among all the pairwise
+# differences), which is faster than the selection of `_select_pairwise_diffs` for
+# short rows but grows quadratically in memory
+_QN_PAIRWISE_MAX_COUNT = 128
+# normalization constant of the Qn scale, to get consistent estimates of the standard
+# deviation at the normal distribution (the default of statsmodels)
+_QN_C = 1 / (np.sqrt(2) * norm.ppf(5 / 8))
+# normalization constant of the median absolute deviation, to get consistent estimates
+# of the standard deviation at the normal distribution
+_MAD_C = 1 / norm.ppf(3 / 4)
+# maximum number of (station, neighbour) pairs processed at once in the buddy check
+_BUDDY_BATCH_SIZE = 1024
+# co-moments of each station with the spatial median, from which the Pearson
+# correlations are computed
+_median_comoment_names = [
+    "corr_count",
+    "mean",
+    "median_mean",
+    "m2",
+    "median_m2",
+    "comoment",
+]
+
+
+class StationIndex:
+    """Spatial index of station locations.
+
+    A KD-tree is built over the station locations once, and the lists of neighbours
+    within each queried radius are cached in compressed sparse row (CSR) form.
+
+    Parameters
+    ----------
+    station_gser : geopandas.GeoSeries
+        Geoseries of station locations (points), indexed by the station id. It should
+        be in a projected CRS so that distances are meaningful.
+
+    """
+
+    def __init__(self, station_gser: gpd.GeoSeries):
+        """Initialize the spatial index."""
+        self.station_ids = station_gser.index
+        self.tree = spatial.cKDTree(
+            np.column_stack([station_gser.x.to_numpy(), station_gser.y.to_numpy()])
+        )
+        self._neighbors_dict = {}
+
+    def get_neighbors(self, radius: float) -> sparse.csr_matrix:
+        """Get the neighbours of each station within a radius.
+
+        Parameters
+        ----------
+        radius : numeric
+            Search radius, in units of the station CRS.
+
+        Returns
+        -------
+        neighbors : scipy.sparse.csr_matrix
+            Boolean adjacency matrix, where the column indices of the row of a station
+            are the positions (in `station_ids`) of its neighbours, excluding itself.
 
-# def get_mislocated_stations(station_gser: gpd.GeoSeries) -> pd.Series:
-#     """Get mislocated stations.
+        """
+        try:
+            return self._neighbors_dict[radius]
+        except KeyError:
+            pairs = self.tree.query_pairs(radius, output_type="ndarray")
+            n_stations = len(self.station_ids)
+            # symmetrize the (i < j) pairs
+            neighbors = sparse.csr_matrix(
+                (
+                    np.ones(2 * len(pairs), dtype=bool),
+                    (
+                        np.concatenate([pairs[:, 0], pairs[:, 1]]),
+                        np.concatenate([pairs[:, 1], pairs[:, 0]]),
+                    ),
+                ),
+                shape=(n_stations, n_stations),
+            )
+            neighbors.sort_indices()
+            self._neighbors_dict[radius] = neighbors
+            return neighbors
 
-#     When multiple stations share the same location, it is likely due to an incorrect
-#     set up that led to automatic location assignment based on the IP address of the
-#     wireless network.
 
-#     Parameters
-#     ----------
-#     station_gser : geopandas.GeoSeries
-#         Geoseries of station locations (points).
+@profile_utils.profiled
+def get_mislocated_stations(station_gser: gpd.GeoSeries | StationIndex) -> pd.Series:
+    """Get mislocated stations.
 
-#     Returns
-#     -------
-#     mislocated_stations : pandas.Series
-#         Boolean series indicating whether a station (index) is mislocated (indicated
-#         by a value of `True`).
-#     """
-#     return station_gser.duplicated(keep=False)
+    When multiple stations share the same location, it is likely due to an incorrect
+    set up that led to automatic location assignment based on the IP address of the
+    wireless network.
 
+    Parameters
+    ----------
+    station_gser : geopandas.GeoSeries or StationIndex
+        Geoseries of station locations (points), or its spatial index.
+
+    Returns
+    -------
+    mislocated_stations : pandas.Series
+        Boolean series indicating whether a station (index) is mislocated (indicated
+        by a value of `True`).
+
+    """
+    if not isinstance(station_gser, StationIndex):
+        station_gser = StationIndex(station_gser)
+    # stations with at least one other station at a zero distance
+    return pd.Series(
+        np.diff(station_gser.get_neighbors(0).indptr) > 0,
+        index=station_gser.station_ids,
+    )
 
+
+@profile_utils.profiled
 def elevation_adjustment(
-    ts_df: pd.DataFrame,
+    ts_df: pd.DataFrame | ts_utils.CompactTSArray,
     station_elevation_ser: pd.Series,
     atmospheric_lapse_rate: float | None = None,
-) -> pd.DataFrame:
+) -> pd.DataFrame | ts_utils.CompactTSArray:
     """Adjust temperature measurements based on station elevation.
 
     Parameters
     ----------
-    ts_df : pandas.DataFrame
+    ts_df : pandas.DataFrame or ts_utils.CompactTSArray
         Time series of measurements (rows) for each station (columns).
     station_elevation_ser : pandas.Series, optional
         Series of station elevations, indexed by the station id. If provided, the
@@ -53,24 +152,318 @@ def elevation_adjustment(
 
     Returns
     -------
-    adjusted_ts_df : pandas.DataFrame
-        Time series of adjusted measurements (rows) for each station (columns).
+    adjusted_ts_df : pandas.DataFrame or ts_utils.CompactTSArray
+        Time series of adjusted measurements (rows) for each station (columns), of the
+        same type as `ts_df`.
 
     """
     if atmospheric_lapse_rate is None:
         atmospheric_lapse_rate = settings.ATMOSPHERIC_LAPSE_RATE
     station_elevation_ser = station_elevation_ser[ts_df.columns]
-    return ts_df + atmospheric_lapse_rate * (
+    offset_ser = atmospheric_lapse_rate * (
         station_elevation_ser - station_elevation_ser.mean()
     )
+    if isinstance(ts_df, ts_utils.CompactTSArray):
+        adjusted_ts_df = ts_df.copy()
+        offsets = offset_ser.to_numpy()
+        for start in range(0, len(ts_df), settings.QC_CHUNKSIZE):
+            adjusted_ts_df.set_arr(
+                adjusted_ts_df.get_arr(start, start + settings.QC_CHUNKSIZE) + offsets,
+                start,
+            )
+        return adjusted_ts_df
+    return ts_df + offset_ser
+
+
+def _search_pairwise_diffs(
+    sorted_arr: np.ndarray,
+    keys: np.ndarray,
+    low: np.ndarray,
+    high: np.ndarray,
+    t: np.ndarray,
+) -> np.ndarray:
+    """Find, for each value, the end of the values that exceed it by at most `t`.
+
+    For each row `r` and column `i` of the row-sorted `sorted_arr`, get the first
+    column `j` within `[low, high)` such that `sorted_arr[r, j] - sorted_arr[r, i] >
+    t[r]` (or `high` if there is none), comparing the differences as computed in
+    floating point so that the counts are exact. The columns are first located
+    approximately, with a single search of all the values in `keys`, and only the few
+    that rounding may have misplaced are then searched exactly within their bounds.
+    """
+    num_cols = sorted_arr.shape[1]
+    flat_arr = sorted_arr.ravel()
+    end_arr = low.copy().ravel()
+    flat = np.flatnonzero(low < high)
+    base = flat - flat % num_cols
+    start_values = flat_arr[flat]
+    low = low.ravel()[flat]
+    high = high.ravel()[flat]
+    t = t[flat // num_cols]
 
+    def compress(keep):
+        return (
+            flat[keep],
+            base[keep],
+            start_values[keep],
+            low[keep],
+            high[keep],
+            t[keep],
+        )
+
+    approx = np.clip(
+        np.searchsorted(keys, keys[flat] + t, side="right") - base, low, high
+    )
+    exact = (
+        (approx == low)
+        | (flat_arr[base + np.maximum(approx - 1, 0)] - start_values <= t)
+    ) & (
+        (approx == high)
+        | (flat_arr[base + np.minimum(approx, num_cols - 1)] - start_values > t)
+    )
+    end_arr[flat[exact]] = approx[exact]
+    flat, base, start_values, low, high, t = compress(~exact)
+    # binary search of the misplaced ones
+    while flat.size:
+        mid = (low + high) // 2
+        cond = flat_arr[base + mid] - start_values <= t
+        low = np.where(cond, mid + 1, low)
+        high = np.where(cond, high, mid)
+        done = low >= high
+        end_arr[flat[done]] = low[done]
+        flat, base, start_values, low, high, t = compress(~done)
+    return end_arr.reshape(sorted_arr.shape)
+
+
+def _select_pairwise_diffs(sorted_arr: np.ndarray, k: int) -> np.ndarray:
+    """Select the k-th smallest pairwise difference of each row of a sorted array.
+
+    The candidate differences of each row are bounded by the range of columns `j` of
+    each value `i`, which is narrowed by counting (with `_search_pairwise_diffs`) the
+    differences below pivots interpolated at the rank `k` between the smallest and
+    largest candidates. Once few candidates are left (or they are all equal), they are
+    enumerated and the k-th smallest is selected. Since the pivots are applied to all
+    the rows at once, there is no Python call per row.
+
+    Parameters
+    ----------
+    sorted_arr : numpy.ndarray
+        Two-dimensional array without NaNs, sorted along its rows.
+    k : int
+        Rank (starting at one) of the difference to select.
+
+    Returns
+    -------
+    diff_arr : numpy.ndarray
+        One-dimensional array with the k-th smallest pairwise difference of each row.
+
+    """
+    num_rows, num_cols = sorted_arr.shape
+    cols = np.arange(num_cols)
+    # candidates of value `i` are the values `j` within [low_arr[:, i], high_arr[:, i])
+    # and `low_counts` are the numbers of differences below the candidates
+    low_arr = np.broadcast_to(cols + 1, sorted_arr.shape).copy()
+    high_arr = np.full(sorted_arr.shape, num_cols)
+    low_counts = np.zeros(num_rows, dtype=np.int64)
+    diff_arr = np.empty(num_rows)
+    rows = np.arange(num_rows)
+    while rows.size:
+        num_candidates = (high_arr - low_arr).sum(axis=1)
+        has_candidates = low_arr < high_arr
+        min_diffs = np.where(
+            has_candidates,
+            np.take_along_axis(sorted_arr, np.minimum(low_arr, num_cols - 1), 1)
+            - sorted_arr,
+            np.inf,
+        ).min(axis=1)
+        max_diffs = np.where(
+            has_candidates,
+            np.take_along_axis(sorted_arr, np.maximum(high_arr - 1, 0), 1) - sorted_arr,
+            -np.inf,
+        ).max(axis=1)
+        is_tie = min_diffs == max_diffs
+        diff_arr[rows[is_tie]] = min_diffs[is_tie]
+        is_few = (num_candidates <= num_cols) & ~is_tie
+        if is_few.any():
+            # enumerate the candidates of each row and sort them by row and value
+            few_rows = np.flatnonzero(is_few)
+            widths = (high_arr[few_rows] - low_arr[few_rows]).ravel()
+            candidate_rows = np.repeat(np.repeat(few_rows, num_cols), widths)
+            candidate_starts = np.repeat(np.tile(cols, len(few_rows)), widths)
+            candidate_ends = np.repeat(low_arr[few_rows].ravel(), widths) + (
+                np.arange(widths.sum()) - np.repeat(np.cumsum(widths) - widths, widths)
+            )
+            candidate_diffs = (
+                sorted_arr[candidate_rows, candidate_ends]
+                - sorted_arr[candidate_rows, candidate_starts]
+            )
+            candidate_diffs = candidate_diffs[
+                np.lexsort((candidate_diffs, candidate_rows))
+            ]
+            row_starts = np.cumsum(num_candidates[few_rows]) - num_candidates[few_rows]
+            diff_arr[rows[few_rows]] = candidate_diffs[
+                row_starts + k - low_counts[few_rows] - 1
+            ]
+        keep = ~(is_tie | is_few)
+        rows, sorted_arr = rows[keep], sorted_arr[keep]
+        low_arr, high_arr, low_counts = low_arr[keep], high_arr[keep], low_counts[keep]
+        if not rows.size:
+            break
+        min_diffs, max_diffs = min_diffs[keep], max_diffs[keep]
+        num_candidates = num_candidates[keep]
+        # the values of all the rows are searched at once, separated by offsets larger
+        # than the range of the rows
+        range_arr = sorted_arr - sorted_arr[:, :1]
+        keys = (
+            range_arr + (np.arange(len(rows)) * (range_arr[:, -1].max() + 1))[:, None]
+        ).ravel()
+        # pivots around the interpolated rank of the k-th difference, so that at most
+        # about `num_cols` candidates are left between them. Pivots are always within
+        # [min_diffs, max_diffs), so that each one removes some candidates.
+        frac = (k - low_counts) / num_candidates
+        delta = num_cols / (4 * num_candidates)
+        for pivot_frac in [frac - delta, frac + delta]:
+            pivots = np.maximum(
+                np.minimum(
+                    min_diffs + np.clip(pivot_frac, 0, 1) * (max_diffs - min_diffs),
+                    np.nextafter(max_diffs, -np.inf),
+                ),
+                min_diffs,
+            )
+            end_arr = _search_pairwise_diffs(
+                sorted_arr, keys, low_arr, high_arr, pivots
+            )
+            counts = low_counts + (end_arr - low_arr).sum(axis=1)
+            is_above = counts >= k
+            high_arr[is_above] = end_arr[is_above]
+            low_arr[~is_above] = end_arr[~is_above]
+            low_counts[~is_above] = counts[~is_above]
+    return diff_arr
+
+
+def _nanqn_scale(arr: np.ndarray) -> np.ndarray:
+    """Compute the Qn scale of each row of a 2-D array, ignoring NaNs.
+
+    Rows are grouped by their number of valid (non-NaN) values so that the Qn scale
+    of all the rows of each group can be computed at once. Short rows are processed by
+    selecting the k-th order statistic of all their pairwise differences, long rows
+    with `_select_pairwise_diffs`, both leading to the exact same values as
+    `statsmodels.robust.scale.qn_scale`.
+
+    Parameters
+    ----------
+    arr : numpy.ndarray
+        Two-dimensional array of measurements, with timestamps as rows.
+
+    Returns
+    -------
+    qn_arr : numpy.ndarray
+        One-dimensional array with the Qn scale of each row, NaN for rows with less
+        than two valid values.
+
+    """
+    # NaNs are sorted to the end of each row so that the first `count` values of a row
+    # with `count` valid values are exactly its valid values
+    sorted_arr = np.sort(arr, axis=1)
+    counts = (~np.isnan(arr)).sum(axis=1)
+    qn_arr = np.full(len(arr), np.nan)
+    for count in np.unique(counts[counts > 1]):
+        rows = counts == count
+        h = count // 2 + 1
+        k = h * (h - 1) // 2
+        if count <= _QN_PAIRWISE_MAX_COUNT:
+            # since rows are sorted, the differences are already non-negative
+            i, j = np.triu_indices(count, k=1)
+            group_arr = sorted_arr[rows, :count]
+            qn_arr[rows] = (
+                _QN_C
+                * np.partition(group_arr[:, j] - group_arr[:, i], k - 1, axis=1)[
+                    :, k - 1
+                ]
+            )
+        else:
+            qn_arr[rows] = _QN_C * _select_pairwise_diffs(sorted_arr[rows, :count], k)
+    return qn_arr
+
+
+def _iter_chunk_arrs(
+    ts_df: pd.DataFrame | ts_utils.CompactTSArray | np.ndarray,
+    chunksize: int,
+    *,
+    copy: bool = False,
+) -> Iterable[np.ndarray]:
+    """Iterate over float64 arrays of consecutive chunks of timestamps (rows).
 
+    Data frames and arrays are converted to an array at once (no copy if they already
+    are of float64 dtype) and then sliced, whereas compact time series arrays are
+    decoded one chunk at a time. If `copy` is True, the chunks never share memory
+    with `ts_df`, so that they can be modified in place.
+
+    """
+    if isinstance(ts_df, ts_utils.CompactTSArray):
+        for start in range(0, len(ts_df), chunksize):
+            yield ts_df.get_arr(start, start + chunksize)
+    else:
+        if isinstance(ts_df, pd.DataFrame):
+            ts_df = ts_df.to_numpy()
+        for start in range(0, len(ts_df), chunksize):
+            yield ts_df[start : start + chunksize].astype(float, copy=copy)
+
+
+def _get_row_medians(chunk_arr: np.ndarray) -> np.ndarray:
+    """Get the median of each row (timestamp), ignoring NaNs."""
+    with warnings.catch_warnings():
+        # ignore all-NaN timestamps, their median is NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmedian(chunk_arr, axis=1)
+
+
+def _count_chunk_outliers(
+    chunk_arr: np.ndarray,
+    nonnan_arr: np.ndarray,
+    median_arr: np.ndarray,
+    low_z: float,
+    high_z: float,
+) -> np.ndarray:
+    """Count the outlier measurements of each station (column) in a chunk."""
+    with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+        # ignore all-NaN timestamps, they do not contribute to the outlier counts
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        z_arr = (chunk_arr - median_arr[:, np.newaxis]) / _nanqn_scale(chunk_arr)[
+            :, np.newaxis
+        ]
+    # note that NaN z-scores (e.g., zero Qn scale) are considered outliers
+    return (~((z_arr > low_z) & (z_arr < high_z)) & nonnan_arr).sum(axis=0)
+
+
+def _get_outlier_counts(
+    ts_df: pd.DataFrame | ts_utils.CompactTSArray | np.ndarray,
+    low_alpha: float,
+    high_alpha: float,
+    chunksize: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Count the outlier and the non-NaN measurements of each station (column)."""
+    low_z = norm.ppf(low_alpha)
+    high_z = norm.ppf(high_alpha)
+    outlier_counts = np.zeros(ts_df.shape[1], dtype=int)
+    nonnan_counts = np.zeros(ts_df.shape[1], dtype=int)
+    for chunk_arr in _iter_chunk_arrs(ts_df, chunksize):
+        nonnan_arr = ~np.isnan(chunk_arr)
+        outlier_counts += _count_chunk_outliers(
+            chunk_arr, nonnan_arr, _get_row_medians(chunk_arr), low_z, high_z
+        )
+        nonnan_counts += nonnan_arr.sum(axis=0)
+    return outlier_counts, nonnan_counts
+
+
+@profile_utils.profiled
 def get_outlier_stations(
-    ts_df: pd.DataFrame,
+    ts_df: pd.DataFrame | ts_utils.CompactTSArray,
     *,
     low_alpha: float | None = None,
     high_alpha: float | None = None,
     station_outlier_threshold: float | None = None,
+    chunksize: int | None = None,
 ) -> pd.Series:
     """Get outlier stations.
 
@@ -81,7 +474,7 @@ def get_outlier_stations(
 
     Parameters
     ----------
-    ts_df : pandas.DataFrame
+    ts_df : pandas.DataFrame or ts_utils.CompactTSArray
         Time series of measurements (rows) for each station (columns).
     low_alpha, high_alpha : numeric, optional
         Values for the lower and upper tail respectively (in proportion from 0 to 1)
@@ -93,6 +486,10 @@ def get_outlier_stations(
         Maximum proportion (from 0 to 1) of outlier measurements after which the
         respective station may be flagged as faulty. If None, the value from
         `settings.STATION_OUTLIER_THRESHOLD` is used.
+    chunksize : int, optional
+        Number of timestamps (rows) processed at once, which bounds the memory used by
+        the intermediate z-score arrays. If None, the value from
+        `settings.QC_CHUNKSIZE` is used.
 
     Returns
     -------
@@ -101,33 +498,147 @@ def get_outlier_stations(
         (indicated by a value of `True`).
 
     """
-
-    def z_score(x):
-        return (x - x.median()) / scale.qn_scale(x.dropna())
-
     if low_alpha is None:
         low_alpha = settings.OUTLIER_LOW_ALPHA
     if high_alpha is None:
         high_alpha = settings.OUTLIER_HIGH_ALPHA
     if station_outlier_threshold is None:
         station_outlier_threshold = settings.STATION_OUTLIER_THRESHOLD
+    if chunksize is None:
+        chunksize = settings.QC_CHUNKSIZE
 
-    nonnan_df = ~ts_df.isna()
-    low_z = norm.ppf(low_alpha)
-    high_z = norm.ppf(high_alpha)
-    outlier_df = (
-        ~ts_df.apply(z_score, axis="columns").apply(
-            lambda z: z.between(low_z, high_z, inclusive="neither"), axis="columns"
-        )
-        & nonnan_df
+    outlier_counts, nonnan_counts = _get_outlier_counts(
+        ts_df, low_alpha, high_alpha, chunksize
+    )
+    prop_outlier_ser = pd.Series(outlier_counts, index=ts_df.columns) / pd.Series(
+        nonnan_counts, index=ts_df.columns
     )
-    prop_outlier_ser = outlier_df.sum() / nonnan_df.sum()
 
     return prop_outlier_ser > station_outlier_threshold
 
 
+def _get_chunk_median_comoments(
+    chunk_arr: np.ndarray, median_arr: np.ndarray
+) -> np.ndarray:
+    """Get the co-moments of each station (column) with the spatial median in a chunk.
+
+    Parameters
+    ----------
+    chunk_arr : numpy.ndarray
+        Two-dimensional array of measurements, with timestamps as rows.
+    median_arr : numpy.ndarray
+        One-dimensional array with the median of each row of `chunk_arr`.
+
+    Returns
+    -------
+    comoments : numpy.ndarray
+        Array with the rows of `_median_comoment_names`, i.e., the number of valid
+        pairs, the means of the station and the median, the sums of squared deviations
+        of the station and the median and the sum of the products of the deviations,
+        and one column per station.
+
+    """
+    valid_arr = ~np.isnan(chunk_arr) & ~np.isnan(median_arr)[:, np.newaxis]
+    counts = valid_arr.sum(axis=0)
+    _counts = np.where(counts > 0, counts, 1)
+    # deviations from the means over the valid pairs (zero elsewhere), computed in place
+    # to bound the number of chunk-sized temporary arrays
+    x_arr = np.where(valid_arr, chunk_arr, 0)
+    means = x_arr.sum(axis=0) / _counts
+    median_arr = np.where(np.isnan(median_arr), 0, median_arr)
+    median_means = median_arr @ valid_arr / _counts
+    x_arr -= means
+    x_arr[~valid_arr] = 0
+    m_arr = median_arr[:, np.newaxis] - median_means
+    m_arr[~valid_arr] = 0
+    return np.array(
+        [
+            counts,
+            means,
+            median_means,
+            np.einsum("ij,ij->j", x_arr, x_arr),
+            np.einsum("ij,ij->j", m_arr, m_arr),
+            np.einsum("ij,ij->j", x_arr, m_arr),
+        ]
+    )
+
+
+def _get_median_comoments(
+    ts_df: pd.DataFrame | ts_utils.CompactTSArray | np.ndarray, chunksize: int
+) -> np.ndarray:
+    """Get the co-moments of each station (column) with the spatial median.
+
+    The co-moments are computed over the timestamps (rows) where both the station and
+    the median are valid, in chunks of `chunksize` timestamps that are merged into the
+    running co-moments, so that the whole array is traversed only once.
+
+    Parameters
+    ----------
+    ts_df : pandas.DataFrame, ts_utils.CompactTSArray or numpy.ndarray
+        Time series of measurements (rows) for each station (columns).
+    chunksize : int
+        Number of timestamps (rows) processed at once.
+
+    Returns
+    -------
+    comoments : numpy.ndarray
+        Array with the rows of `_median_comoment_names` and one column per station.
+
+    """
+    comoments = np.zeros((len(_median_comoment_names), ts_df.shape[1]))
+    # accumulate in double precision regardless of the input precision
+    for chunk_arr in _iter_chunk_arrs(ts_df, chunksize):
+        comoments = _merge_median_comoments(
+            comoments,
+            _get_chunk_median_comoments(chunk_arr, _get_row_medians(chunk_arr)),
+        )
+    return comoments
+
+
+def _merge_median_comoments(
+    comoments_a: np.ndarray, comoments_b: np.ndarray
+) -> np.ndarray:
+    """Merge two sets of co-moments with the spatial median (see above)."""
+    # pairwise update of Chan et al. (1979), which is numerically stable
+    count_a, mean_a, median_mean_a, m2_a, median_m2_a, comoment_a = comoments_a
+    count_b, mean_b, median_mean_b, m2_b, median_m2_b, comoment_b = comoments_b
+    count = count_a + count_b
+    # avoid division by zero for stations without valid pairs so far (their
+    # co-moments are all zero)
+    _count = np.where(count > 0, count, 1)
+    weight = count_a * count_b / _count
+    delta = mean_b - mean_a
+    median_delta = median_mean_b - median_mean_a
+    return np.array(
+        [
+            count,
+            mean_a + delta * count_b / _count,
+            median_mean_a + median_delta * count_b / _count,
+            m2_a + m2_b + delta**2 * weight,
+            median_m2_a + median_m2_b + median_delta**2 * weight,
+            comoment_a + comoment_b + delta * median_delta * weight,
+        ]
+    )
+
+
+def _get_median_corrs(comoments: np.ndarray) -> np.ndarray:
+    """Get the Pearson correlations from the co-moments with the spatial median."""
+    count, _, _, m2, median_m2, comoment = comoments
+    with np.errstate(divide="ignore", invalid="ignore"):
+        corrs = comoment / np.sqrt(m2 * median_m2)
+    # as in `pandas.DataFrame.corrwith`, correlations of less than two valid pairs are
+    # NaN (and thus not flagged)
+    return np.where(count > 1, corrs, np.nan)
+
+
+@profile_utils.profiled
 def get_indoor_stations(
-    ts_df: pd.DataFrame, *, station_indoor_corr_threshold: float | None = None
+    ts_df: pd.DataFrame
+    | ts_utils.CompactTSArray
+    | Iterable[pd.DataFrame | ts_utils.CompactTSArray],
+    *,
+    station_indoor_corr_threshold: float | None = None,
+    chunksize: int | None = None,
 ) -> pd.Series:
     """Get indoor stations.
 
@@ -136,12 +647,19 @@ def get_indoor_stations(
 
     Parameters
     ----------
-    ts_df : pandas.DataFrame
-        Time series of measurements (rows) for each station (columns).
+    ts_df : pandas.DataFrame, ts_utils.CompactTSArray or iterable of them
+        Time series of measurements (rows) for each station (columns). It can also be
+        an iterable of consecutive time blocks of such data frames (e.g., read one
+        month at a time), which are consumed one at a time so that the whole time
+        series never needs to be in memory.
     station_indoor_corr_threshold : numeric, optonal
         Stations showing Pearson correlations (with the overall station median
         distribution) lower than this threshold are likely set up indoors. If None,
         the value from `settings.STATION_INDOOR_CORR_THRESHOLD` is used.
+    chunksize : int, optional
+        Number of timestamps (rows) processed at once, which bounds the memory used by
+        the intermediate arrays. If None, the value from `settings.QC_CHUNKSIZE` is
+        used.
 
     Returns
     -------
@@ -152,21 +670,49 @@ def get_indoor_stations(
     """
     if station_indoor_corr_threshold is None:
         station_indoor_corr_threshold = settings.STATION_INDOOR_CORR_THRESHOLD
+    if chunksize is None:
+        chunksize = settings.QC_CHUNKSIZE
+    if isinstance(ts_df, pd.DataFrame | ts_utils.CompactTSArray):
+        ts_df = [ts_df]
 
-    return ts_df.corrwith(ts_df.median(axis="columns")) < station_indoor_corr_threshold
+    stations = None
+    for block_df in ts_df:
+        if stations is None:
+            stations = block_df.columns
+            comoments = np.zeros((len(_median_comoment_names), len(stations)))
+        # stations that appear in a later block have no valid pairs before
+        new_stations = block_df.columns.difference(stations, sort=False)
+        if len(new_stations) > 0:
+            stations = stations.append(new_stations)
+            comoments = np.hstack(
+                [comoments, np.zeros((len(_median_comoment_names), len(new_stations)))]
+            )
+        block_comoments = _get_median_comoments(block_df, chunksize)
+        block_stations = stations.get_indexer(block_df.columns)
+        comoments[:, block_stations] = _merge_median_comoments(
+            comoments[:, block_stations], block_comoments
+        )
+
+    return (
+        pd.Series(_get_median_corrs(comoments), index=stations)
+        < station_indoor_corr_threshold
+    )
 
 
 # function to filter stations depending on the proportion of available valid
 # measurements
 # def get_valid_stations(ts_df, min_nonna_prop):
+@profile_utils.profiled
 def get_unreliable_stations(
-    ts_df: pd.DataFrame, *, unreliable_threshold: float | None = None
+    ts_df: pd.DataFrame | ts_utils.CompactTSArray,
+    *,
+    unreliable_threshold: float | None = None,
 ) -> pd.Series:
     """Get stations with a high proportion of non-valid measurements.
 
     Parameters
     ----------
-    ts_df : pandas.DataFrame
+    ts_df : pandas.DataFrame or ts_utils.CompactTSArray
         Time series of measurements (rows) for each station (columns).
     unreliable_threshold : numeric, optional
         Proportion of non-valid measurements after which a station is considered
@@ -182,7 +728,526 @@ def get_unreliable_stations(
     if unreliable_threshold is None:
         unreliable_threshold = settings.UNRELIABLE_THRESHOLD
 
-    return ts_df.isna().sum() / len(ts_df.index) > unreliable_threshold
+    return (len(ts_df.index) - ts_df.count()) / len(ts_df.index) > unreliable_threshold
+
+
+@profile_utils.profiled
+def get_buddy_check_stations(
+    ts_df: pd.DataFrame,
+    station_gser: gpd.GeoSeries | StationIndex,
+    *,
+    radius: float | None = None,
+    min_neighbors: int | None = None,
+    buddy_z_threshold: float | None = None,
+    buddy_min_scale: float | None = None,
+    station_buddy_threshold: float | None = None,
+    chunksize: int | None = None,
+) -> pd.Series:
+    """Get stations that often deviate from their neighbours (buddy check).
+
+    Each measurement is compared against the measurements of the neighbouring stations
+    (within `radius`) at the same timestamp with a robust z-score, i.e., its deviation
+    from the neighbours' median divided by the neighbours' median absolute deviation
+    (scaled to be consistent with the standard deviation at the normal distribution).
+    Stations with a high proportion of measurements that deviate from their neighbours
+    are likely affected by local measurement errors.
+
+    Parameters
+    ----------
+    ts_df : pandas.DataFrame
+        Time series of measurements (rows) for each station (columns).
+    station_gser : geopandas.GeoSeries or StationIndex
+        Geoseries of station locations (points) in a projected CRS, or its spatial
+        index, which can be reused across calls. Must include all the stations of
+        `ts_df`.
+    radius : numeric, optional
+        Radius (in units of the station CRS) within which stations are considered
+        neighbours. If None, the value from `settings.BUDDY_RADIUS` is used.
+    min_neighbors : int, optional
+        Minimum number of neighbours with valid measurements required to check a
+        measurement. If None, the value from `settings.BUDDY_MIN_NEIGHBORS` is used.
+    buddy_z_threshold : numeric, optional
+        Measurements with an absolute robust z-score above this threshold are flagged.
+        If None, the value from `settings.BUDDY_Z_THRESHOLD` is used.
+    buddy_min_scale : numeric, optional
+        Lower bound of the neighbours' scale (in unit of `ts_df`), which avoids
+        flagging small deviations when the neighbours agree closely. If None, the
+        value from `settings.BUDDY_MIN_SCALE` is used.
+    station_buddy_threshold : numeric, optional
+        Maximum proportion (from 0 to 1) of flagged measurements after which the
+        respective station may be considered faulty. If None, the value from
+        `settings.STATION_BUDDY_THRESHOLD` is used.
+    chunksize : int, optional
+        Number of timestamps (rows) processed at once. If None, the value from
+        `settings.QC_CHUNKSIZE` is used.
+
+    Returns
+    -------
+    buddy_stations : pandas.Series
+        Boolean series indicating whether a station (index) fails the buddy check
+        (indicated by a value of `True`).
+
+    """
+    if radius is None:
+        radius = settings.BUDDY_RADIUS
+    if min_neighbors is None:
+        min_neighbors = settings.BUDDY_MIN_NEIGHBORS
+    if buddy_z_threshold is None:
+        buddy_z_threshold = settings.BUDDY_Z_THRESHOLD
+    if buddy_min_scale is None:
+        buddy_min_scale = settings.BUDDY_MIN_SCALE
+    if station_buddy_threshold is None:
+        station_buddy_threshold = settings.STATION_BUDDY_THRESHOLD
+    if chunksize is None:
+        chunksize = settings.QC_CHUNKSIZE
+    if not isinstance(station_gser, StationIndex):
+        station_gser = StationIndex(station_gser)
+
+    # align the measurements with the spatial index (stations of the index without
+    # measurements are NaN) and keep only the stations of `ts_df`
+    ts_arr = ts_df.reindex(columns=station_gser.station_ids).to_numpy(dtype=float)
+    neighbors = station_gser.get_neighbors(radius)
+    stations = station_gser.station_ids.get_indexer(ts_df.columns)
+    degrees = np.diff(neighbors.indptr)[stations]
+
+    flagged_counts = np.zeros(len(stations), dtype=int)
+    for degree in np.unique(degrees[degrees >= min_neighbors]):
+        # all the stations with the same number of neighbours are processed at once,
+        # in batches that bound the size of the (timestamp, station, neighbour) arrays
+        group = np.flatnonzero(degrees == degree)
+        batch_size = max(1, _BUDDY_BATCH_SIZE // degree)
+        for batch in np.array_split(group, np.ceil(len(group) / batch_size)):
+            neighbor_idx = neighbors.indices[
+                neighbors.indptr[stations[batch]][:, np.newaxis] + np.arange(degree)
+            ]
+            for start in range(0, len(ts_arr), chunksize):
+                chunk_arr = ts_arr[start : start + chunksize]
+                neighbor_arr = chunk_arr[:, neighbor_idx]
+                with warnings.catch_warnings(), np.errstate(invalid="ignore"):
+                    # ignore timestamps where all the neighbours are NaN
+                    warnings.simplefilter("ignore", category=RuntimeWarning)
+                    median_arr = np.nanmedian(neighbor_arr, axis=2)
+                    scale_arr = _MAD_C * np.nanmedian(
+                        np.abs(neighbor_arr - median_arr[:, :, np.newaxis]), axis=2
+                    )
+                    z_arr = (chunk_arr[:, stations[batch]] - median_arr) / np.maximum(
+                        scale_arr, buddy_min_scale
+                    )
+                checked_arr = (~np.isnan(neighbor_arr)).sum(axis=2) >= min_neighbors
+                # NaN measurements have NaN z-scores and are thus not flagged
+                flagged_counts[batch] += (
+                    (np.abs(z_arr) > buddy_z_threshold) & checked_arr
+                ).sum(axis=0)
+
+    return (
+        pd.Series(flagged_counts, index=ts_df.columns) / ts_df.notna().sum()
+        > station_buddy_threshold
+    )
+
+
+@profile_utils.profiled
+def run_qc(
+    ts_df: pd.DataFrame | ts_utils.CompactTSArray,
+    *,
+    station_elevation_ser: pd.Series | None = None,
+    atmospheric_lapse_rate: float | None = None,
+    low_alpha: float | None = None,
+    high_alpha: float | None = None,
+    station_outlier_threshold: float | None = None,
+    station_indoor_corr_threshold: float | None = None,
+    unreliable_threshold: float | None = None,
+    chunksize: int | None = None,
+) -> tuple[pd.DataFrame, pd.Series]:
+    """Run all the QC filters at once.
+
+    The measurements are processed in chunks of timestamps, each of which is converted
+    to an array only once and adjusted for the elevation in place. The NaN mask and the
+    row medians of each chunk are shared between the filters. The flags are the same
+    as those obtained by calling `elevation_adjustment`, `get_outlier_stations`,
+    `get_indoor_stations` and `get_unreliable_stations` separately.
+
+    Parameters
+    ----------
+    ts_df : pandas.DataFrame or ts_utils.CompactTSArray
+        Time series of measurements (rows) for each station (columns).
+    station_elevation_ser : pandas.Series, optional
+        Series of station elevations, indexed by the station id. If provided, the
+        measurements are adjusted to account for the elevation effect before the QC.
+    atmospheric_lapse_rate : numeric, optional
+        Atmospheric lapse rate to account for the elevation effect. If None, the value
+        from `settings.ATMOSPHERIC_LAPSE_RATE` is used.
+    low_alpha, high_alpha, station_outlier_threshold : numeric, optional
+        Parameters of the outlier filter, see `get_outlier_stations`.
+    station_indoor_corr_threshold : numeric, optional
+        Parameter of the indoor filter, see `get_indoor_stations`.
+    unreliable_threshold : numeric, optional
+        Parameter of the unreliable filter, see `get_unreliable_stations`.
+    chunksize : int, optional
+        Number of timestamps (rows) processed at once. If None, the value from
+        `settings.QC_CHUNKSIZE` is used.
+
+    Returns
+    -------
+    qc_df : pandas.DataFrame
+        Boolean data frame with the stations as index and one column per filter
+        ("outlier", "indoor" and "unreliable") indicating whether the station is
+        flagged by the filter (indicated by a value of `True`).
+    timing_ser : pandas.Series
+        Time (in seconds) spent in each stage of the pipeline, i.e., the conversion to
+        an array and elevation adjustment, the row medians, the outlier and indoor
+        filters and the computation of the flags from the per-station statistics.
+
+    """
+    if atmospheric_lapse_rate is None:
+        atmospheric_lapse_rate = settings.ATMOSPHERIC_LAPSE_RATE
+    if low_alpha is None:
+        low_alpha = settings.OUTLIER_LOW_ALPHA
+    if high_alpha is None:
+        high_alpha = settings.OUTLIER_HIGH_ALPHA
+    if station_outlier_threshold is None:
+        station_outlier_threshold = settings.STATION_OUTLIER_THRESHOLD
+    if station_indoor_corr_threshold is None:
+        station_indoor_corr_threshold = settings.STATION_INDOOR_CORR_THRESHOLD
+    if unreliable_threshold is None:
+        unreliable_threshold = settings.UNRELIABLE_THRESHOLD
+    if chunksize is None:
+        chunksize = settings.QC_CHUNKSIZE
+    profile_utils.add_counts(stations=ts_df.shape[1], timestamps=ts_df.shape[0])
+
+    timing_dict = dict.fromkeys(
+        ["elevation_adjustment", "medians", "outlier", "indoor", "flags"], 0.0
+    )
+    if station_elevation_ser is not None:
+        station_elevation_ser = station_elevation_ser[ts_df.columns]
+        offsets = (
+            atmospheric_lapse_rate
+            * (station_elevation_ser - station_elevation_ser.mean())
+        ).to_numpy()
+
+    low_z = norm.ppf(low_alpha)
+    high_z = norm.ppf(high_alpha)
+    outlier_counts = np.zeros(ts_df.shape[1], dtype=int)
+    nonnan_counts = np.zeros(ts_df.shape[1], dtype=int)
+    comoments = np.zeros((len(_median_comoment_names), ts_df.shape[1]))
+    stage_time = time.perf_counter()
+    # the chunks are copies so that the elevation adjustment can be applied in place
+    for chunk_arr in _iter_chunk_arrs(ts_df, chunksize, copy=True):
+        if station_elevation_ser is not None:
+            chunk_arr += offsets
+        nonnan_arr = ~np.isnan(chunk_arr)
+        nonnan_counts += nonnan_arr.sum(axis=0)
+        timing_dict["elevation_adjustment"] += time.perf_counter() - stage_time
+        stage_time = time.perf_counter()
+        median_arr = _get_row_medians(chunk_arr)
+        timing_dict["medians"] += time.perf_counter() - stage_time
+        stage_time = time.perf_counter()
+        outlier_counts += _count_chunk_outliers(
+            chunk_arr, nonnan_arr, median_arr, low_z, high_z
+        )
+        timing_dict["outlier"] += time.perf_counter() - stage_time
+        stage_time = time.perf_counter()
+        comoments = _merge_median_comoments(
+            comoments, _get_chunk_median_comoments(chunk_arr, median_arr)
+        )
+        timing_dict["indoor"] += time.perf_counter() - stage_time
+        stage_time = time.perf_counter()
+
+    stage_time = time.perf_counter()
+    nonnan_counts = pd.Series(nonnan_counts, index=ts_df.columns)
+    qc_df = pd.DataFrame(
+        {
+            "outlier": pd.Series(outlier_counts, index=ts_df.columns) / nonnan_counts
+            > station_outlier_threshold,
+            "indoor": pd.Series(_get_median_corrs(comoments), index=ts_df.columns)
+            < station_indoor_corr_threshold,
+            "unreliable": (len(ts_df.index) - nonnan_counts) / len(ts_df.index)
+            > unreliable_threshold,
+        }
+    )
+    timing_dict["flags"] += time.perf_counter() - stage_time
+
+    return qc_df, pd.Series(timing_dict)
+
+
+class IncrementalQC:
+    """Incremental quality control of CWS data.
+
+    Keep per-station sufficient statistics (non-NaN and outlier counts, and the
+    co-moments with the spatial median time series) so that new time windows can be
+    folded in and the station flags updated without rescanning the previous
+    measurements. The flags are the same as those obtained by `get_outlier_stations`,
+    `get_indoor_stations` and `get_unreliable_stations` on all the (elevation-adjusted)
+    time windows concatenated.
+
+    Parameters
+    ----------
+    station_elevation_ser : pandas.Series, optional
+        Series of station elevations, indexed by the station id. If provided, the
+        measurements are adjusted to account for the elevation effect (see
+        `elevation_adjustment`). It must include the stations of all the time windows.
+    atmospheric_lapse_rate : numeric, optional
+        Atmospheric lapse rate to account for the elevation effect. If None, the value
+        from `settings.ATMOSPHERIC_LAPSE_RATE` is used.
+    low_alpha, high_alpha : numeric, optional
+        Values for the lower and upper tail respectively used to flag outlier
+        measurements (see `get_outlier_stations`). If None, the respective values from
+        `settings.OUTLIER_LOW_ALPHA` and `settings.OUTLIER_HIGH_ALPHA` are used.
+    chunksize : int, optional
+        Number of timestamps (rows) processed at once. If None, the value from
+        `settings.QC_CHUNKSIZE` is used.
+
+    """
+
+    _stat_names = ["nonnan_count", "outlier_count"] + _median_comoment_names
+
+    def __init__(
+        self,
+        station_elevation_ser: pd.Series | None = None,
+        *,
+        atmospheric_lapse_rate: float | None = None,
+        low_alpha: float | None = None,
+        high_alpha: float | None = None,
+        chunksize: int | None = None,
+    ):
+        """Initialize the incremental QC with empty statistics."""
+        if atmospheric_lapse_rate is None:
+            atmospheric_lapse_rate = settings.ATMOSPHERIC_LAPSE_RATE
+        if low_alpha is None:
+            low_alpha = settings.OUTLIER_LOW_ALPHA
+        if high_alpha is None:
+            high_alpha = settings.OUTLIER_HIGH_ALPHA
+        if chunksize is None:
+            chunksize = settings.QC_CHUNKSIZE
+        self.station_elevation_ser = station_elevation_ser
+        self.atmospheric_lapse_rate = atmospheric_lapse_rate
+        self.low_alpha = low_alpha
+        self.high_alpha = high_alpha
+        self.chunksize = chunksize
+
+        self.n_timestamps = 0
+        self.end_time = None
+        self.stats_df = pd.DataFrame(
+            {stat_name: pd.Series(dtype=float) for stat_name in self._stat_names}
+        )
+
+    def update(self, ts_df: pd.DataFrame) -> "IncrementalQC":
+        """Fold a new time window into the per-station statistics.
+
+        Parameters
+        ----------
+        ts_df : pandas.DataFrame
+            Time series of measurements (rows) for each station (columns). All the
+            timestamps must be later than the ones of the previous time windows.
+
+        Returns
+        -------
+        self : IncrementalQC
+            The updated incremental QC.
+
+        """
+        if self.end_time is not None and ts_df.index.min() <= self.end_time:
+            raise ValueError(
+                f"The time window must start after the last timestamp {self.end_time}."
+            )
+        ts_arr = ts_df.to_numpy(dtype=float)
+        if self.station_elevation_ser is not None:
+            # the elevation mean subtracted in `elevation_adjustment` shifts all the
+            # measurements by the same value, which affects neither the z-scores nor
+            # the correlations as long as it is the same for all the time windows, so
+            # it is omitted
+            ts_arr = ts_arr + self.atmospheric_lapse_rate * (
+                self.station_elevation_ser[ts_df.columns].to_numpy(dtype=float)
+            )
+
+        # outliers (they only depend on the measurements of each timestamp)
+        outlier_counts, nonnan_counts = _get_outlier_counts(
+            ts_arr, self.low_alpha, self.high_alpha, self.chunksize
+        )
+
+        window_stats_df = pd.DataFrame(
+            {
+                "nonnan_count": nonnan_counts,
+                "outlier_count": outlier_counts,
+                **dict(
+                    zip(
+                        _median_comoment_names,
+                        _get_median_comoments(ts_arr, self.chunksize),
+                    )
+                ),
+            },
+            index=ts_df.columns,
+        )
+        self.stats_df = self._merge_stats(
+            self.stats_df.reindex(self.stats_df.index.union(ts_df.columns, sort=False)),
+            window_stats_df,
+        )
+        self.n_timestamps += len(ts_df.index)
+        self.end_time = ts_df.index.max()
+
+        return self
+
+    @staticmethod
+    def _merge_stats(stats_df, window_stats_df):
+        window_stats_df = window_stats_df.reindex(stats_df.index).fillna(0)
+        stats_df = stats_df.fillna(0)
+        return pd.DataFrame(
+            {
+                "nonnan_count": stats_df["nonnan_count"]
+                + window_stats_df["nonnan_count"],
+                "outlier_count": stats_df["outlier_count"]
+                + window_stats_df["outlier_count"],
+                **dict(
+                    zip(
+                        _median_comoment_names,
+                        _merge_median_comoments(
+                            stats_df[_median_comoment_names].to_numpy().T,
+                            window_stats_df[_median_comoment_names].to_numpy().T,
+                        ),
+                    )
+                ),
+            },
+            index=stats_df.index,
+        )
+
+    def get_outlier_stations(
+        self, *, station_outlier_threshold: float | None = None
+    ) -> pd.Series:
+        """Get outlier stations.
+
+        Parameters
+        ----------
+        station_outlier_threshold : numeric, optonal
+            Maximum proportion (from 0 to 1) of outlier measurements after which the
+            respective station may be flagged as faulty. If None, the value from
+            `settings.STATION_OUTLIER_THRESHOLD` is used.
+
+        Returns
+        -------
+        outlier_stations : pandas.Series
+            Boolean series indicating whether a station (index) is considered an
+            outlier (indicated by a value of `True`).
+
+        """
+        if station_outlier_threshold is None:
+            station_outlier_threshold = settings.STATION_OUTLIER_THRESHOLD
+
+        return (
+            self.stats_df["outlier_count"] / self.stats_df["nonnan_count"]
+            > station_outlier_threshold
+        )
+
+    def get_indoor_stations(
+        self, *, station_indoor_corr_threshold: float | None = None
+    ) -> pd.Series:
+        """Get indoor stations.
+
+        Parameters
+        ----------
+        station_indoor_corr_threshold : numeric, optonal
+            Stations showing Pearson correlations (with the overall station median
+            distribution) lower than this threshold are likely set up indoors. If
+            None, the value from `settings.STATION_INDOOR_CORR_THRESHOLD` is used.
+
+        Returns
+        -------
+        indoor_stations : pandas.Series
+            Boolean series indicating whether a station (index) is likely set up
+            indoors (indicated by a value of `True`).
+
+        """
+        if station_indoor_corr_threshold is None:
+            station_indoor_corr_threshold = settings.STATION_INDOOR_CORR_THRESHOLD
+
+        return (
+            pd.Series(
+                _get_median_corrs(self.stats_df[_median_comoment_names].to_numpy().T),
+                index=self.stats_df.index,
+            )
+            < station_indoor_corr_threshold
+        )
+
+    def get_unreliable_stations(
+        self, *, unreliable_threshold: float | None = None
+    ) -> pd.Series:
+        """Get stations with a high proportion of non-valid measurements.
+
+        Parameters
+        ----------
+        unreliable_threshold : numeric, optional
+            Proportion of non-valid measurements after which a station is considered
+            unreliable. If None, the value from `settings.UNRELIABLE_THRESHOLD` is
+            used.
+
+        Returns
+        -------
+        unreliable_stations : pandas.Series
+            Boolean series indicating whether a station (index) is considered
+            unreliable (indicated by a value of `True`).
+
+        """
+        if unreliable_threshold is None:
+            unreliable_threshold = settings.UNRELIABLE_THRESHOLD
+
+        return (
+            self.n_timestamps - self.stats_df["nonnan_count"]
+        ) / self.n_timestamps > unreliable_threshold
+
+    def save(self, dst_filepath: str):
+        """Save the per-station statistics to a (NumPy `.npz`) file.
+
+        Parameters
+        ----------
+        dst_filepath : str
+            Path to the file to write.
+
+        """
+        # write to a temporary file first so that an interrupted run never leaves a
+        # partially written file behind
+        tmp_filepath = f"{dst_filepath}.tmp"
+        with open(tmp_filepath, "wb") as dst:
+            np.savez(
+                dst,
+                # use a list so that string ids are not stored as (pickled) objects
+                station_ids=np.array(list(self.stats_df.index)),
+                n_timestamps=self.n_timestamps,
+                end_time=np.datetime64(self.end_time, "ns"),
+                **{
+                    stat_name: self.stats_df[stat_name].to_numpy()
+                    for stat_name in self._stat_names
+                },
+            )
+        os.replace(tmp_filepath, dst_filepath)
+
+    @classmethod
+    def load(cls, src_filepath: str, **init_kws) -> "IncrementalQC":
+        """Load an incremental QC from a file written by `save`.
+
+        Parameters
+        ----------
+        src_filepath : str
+            Path to the file to read.
+        **init_kws
+            Keyword arguments to pass to the initialization method, e.g., the station
+            elevations. They must be the same as those used to compute the saved
+            statistics.
+
+        Returns
+        -------
+        incremental_qc : IncrementalQC
+            The incremental QC with the loaded statistics.
+
+        """
+        incremental_qc = cls(**init_kws)
+        with np.load(src_filepath) as npz:
+            incremental_qc.stats_df = pd.DataFrame(
+                {stat_name: npz[stat_name] for stat_name in cls._stat_names},
+                index=pd.Index(npz["station_ids"].tolist()),
+            )
+            incremental_qc.n_timestamps = int(npz["n_timestamps"])
+            end_time = pd.Timestamp(npz["end_time"][()])
+            if not pd.isna(end_time):
+                incremental_qc.end_time = end_time
+        return incremental_qc
 
 
 # plotting
@@ -0,0 +1,261 @@
+"""Distance raster utils."""
+import hashlib
+import os
+from os import path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import shapely
+from rasterio import features, transform, windows
+from scipy import ndimage
+
+from uhi_drivers_lausanne import grid_utils, profile_utils, settings
+
+
+def get_distance_arr(
+    feature_gser: gpd.GeoSeries,
+    bounds: tuple,
+    res: float,
+    *,
+    all_touched: bool = True,
+) -> tuple[np.ndarray, transform.Affine]:
+    """Get the Euclidean distance to the nearest feature of each pixel of a grid.
+
+    Features are rasterized onto the grid and the distance from each pixel center to
+    the nearest feature pixel is computed with a Euclidean distance transform. Pixels
+    covered by a feature have zero distance. The distance is thus exact up to the
+    resolution of the grid. Features outside the grid are ignored, so the bounds
+    should include a margin around the area of interest.
+
+    Parameters
+    ----------
+    feature_gser : geopandas.GeoSeries
+        Geometries of the features (e.g., lakes, parks, rivers or roads), in a
+        projected CRS.
+    bounds : tuple
+        Bounds of the grid (minx, miny, maxx, maxy), in the CRS of `feature_gser`.
+    res : numeric
+        Resolution of the grid, in the units of the CRS.
+    all_touched : bool, default True
+        Whether all the pixels touched by the features are considered feature pixels,
+        or only those whose center is within a feature. The former ensures that thin
+        features (e.g., lines) are not missed.
+
+    Returns
+    -------
+    distance_arr : numpy.ndarray
+        Distance to the nearest feature (in the units of the CRS) of each pixel.
+    distance_transform : affine.Affine
+        Transform of the grid.
+
+    """
+    distance_transform, out_shape = grid_utils.get_grid(bounds, res)
+    feature_mask = features.rasterize(
+        feature_gser.values[~shapely.is_empty(feature_gser.values)],
+        out_shape=out_shape,
+        transform=distance_transform,
+        fill=0,
+        default_value=1,
+        all_touched=all_touched,
+        dtype="uint8",
+    ).astype(bool)
+    if not feature_mask.any():
+        raise ValueError("No feature intersects the grid bounds.")
+    profile_utils.add_counts(pixels=feature_mask.size)
+    # the distance transform computes the distance to the nearest zero (i.e., feature)
+    # pixel
+    distance_arr = ndimage.distance_transform_edt(~feature_mask, sampling=res)
+    return distance_arr.astype("float32"), distance_transform
+
+
+def _get_cache_key(feature_gser, bounds, res, all_touched):
+    # key of the raster by the content of its inputs, so that changing the features,
+    # the extent or the resolution computes a new raster
+    digest = hashlib.sha256()
+    digest.update(str(feature_gser.crs).encode())
+    digest.update(repr((tuple(bounds), res, all_touched)).encode())
+    for wkb in shapely.to_wkb(feature_gser.values):
+        digest.update(wkb)
+    return digest.hexdigest()[:16]
+
+
+@profile_utils.profiled
+def get_distance_raster(
+    feature_gser: gpd.GeoSeries,
+    bounds: tuple,
+    *,
+    res: float | None = None,
+    name: str = "distance",
+    cache_dir: str | None = None,
+    all_touched: bool = True,
+) -> str:
+    """Get the path to a (cached) GeoTIFF of the distance to the nearest feature.
+
+    The raster is only computed (see `get_distance_arr`) if it is not in the cache
+    already, i.e., if no raster has been computed for the same features, bounds and
+    resolution. It can be used to look up the distance of stations (see
+    `sample_raster`) or of any point of the grid, e.g., to predict over the full
+    extent.
+
+    Parameters
+    ----------
+    feature_gser : geopandas.GeoSeries
+        Geometries of the features (e.g., lakes, parks, rivers or roads), in a
+        projected CRS.
+    bounds : tuple
+        Bounds of the grid (minx, miny, maxx, maxy), in the CRS of `feature_gser`.
+    res : numeric, optional
+        Resolution of the grid, in the units of the CRS. If None, the value from
+        `settings.DISTANCE_RES` is used.
+    name : str, default "distance"
+        Name of the feature layer, used as prefix of the raster file name.
+    cache_dir : str, optional
+        Directory where the rasters are cached. If None, the "distance" subdirectory
+        of `settings.ASSET_CACHE_DIR` is used.
+    all_touched : bool, default True
+        Whether all the pixels touched by the features are considered feature pixels,
+        see `get_distance_arr`.
+
+    Returns
+    -------
+    raster_filepath : str
+        Path to the distance raster.
+
+    """
+    if res is None:
+        res = settings.DISTANCE_RES
+    if cache_dir is None:
+        cache_dir = path.join(settings.ASSET_CACHE_DIR, "distance")
+
+    raster_filepath = path.join(
+        cache_dir,
+        f"{name}-{_get_cache_key(feature_gser, bounds, res, all_touched)}.tif",
+    )
+    if path.exists(raster_filepath):
+        return raster_filepath
+
+    distance_arr, distance_transform = get_distance_arr(
+        feature_gser, bounds, res, all_touched=all_touched
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so that an interrupted run never leaves a
+    # partially written raster in the cache
+    with rio.open(
+        f"{raster_filepath}.tmp",
+        "w",
+        driver="GTiff",
+        height=distance_arr.shape[0],
+        width=distance_arr.shape[1],
+        count=1,
+        dtype=distance_arr.dtype,
+        crs=feature_gser.crs,
+        transform=distance_transform,
+        tiled=True,
+        compress="deflate",
+        predictor=3,
+    ) as dst:
+        dst.write(distance_arr, 1)
+    os.replace(f"{raster_filepath}.tmp", raster_filepath)
+    return raster_filepath
+
+
+def sample_raster(raster_filepath: str, station_gser: gpd.GeoSeries) -> pd.Series:
+    """Look up the value of the raster pixel of each station.
+
+    Parameters
+    ----------
+    raster_filepath : str
+        Path to a single-band raster, e.g., as returned by `get_distance_raster`.
+    station_gser : geopandas.GeoSeries
+        Station locations.
+
+    Returns
+    -------
+    value_ser : pandas.Series
+        Value of the pixel of each station, NaN for stations outside the raster.
+
+    """
+    values = np.full(len(station_gser), np.nan)
+    with rio.open(raster_filepath) as src:
+        station_gser = station_gser.to_crs(src.crs)
+        cols, rows = ~src.transform * (
+            station_gser.x.to_numpy(),
+            station_gser.y.to_numpy(),
+        )
+        rows = np.floor(rows).astype(int)
+        cols = np.floor(cols).astype(int)
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        if inside.any():
+            rows, cols = rows[inside], cols[inside]
+            # read only the window that covers the stations rather than the whole
+            # raster
+            row_start, col_start = rows.min(), cols.min()
+            arr = src.read(
+                1,
+                window=windows.Window(
+                    col_start,
+                    row_start,
+                    cols.max() - col_start + 1,
+                    rows.max() - row_start + 1,
+                ),
+            )
+            values[inside] = arr[rows - row_start, cols - col_start]
+    return pd.Series(values, index=station_gser.index)
+
+
+def get_distance_features_df(
+    station_gser: gpd.GeoSeries,
+    feature_gser_dict: dict,
+    bounds: tuple,
+    *,
+    res: float | None = None,
+    cache_dir: str | None = None,
+    all_touched: bool = True,
+) -> pd.DataFrame:
+    """Get the distance of each station to the nearest feature of several layers.
+
+    Parameters
+    ----------
+    station_gser : geopandas.GeoSeries
+        Station locations.
+    feature_gser_dict : dict
+        Mapping of the name of each feature layer (e.g., "lake") to the geometries of
+        its features, in a projected CRS.
+    bounds : tuple
+        Bounds of the grid (minx, miny, maxx, maxy), in the CRS of the features.
+    res : numeric, optional
+        Resolution of the grid, in the units of the CRS. If None, the value from
+        `settings.DISTANCE_RES` is used.
+    cache_dir : str, optional
+        Directory where the rasters are cached. If None, the "distance" subdirectory
+        of `settings.ASSET_CACHE_DIR` is used.
+    all_touched : bool, default True
+        Whether all the pixels touched by the features are considered feature pixels,
+        see `get_distance_arr`.
+
+    Returns
+    -------
+    distance_df : pandas.DataFrame
+        Distance of each station (rows) to the nearest feature of each layer
+        (columns, named "<layer>_dist").
+
+    """
+    return pd.DataFrame(
+        {
+            f"{name}_dist": sample_raster(
+                get_distance_raster(
+                    feature_gser,
+                    bounds,
+                    res=res,
+                    name=name,
+                    cache_dir=cache_dir,
+                    all_touched=all_touched,
+                ),
+                station_gser,
+            )
+            for name, feature_gser in feature_gser_dict.items()
+        },
+        index=station_gser.index,
+    )
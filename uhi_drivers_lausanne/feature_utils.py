@@ -0,0 +1,331 @@
+"""Feature store utils."""
+
+import hashlib
+import os
+import shutil
+from collections.abc import Callable
+from os import path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+
+from uhi_drivers_lausanne import profile_utils
+
+# column with the location of the station for which the features were computed
+LOCATION_COL = "_location"
+# key of the Parquet metadata with the fingerprint of the features of a family
+FINGERPRINT_KEY = b"uhi_drivers_lausanne:fingerprint"
+
+
+def get_fingerprint(
+    params: dict | None = None, *, input_filepaths: list | None = None
+) -> str:
+    """Get a fingerprint of the parameters and inputs of the features of a family.
+
+    Parameters
+    ----------
+    params : dict, optional
+        Parameters of the computation of the features (e.g., buffer distances), whose
+        values must have a deterministic `repr`.
+    input_filepaths : list of str, optional
+        Paths to the input files or directories (e.g., Zarr stores) of the
+        computation, whose content is digested.
+
+    Returns
+    -------
+    fingerprint : str
+        Fingerprint, which changes whenever the parameters or the content of the
+        inputs change.
+
+    """
+    digest = hashlib.sha256()
+    if params is not None:
+        digest.update(repr(sorted(params.items())).encode())
+    for input_filepath in input_filepaths or []:
+        if path.isdir(input_filepath):
+            filepaths = sorted(
+                path.join(dirpath, filename)
+                for dirpath, _, filenames in os.walk(input_filepath)
+                for filename in filenames
+            )
+        else:
+            filepaths = [input_filepath]
+        for filepath in filepaths:
+            # the relative path, so that moving the inputs does not change it
+            digest.update(path.relpath(filepath, input_filepath).encode())
+            with open(filepath, "rb") as src:
+                while chunk := src.read(shutil.COPY_BUFSIZE):
+                    digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+class FeatureStore:
+    """Columnar store of station features, keyed by station id and feature family.
+
+    The features of each family (e.g., buildings, tree canopy, elevation...) are stored
+    in a Parquet file, with a row for each station along with its location. Features
+    are only computed for the stations that are not in the store yet (or whose
+    location changed), so that adding stations does not require recomputing the
+    features of all the stations. Each family can also store a fingerprint of the
+    parameters and inputs of its computation (see `get_fingerprint`), so that all its
+    stations are computed again when they change.
+    """
+
+    def __init__(self, store_dir: str) -> None:
+        """Initialize the feature store.
+
+        Parameters
+        ----------
+        store_dir : str
+            Directory of the store, created if it does not exist.
+
+        """
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        # families (and their fingerprints) loaded so far, so that repeated queries do
+        # not read the files again
+        self._family_dfs = {}
+        self._family_fingerprints = {}
+
+    def _get_family_filepath(self, family):
+        return path.join(self.store_dir, f"{family}.parquet")
+
+    def _read_family(self, family):
+        if family not in self._family_dfs:
+            family_filepath = self._get_family_filepath(family)
+            if path.exists(family_filepath):
+                self._family_dfs[family] = pd.read_parquet(family_filepath)
+                fingerprint = (pq.read_schema(family_filepath).metadata or {}).get(
+                    FINGERPRINT_KEY
+                )
+                self._family_fingerprints[family] = (
+                    None if fingerprint is None else fingerprint.decode()
+                )
+            else:
+                self._family_dfs[family] = pd.DataFrame(columns=[LOCATION_COL])
+                self._family_fingerprints[family] = None
+        return self._family_dfs[family]
+
+    def _is_stale(self, family, fingerprint):
+        # stored features are stale if they were computed with another fingerprint
+        self._read_family(family)
+        return (
+            fingerprint is not None and fingerprint != self._family_fingerprints[family]
+        )
+
+    @property
+    def families(self) -> list:
+        """Feature families in the store."""
+        return sorted(
+            path.splitext(filename)[0]
+            for filename in os.listdir(self.store_dir)
+            if filename.endswith(".parquet")
+        )
+
+    def get_missing_stations(
+        self,
+        family: str,
+        station_gser: gpd.GeoSeries,
+        *,
+        fingerprint: str | None = None,
+    ) -> gpd.GeoSeries:
+        """Get the stations whose features of a family are not in the store.
+
+        Parameters
+        ----------
+        family : str
+            Feature family.
+        station_gser : geopandas.GeoSeries
+            Station locations, indexed by the station id. Must be in the same CRS
+            every time that the family is queried.
+        fingerprint : str, optional
+            Fingerprint of the parameters and inputs of the features (see
+            `get_fingerprint`). If it does not match the stored one, all the stations
+            are missing. If None, the stored fingerprint is not checked.
+
+        Returns
+        -------
+        missing_gser : geopandas.GeoSeries
+            Stations that are not in the store, or whose location changed.
+
+        """
+        if self._is_stale(family, fingerprint):
+            return station_gser
+        stored_location_ser = self._read_family(family)[LOCATION_COL].reindex(
+            station_gser.index
+        )
+        return station_gser[
+            stored_location_ser.to_numpy()
+            != shapely.to_wkb(station_gser.values, hex=True)
+        ]
+
+    def update(
+        self,
+        family: str,
+        features_df: pd.DataFrame,
+        station_gser: gpd.GeoSeries,
+        *,
+        fingerprint: str | None = None,
+    ) -> None:
+        """Insert or replace the features of a family for some stations.
+
+        Parameters
+        ----------
+        family : str
+            Feature family.
+        features_df : pandas.DataFrame
+            Features (columns) of each station (rows), indexed by the station id.
+        station_gser : geopandas.GeoSeries
+            Locations of the stations in `features_df`, indexed by the station id.
+        fingerprint : str, optional
+            Fingerprint of the parameters and inputs of the features (see
+            `get_fingerprint`). If it does not match the stored one, the stored
+            features of all the stations are replaced by `features_df`. If None, the
+            stored fingerprint is kept.
+
+        """
+        features_df = features_df.assign(
+            **{
+                LOCATION_COL: shapely.to_wkb(
+                    station_gser[features_df.index].values, hex=True
+                )
+            }
+        )
+        family_df = self._read_family(family)
+        if self._is_stale(family, fingerprint):
+            # never mix features computed with different parameters or inputs
+            family_df = family_df.iloc[:0]
+        elif fingerprint is None:
+            fingerprint = self._family_fingerprints[family]
+        if not family_df.empty:
+            features_df = pd.concat(
+                [family_df.drop(features_df.index, errors="ignore"), features_df]
+            )
+        table = pa.Table.from_pandas(features_df)
+        if fingerprint is not None:
+            table = table.replace_schema_metadata(
+                {**table.schema.metadata, FINGERPRINT_KEY: fingerprint.encode()}
+            )
+        # write to a temporary file first so that an interrupted update never leaves a
+        # partially written family behind
+        family_filepath = self._get_family_filepath(family)
+        pq.write_table(table, f"{family_filepath}.tmp")
+        os.replace(f"{family_filepath}.tmp", family_filepath)
+        self._family_dfs[family] = features_df
+        self._family_fingerprints[family] = fingerprint
+
+    @profile_utils.profiled
+    def compute(
+        self,
+        family: str,
+        station_gser: gpd.GeoSeries,
+        compute_features: Callable[[gpd.GeoSeries], pd.DataFrame],
+        *,
+        fingerprint: str | None = None,
+    ) -> pd.DataFrame:
+        """Get the features of a family, computing only those not in the store.
+
+        Parameters
+        ----------
+        family : str
+            Feature family.
+        station_gser : geopandas.GeoSeries
+            Station locations, indexed by the station id. Must be in the same CRS
+            every time that the family is queried.
+        compute_features : callable
+            Function that takes the stations missing from the store (as a geo-series
+            of locations) and returns a data frame of their features (columns),
+            indexed by the station id. Stations without a row in the returned data
+            frame are stored with NaN features, so that they are not computed again.
+        fingerprint : str, optional
+            Fingerprint of the parameters and inputs of the features (see
+            `get_fingerprint`). If it does not match the stored one, the features of
+            all the stations are computed again. If None, the stored fingerprint is not
+            checked.
+
+        Returns
+        -------
+        features_df : pandas.DataFrame
+            Features (columns) of each station of `station_gser` (rows).
+
+        """
+        missing_gser = self.get_missing_stations(
+            family, station_gser, fingerprint=fingerprint
+        )
+        profile_utils.add_counts(stations=len(missing_gser))
+        if not missing_gser.empty:
+            self.update(
+                family,
+                compute_features(missing_gser).reindex(missing_gser.index),
+                missing_gser,
+                fingerprint=fingerprint,
+            )
+        return self.get_features_df(station_gser.index, families=[family])
+
+    def get_features_df(
+        self, station_ids=None, *, families: list | None = None
+    ) -> pd.DataFrame:
+        """Get the features of the stations as a data frame.
+
+        Parameters
+        ----------
+        station_ids : list-like, optional
+            Ids of the stations, in the order of the rows of the returned data frame.
+            If None, all the stations in the store are returned.
+        families : list of str, optional
+            Feature families, in the order of the columns of the returned data frame.
+            If None, all the families in the store are returned.
+
+        Returns
+        -------
+        features_df : pandas.DataFrame
+            Features (columns) of each station (rows).
+
+        """
+        if families is None:
+            families = self.families
+        features_df = pd.concat(
+            [
+                self._read_family(family).drop(columns=LOCATION_COL)
+                for family in families
+            ],
+            axis="columns",
+        )
+        if station_ids is not None:
+            features_df = features_df.reindex(station_ids)
+        return features_df
+
+    def get_features_arr(
+        self,
+        station_ids,
+        *,
+        families: list | None = None,
+        fillna: float | bool = 0,
+    ) -> np.ndarray:
+        """Get the feature matrix of the stations, e.g., to fit a regression.
+
+        Parameters
+        ----------
+        station_ids : list-like
+            Ids of the stations, in the order of the rows of the feature matrix.
+        families : list of str, optional
+            Feature families, in the order of the columns of the feature matrix (see
+            `get_features_df` for the names of the columns). If None, all the
+            families in the store are used.
+        fillna : float or bool, default 0
+            Value to replace NaNs with. A value of False will not replace NaNs.
+
+        Returns
+        -------
+        features_arr : numpy.ndarray
+            Feature matrix, with a row for each station and a column for each feature.
+
+        """
+        features_df = self.get_features_df(station_ids, families=families)
+        if fillna is not False:
+            features_df = features_df.fillna(fillna)
+        return features_df.to_numpy(dtype=float)
@@ -0,0 +1,498 @@
+"""Grid utils.
+
+Compute the regression features for every cell of a regular grid (rather than only at
+the station locations), e.g., to map the urban heat island over the whole extent. The
+features are stored in a Zarr group (the "feature stack") with a chunked 2D array for
+each feature, which is processed chunk by chunk so that memory use is bounded.
+"""
+import os
+from collections.abc import Callable
+from concurrent import futures
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyproj
+import rasterio as rio
+import shapely
+import tqdm
+import xarray as xr
+import zarr
+from numcodecs import Blosc
+from rasterio import shutil as rio_shutil
+from rasterio import transform, windows
+from scipy import fft
+
+from uhi_drivers_lausanne import profile_utils, settings
+
+# attribute of the feature stack with the grid transform (as a list of 6 coefficients)
+TRANSFORM_ATTR = "transform"
+# attribute of the feature stack with the grid CRS (as WKT)
+CRS_ATTR = "crs"
+# attribute of the feature stack with the geometry (as WKT) of the extent of interest
+EXTENT_ATTR = "extent"
+# attribute of the feature stack with the side (in cells) of the chunks
+CHUNKSIZE_ATTR = "chunksize"
+
+
+def get_grid(bounds: tuple, res: float) -> tuple[transform.Affine, tuple]:
+    """Get the transform and shape of a regular grid over some bounds.
+
+    The grid is aligned to multiples of the resolution, so that grids of the same
+    resolution over different (or slightly different) bounds share the same pixels.
+
+    Parameters
+    ----------
+    bounds : tuple
+        Bounds of the grid (minx, miny, maxx, maxy), in a projected CRS.
+    res : numeric
+        Resolution of the grid, in the units of the CRS.
+
+    Returns
+    -------
+    grid_transform : affine.Affine
+        Transform of the grid.
+    shape : tuple
+        Number of rows and columns of the grid.
+
+    """
+    minx, miny, maxx, maxy = bounds
+    west, north = np.floor(minx / res) * res, np.ceil(maxy / res) * res
+    width = int(np.ceil((maxx - west) / res))
+    height = int(np.ceil((north - miny) / res))
+    return transform.from_origin(west, north, res, res), (height, width)
+
+
+def get_disk_kernel(pixel_radius: int) -> np.ndarray:
+    """Get a normalized circular kernel.
+
+    Parameters
+    ----------
+    pixel_radius : int
+        Radius of the kernel (in pixels).
+
+    Returns
+    -------
+    kernel : numpy.ndarray
+        Array of side `2 * pixel_radius + 1` with equal weights (summing to one) for
+        the pixels whose center is at most `pixel_radius` from the central pixel, and
+        zero elsewhere.
+
+    """
+    y, x = np.ogrid[-pixel_radius : pixel_radius + 1, -pixel_radius : pixel_radius + 1]
+    kernel = (x**2 + y**2 <= pixel_radius**2).astype(float)
+    return kernel / kernel.sum()
+
+
+def get_buffer_means(
+    arr: np.ndarray, pixel_radii: list, rows: np.ndarray, cols: np.ndarray
+) -> np.ndarray:
+    """Get the mean of an array within circular buffers around some of its pixels.
+
+    The convolutions with the kernels of all the radii are computed with FFTs, reusing
+    the transform of the array. The pixels must be at least the largest radius away
+    from the edges of the array, i.e., the array must include a halo around them.
+
+    Parameters
+    ----------
+    arr : numpy.ndarray
+        2D array.
+    pixel_radii : list of int
+        Radii of the buffers (in pixels).
+    rows, cols : numpy.ndarray
+        Row and column of the center pixel of each buffer.
+
+    Returns
+    -------
+    mean_arr : numpy.ndarray
+        Array with the mean of each buffer (rows) for each radius (columns).
+
+    """
+    # the output only needs to be valid at the buffer centers, which are far enough from
+    # the edges so that the circular convolution does not wrap around, hence there is
+    # no need to pad the array
+    shape = [fft.next_fast_len(side, real=True) for side in arr.shape]
+    arr_fft = fft.rfft2(arr, shape)
+    mean_arr = np.empty((len(rows), len(pixel_radii)))
+    for i, pixel_radius in enumerate(pixel_radii):
+        conv_arr = fft.irfft2(
+            arr_fft * fft.rfft2(get_disk_kernel(pixel_radius), shape), shape
+        )
+        # the full convolution is shifted by the radius with respect to the array
+        mean_arr[:, i] = conv_arr[rows + pixel_radius, cols + pixel_radius]
+    return mean_arr
+
+
+def open_feature_stack(
+    dst_filepath: str,
+    bounds: tuple,
+    res: float,
+    crs,
+    *,
+    extent_geom: shapely.Geometry | None = None,
+    chunksize: int | None = None,
+) -> zarr.Group:
+    """Open the on-disk feature stack of a grid, creating it if it does not exist.
+
+    Parameters
+    ----------
+    dst_filepath : str
+        Path to the Zarr store.
+    bounds : tuple
+        Bounds of the grid (minx, miny, maxx, maxy), in `crs`.
+    res : numeric
+        Resolution of the grid, in the units of `crs`.
+    crs : str or pyproj.CRS
+        Projected CRS of the grid.
+    extent_geom : shapely.Geometry, optional
+        Geometry of the extent of interest, in `crs`. Chunks that do not intersect it
+        are not computed and cells outside it are NaN. If None, all the cells are
+        computed.
+    chunksize : int, optional
+        Side (in cells) of the chunks. If None, the value from
+        `settings.GRID_CHUNKSIZE` is used.
+
+    Returns
+    -------
+    feature_stack : zarr.Group
+        Feature stack, with the cell center coordinates ("x" and "y") and a 2D array
+        for each feature computed so far.
+
+    """
+    if chunksize is None:
+        chunksize = settings.GRID_CHUNKSIZE
+
+    grid_transform, shape = get_grid(bounds, res)
+    group = zarr.open_group(dst_filepath, mode="a")
+    if TRANSFORM_ATTR in group.attrs:
+        if (
+            transform.Affine(*group.attrs[TRANSFORM_ATTR][:6]) != grid_transform
+            or group["y"].shape + group["x"].shape != shape
+        ):
+            raise ValueError(
+                f"The feature stack at {dst_filepath} does not match the bounds and "
+                "resolution provided."
+            )
+        return group
+
+    # the `_ARRAY_DIMENSIONS` attributes make the store readable by xarray
+    for dim, coords in zip(
+        ["y", "x"],
+        [
+            grid_transform.f - (np.arange(shape[0]) + 0.5) * res,
+            grid_transform.c + (np.arange(shape[1]) + 0.5) * res,
+        ],
+    ):
+        coord_arr = group.array(dim, coords, overwrite=True)
+        coord_arr.attrs["_ARRAY_DIMENSIONS"] = [dim]
+    group.attrs.update(
+        {
+            TRANSFORM_ATTR: list(grid_transform)[:6],
+            CRS_ATTR: pyproj.CRS.from_user_input(crs).to_wkt(),
+            EXTENT_ATTR: None if extent_geom is None else extent_geom.wkt,
+            CHUNKSIZE_ATTR: chunksize,
+        }
+    )
+    return group
+
+
+def open_feature_stack_ds(filepath: str) -> xr.Dataset:
+    """Open the feature stack as a lazily-loaded dataset.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the Zarr store, as created by `open_feature_stack`.
+
+    Returns
+    -------
+    feature_stack_ds : xarray.Dataset
+        Dataset with a data variable for each feature, with "y" and "x" dimensions.
+
+    """
+    return xr.open_dataset(filepath, engine="zarr", consolidated=False)
+
+
+def _require_feature_arr(feature_stack, feature):
+    if feature not in feature_stack:
+        chunksize = feature_stack.attrs[CHUNKSIZE_ATTR]
+        feature_arr = feature_stack.create(
+            feature,
+            shape=feature_stack["y"].shape + feature_stack["x"].shape,
+            chunks=(chunksize, chunksize),
+            dtype="float32",
+            fill_value=np.nan,
+            compressor=Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE),
+        )
+        feature_arr.attrs["_ARRAY_DIMENSIONS"] = ["y", "x"]
+    return feature_stack[feature]
+
+
+def _get_chunk_slices(feature_stack):
+    # slices of the chunks that intersect the extent of interest, along with the mask
+    # of their cells within it
+    grid_transform = transform.Affine(*feature_stack.attrs[TRANSFORM_ATTR][:6])
+    chunksize = feature_stack.attrs[CHUNKSIZE_ATTR]
+    extent_wkt = feature_stack.attrs.get(EXTENT_ATTR)
+    extent_geom = None if extent_wkt is None else shapely.from_wkt(extent_wkt)
+    if extent_geom is not None:
+        shapely.prepare(extent_geom)
+    height, width = feature_stack["y"].shape[0], feature_stack["x"].shape[0]
+    x = feature_stack["x"][:]
+    y = feature_stack["y"][:]
+    for row_start in range(0, height, chunksize):
+        for col_start in range(0, width, chunksize):
+            row_slice = slice(row_start, min(row_start + chunksize, height))
+            col_slice = slice(col_start, min(col_start + chunksize, width))
+            if extent_geom is None:
+                mask = np.ones(
+                    (row_slice.stop - row_start, col_slice.stop - col_start),
+                    dtype=bool,
+                )
+            else:
+                chunk_geom = shapely.box(
+                    *windows.bounds(
+                        windows.Window.from_slices(row_slice, col_slice),
+                        grid_transform,
+                    )
+                )
+                if not extent_geom.intersects(chunk_geom):
+                    continue
+                chunk_x, chunk_y = np.meshgrid(x[col_slice], y[row_slice])
+                mask = shapely.intersects_xy(extent_geom, chunk_x, chunk_y)
+                # the extent can intersect the chunk without containing any of its
+                # cell centers
+                if not mask.any():
+                    continue
+            yield row_slice, col_slice, mask
+
+
+def _get_chunk_buffer_means(layer_filepath, x, y, buffer_dists, threshold):
+    """Get the buffer means of a raster layer around the cell centers of a chunk."""
+    with rio.open(layer_filepath) as src:
+        layer_res = src.res[0]
+        pixel_radii = [int(buffer_dist / layer_res) for buffer_dist in buffer_dists]
+        halo = pixel_radii[-1] * layer_res
+        # read the pixels of the chunk along with a halo of the largest radius, filling
+        # the pixels outside the raster with zeros
+        window = (
+            windows.from_bounds(
+                x.min() - halo - layer_res,
+                y.min() - halo - layer_res,
+                x.max() + halo + layer_res,
+                y.max() + halo + layer_res,
+                src.transform,
+            )
+            .round_offsets()
+            .round_lengths()
+        )
+        arr = src.read(1, window=window, boundless=True, fill_value=0, masked=True)
+        window_transform = src.window_transform(window)
+    arr = arr.filled(0).astype(float)
+    if threshold is not None:
+        arr = (arr > threshold).astype(float)
+    cols, rows = ~window_transform * (x, y)
+    return get_buffer_means(
+        arr,
+        pixel_radii,
+        np.floor(rows).astype(int),
+        np.floor(cols).astype(int),
+    )
+
+
+@profile_utils.profiled
+def compute_buffer_features(
+    feature_stack: zarr.Group,
+    name: str,
+    layer_filepath: str,
+    buffer_dists: list,
+    *,
+    threshold: float | None = None,
+    max_workers: int | None = None,
+    max_in_flight: int | None = None,
+) -> zarr.Group:
+    """Compute the mean of a raster layer within buffers around each grid cell.
+
+    The raster layer (e.g., a building footprint or tree canopy mask at a fine
+    resolution) is read chunk by chunk, with a halo of the largest buffer distance,
+    and the means within circular buffers around the cell centers are computed with
+    FFT convolutions (see `get_buffer_means`). Chunks are processed in parallel. The
+    buffers are centered at the layer pixel that contains each cell center.
+
+    Parameters
+    ----------
+    feature_stack : zarr.Group
+        Feature stack, as returned by `open_feature_stack`, modified in place.
+    name : str
+        Name of the feature, used as prefix of the feature arrays (e.g., "bldg_area"
+        will produce "bldg_area_10", "bldg_area_30"...).
+    layer_filepath : str
+        Path to the raster layer, in the CRS of the feature stack.
+    buffer_dists : list of numeric
+        Buffer distances, in the units of the CRS.
+    threshold : numeric, optional
+        If provided, the layer pixels with values greater than this threshold count as
+        one and the rest as zero, so that the features are fractions of the buffers
+        (e.g., of tree canopy, as in `canopy_utils.get_buffer_fractions`).
+    max_workers : int, optional
+        Maximum number of processes used to process chunks. If None, it will default
+        to the number of processors on the machine.
+    max_in_flight : int, optional
+        Maximum number of chunks being processed at once, which bounds memory usage.
+        If None, it will default to twice `max_workers`.
+
+    Returns
+    -------
+    feature_stack : zarr.Group
+        Feature stack.
+
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+    buffer_dists = sorted(buffer_dists)
+
+    feature_arrs = [
+        _require_feature_arr(feature_stack, f"{name}_{buffer_dist}")
+        for buffer_dist in buffer_dists
+    ]
+    x = feature_stack["x"][:]
+    y = feature_stack["y"][:]
+    chunk_slices = list(_get_chunk_slices(feature_stack))
+    profile_utils.add_counts(chunks=len(chunk_slices))
+    with futures.ProcessPoolExecutor(max_workers=max_workers) as executor, tqdm.tqdm(
+        total=len(chunk_slices)
+    ) as pbar:
+        future_to_chunk = {}
+        while chunk_slices or future_to_chunk:
+            while chunk_slices and len(future_to_chunk) < max_in_flight:
+                row_slice, col_slice, mask = chunk_slices.pop()
+                chunk_x, chunk_y = np.meshgrid(x[col_slice], y[row_slice])
+                future = executor.submit(
+                    _get_chunk_buffer_means,
+                    layer_filepath,
+                    chunk_x[mask],
+                    chunk_y[mask],
+                    buffer_dists,
+                    threshold,
+                )
+                future_to_chunk[future] = (row_slice, col_slice, mask)
+            done, _ = futures.wait(future_to_chunk, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                row_slice, col_slice, mask = future_to_chunk.pop(future)
+                mean_arr = future.result()
+                for i, feature_arr in enumerate(feature_arrs):
+                    chunk_arr = np.full(mask.shape, np.nan, dtype="float32")
+                    chunk_arr[mask] = mean_arr[:, i]
+                    feature_arr[row_slice, col_slice] = chunk_arr
+                pbar.update()
+    return feature_stack
+
+
+@profile_utils.profiled
+def compute_point_features(
+    feature_stack: zarr.Group,
+    compute_features: Callable[[gpd.GeoSeries], pd.DataFrame],
+) -> zarr.Group:
+    """Compute point features (e.g., elevation or distances) at each grid cell center.
+
+    Chunks are processed sequentially, so that the function can use its own
+    parallelism, e.g., the same functions used to compute the features of the
+    stations (see `feature_utils.FeatureStore.compute`).
+
+    Parameters
+    ----------
+    feature_stack : zarr.Group
+        Feature stack, as returned by `open_feature_stack`, modified in place.
+    compute_features : callable
+        Function that takes the cell centers of a chunk (as a geo-series of points in
+        the CRS of the feature stack) and returns a data frame of their features
+        (columns), with the same index.
+
+    Returns
+    -------
+    feature_stack : zarr.Group
+        Feature stack.
+
+    """
+    crs = feature_stack.attrs[CRS_ATTR]
+    x = feature_stack["x"][:]
+    y = feature_stack["y"][:]
+    chunk_slices = list(_get_chunk_slices(feature_stack))
+    profile_utils.add_counts(chunks=len(chunk_slices))
+    for row_slice, col_slice, mask in tqdm.tqdm(chunk_slices):
+        chunk_x, chunk_y = np.meshgrid(x[col_slice], y[row_slice])
+        features_df = compute_features(
+            gpd.GeoSeries(shapely.points(chunk_x[mask], chunk_y[mask]), crs=crs)
+        )
+        for feature, values in features_df.items():
+            chunk_arr = np.full(mask.shape, np.nan, dtype="float32")
+            chunk_arr[mask] = values.to_numpy(dtype="float32")
+            _require_feature_arr(feature_stack, feature)[
+                row_slice, col_slice
+            ] = chunk_arr
+    return feature_stack
+
+
+@profile_utils.profiled
+def to_cog(
+    feature_stack: zarr.Group, dst_filepath: str, *, features: list | None = None
+) -> None:
+    """Write the features of the stack as a multi-band Cloud Optimized GeoTIFF.
+
+    The features are copied chunk by chunk into a tiled GeoTIFF, which is then
+    converted to a COG, so that the stack is never fully loaded into memory.
+
+    Parameters
+    ----------
+    feature_stack : zarr.Group
+        Feature stack, as returned by `open_feature_stack`.
+    dst_filepath : str
+        Path to the COG.
+    features : list of str, optional
+        Features to write, one per band. If None, all the features of the stack are
+        written.
+
+    """
+    if features is None:
+        features = sorted(
+            feature
+            for feature, _ in feature_stack.arrays()
+            if feature_stack[feature].ndim == 2
+        )
+    chunksize = feature_stack.attrs[CHUNKSIZE_ATTR]
+    height, width = feature_stack["y"].shape[0], feature_stack["x"].shape[0]
+    tmp_filepath = f"{dst_filepath}.tmp.tif"
+    with rio.open(
+        tmp_filepath,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=len(features),
+        dtype="float32",
+        crs=feature_stack.attrs[CRS_ATTR],
+        transform=transform.Affine(*feature_stack.attrs[TRANSFORM_ATTR][:6]),
+        nodata=np.nan,
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        BIGTIFF="IF_SAFER",
+    ) as dst:
+        for band, feature in enumerate(features, start=1):
+            dst.set_band_description(band, feature)
+            feature_arr = feature_stack[feature]
+            for row_start in range(0, height, chunksize):
+                for col_start in range(0, width, chunksize):
+                    window = windows.Window(
+                        col_start,
+                        row_start,
+                        min(chunksize, width - col_start),
+                        min(chunksize, height - row_start),
+                    )
+                    dst.write(feature_arr[window.toslices()], band, window=window)
+    rio_shutil.copy(
+        tmp_filepath, dst_filepath, driver="COG", compress="deflate", predictor=3
+    )
+    os.remove(tmp_filepath)
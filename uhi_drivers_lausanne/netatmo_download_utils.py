@@ -0,0 +1,548 @@
+"""Netatmo download utils.
+
+Download the measurements of the Netatmo stations of a region concurrently, with a
+token-bucket rate limiter (so that the user limits of the API are not exceeded),
+bounded concurrency, retries with exponential backoff and an on-disk cache of the raw
+responses, keyed by station and time window, so that an interrupted download resumes
+where it stopped. The access token can be provided by a callable (e.g., a
+`RefreshTokenProvider`), so that it is refreshed whenever the API rejects it. The
+cached responses are then dumped as snapshots in the format of the "getpublicdata"
+responses, which can be processed with `netatmo_utils.process_filepaths` (or
+`netatmo_utils.stream_filepaths`).
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from collections.abc import Callable, Coroutine
+from concurrent import futures
+from os import path
+from urllib import parse, request
+
+import aiohttp
+import pandas as pd
+import tqdm
+
+from uhi_drivers_lausanne import profile_utils, settings
+
+# maximum number of values returned by a "getmeasure" request
+MAX_MEASURES = 1024
+# duration of each "getmeasure" scale, in seconds
+SCALE_SECONDS = {"30min": 1800, "1hour": 3600, "3hours": 10800, "1day": 86400}
+# module type that measures temperature and humidity (i.e., the outdoor module)
+OUTDOOR_MODULE_TYPE = "NAModule1"
+# HTTP statuses of the responses that are retried (rate limited or server errors)
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# HTTP statuses of the responses to requests with an expired (or invalid) token
+_AUTH_STATUSES = {401, 403}
+
+
+class TokenBucket:
+    """Token-bucket rate limiter for asyncio tasks.
+
+    The bucket holds up to `capacity` tokens and is refilled at `rate` tokens per
+    second. Each request consumes a token, waiting for the bucket to refill if it is
+    empty, so that bursts of up to `capacity` requests are allowed but the average
+    rate never exceeds `rate`.
+
+    Parameters
+    ----------
+    rate : numeric
+        Number of tokens added per second.
+    capacity : numeric
+        Maximum number of tokens in the bucket.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """Initialize the (full) token bucket."""
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        # waiting tasks acquire the tokens in order of arrival
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until a token is available and consume it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._last) * self.rate
+                )
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RefreshTokenProvider:
+    """OAuth2 access token provider that uses a refresh token.
+
+    Each call requests a new access token from the token endpoint of the API with the
+    "refresh_token" grant. The API may rotate the refresh token, in which case the new
+    one is kept for the next call.
+
+    Parameters
+    ----------
+    refresh_token : str
+        OAuth2 refresh token, e.g., as generated in the app page of the Netatmo
+        developer portal.
+    client_id, client_secret : str
+        Credentials of the Netatmo app.
+    token_url : str, optional
+        URL of the token endpoint. If None, the value from
+        `settings.NETATMO_TOKEN_URL` is used.
+    """
+
+    def __init__(
+        self,
+        refresh_token: str,
+        client_id: str,
+        client_secret: str,
+        *,
+        token_url: str | None = None,
+    ) -> None:
+        """Initialize the token provider."""
+        if token_url is None:
+            token_url = settings.NETATMO_TOKEN_URL
+        self.refresh_token = refresh_token
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_url = token_url
+
+    def __call__(self) -> str:
+        """Request a new access token."""
+        data = parse.urlencode(
+            {
+                "grant_type": "refresh_token",
+                "refresh_token": self.refresh_token,
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+            }
+        ).encode()
+        with request.urlopen(request.Request(self.token_url, data=data)) as response:
+            token_json = json.load(response)
+        self.refresh_token = token_json.get("refresh_token", self.refresh_token)
+        return token_json["access_token"]
+
+
+class _AccessToken:
+    # access token shared by the concurrent requests, which is refreshed with the token
+    # provider (if any) when the API rejects it
+    def __init__(self, access_token):
+        if callable(access_token):
+            self._provider = access_token
+            self.value = None
+        else:
+            self._provider = None
+            self.value = access_token
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, rejected_value):
+        # returns whether the token can be refreshed. The requests rejected at the same
+        # time only refresh the token once.
+        if self._provider is None:
+            return False
+        async with self._lock:
+            if self.value == rejected_value:
+                # the provider may block (e.g., on an HTTP request)
+                self.value = await asyncio.to_thread(self._provider)
+        return True
+
+
+def _run(coro: Coroutine):
+    # `asyncio.run` cannot be called from a running event loop (e.g., in a Jupyter
+    # notebook), in which case the coroutine is run in its own thread
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def _dump_json(response_json, dst_filepath):
+    # write to a temporary file first so that an interrupted download never leaves a
+    # partially written response in the cache
+    os.makedirs(path.dirname(dst_filepath), exist_ok=True)
+    with open(f"{dst_filepath}.tmp", "w") as dst:
+        json.dump(response_json, dst)
+    os.replace(f"{dst_filepath}.tmp", dst_filepath)
+
+
+async def _get_json(
+    session, url, params, token, bucket, semaphore, max_retries, backoff
+):
+    attempt = 0
+    refreshed = False
+    while True:
+        await bucket.acquire()
+        access_token = token.value
+        try:
+            async with semaphore, session.get(
+                url,
+                params=params,
+                headers={"Authorization": f"Bearer {access_token}"},
+            ) as response:
+                if response.status in _AUTH_STATUSES and not refreshed:
+                    # the token may have expired during the download, in which case
+                    # it is refreshed (once per request) and the request is sent again
+                    refreshed = await token.refresh(access_token)
+                    if refreshed:
+                        continue
+                if response.status not in _RETRY_STATUSES:
+                    # other client errors (e.g., invalid token) are not retried
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+                error = aiohttp.ClientResponseError(
+                    response.request_info,
+                    response.history,
+                    status=response.status,
+                    message=response.reason,
+                )
+        except (
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            asyncio.TimeoutError,
+        ) as exc:
+            error = exc
+        if attempt == max_retries:
+            raise error
+        # exponential backoff with jitter, so that retries are spread out
+        await asyncio.sleep(backoff * 2**attempt * (1 + random.random()))
+        attempt += 1
+
+
+async def _download_json(
+    request_dict,
+    token,
+    *,
+    rate,
+    capacity,
+    max_concurrency,
+    max_retries,
+    backoff,
+):
+    # download the responses of the requests (a mapping of the cache filepath to the
+    # url and query parameters) that are not cached yet, and return their number
+    missing_dict = {
+        dst_filepath: request
+        for dst_filepath, request in request_dict.items()
+        if not path.exists(dst_filepath)
+    }
+    if not missing_dict:
+        return 0
+    if token.value is None:
+        # the first token of a provider is only requested if something is downloaded
+        await token.refresh(None)
+    bucket = TokenBucket(rate, capacity)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with aiohttp.ClientSession() as session:
+        with tqdm.tqdm(total=len(missing_dict)) as pbar:
+
+            async def download(dst_filepath, url, params):
+                response_json = await _get_json(
+                    session,
+                    url,
+                    params,
+                    token,
+                    bucket,
+                    semaphore,
+                    max_retries,
+                    backoff,
+                )
+                _dump_json(response_json, dst_filepath)
+                pbar.update()
+
+            await asyncio.gather(
+                *(
+                    download(dst_filepath, url, params)
+                    for dst_filepath, (url, params) in missing_dict.items()
+                )
+            )
+    return len(missing_dict)
+
+
+def _get_timestamp(dt):
+    # naive datetimes are treated as UTC
+    return int(pd.Timestamp(dt).timestamp())
+
+
+def _get_windows(start_ts, end_ts, scale):
+    # split the time range so that each request returns at most `MAX_MEASURES` values
+    step = SCALE_SECONDS[scale]
+    return [
+        (begin_ts, min(begin_ts + (MAX_MEASURES - 1) * step, end_ts))
+        for begin_ts in range(start_ts, end_ts + 1, MAX_MEASURES * step)
+    ]
+
+
+def _get_station_modules(station_records):
+    # station id, outdoor module id and location of each station
+    return [
+        (station_record["_id"], module_id, station_record["place"]["location"][:2])
+        for station_record in station_records
+        for module_id, module_type in station_record.get("module_types", {}).items()
+        if module_type == OUTDOOR_MODULE_TYPE
+    ]
+
+
+def _get_measure_filepath(cache_dir, station_id, module_id, begin_ts, end_ts):
+    # station and module ids are MAC addresses, whose colons are dropped so that the
+    # file names are valid on all platforms
+    return path.join(
+        cache_dir,
+        "measures",
+        f"{station_id}_{module_id}_{begin_ts}_{end_ts}.json".replace(":", ""),
+    )
+
+
+def dump_snapshots(
+    measure_filepath_dict: dict,
+    variables: list,
+    dst_dir: str,
+) -> list:
+    """Dump the cached "getmeasure" responses as snapshots of all the stations.
+
+    Each snapshot has the measurements of all the stations at a given time, in the
+    format of the "getpublicdata" responses, so that they can be processed with
+    `netatmo_utils.process_filepaths`.
+
+    Parameters
+    ----------
+    measure_filepath_dict : dict
+        Mapping of the JSON filepath of each "getmeasure" response (requested with
+        `optimize=false`) to the station id, outdoor module id and location
+        (longitude, latitude) of the station.
+    variables : list of str
+        Variables of the "getmeasure" requests, in the order of their values.
+    dst_dir : str
+        Directory where the snapshots are dumped, one JSON file per timestamp.
+        Existing snapshots for the same timestamps are overwritten.
+
+    Returns
+    -------
+    snapshot_filepaths : list of str
+        JSON filepaths of the snapshots, sorted by time.
+    """
+    station_records_dict = {}
+    for measure_filepath, (
+        station_id,
+        module_id,
+        location,
+    ) in measure_filepath_dict.items():
+        with open(measure_filepath) as src:
+            body = json.load(src)["body"]
+        # "getmeasure" responses without values have an empty list as body
+        for ts, values in (body or {}).items():
+            station_records_dict.setdefault(int(ts), []).append(
+                {
+                    "_id": station_id,
+                    "place": {"location": list(location)},
+                    "module_types": {module_id: OUTDOOR_MODULE_TYPE},
+                    "measures": {module_id: {"res": {ts: values}, "type": variables}},
+                }
+            )
+
+    os.makedirs(dst_dir, exist_ok=True)
+    snapshot_filepaths = []
+    for ts in sorted(station_records_dict):
+        snapshot_filepath = path.join(dst_dir, f"{ts}.json")
+        with open(snapshot_filepath, "w") as dst:
+            json.dump(
+                {"body": station_records_dict[ts], "status": "ok", "time_server": ts},
+                dst,
+            )
+        snapshot_filepaths.append(snapshot_filepath)
+    return snapshot_filepaths
+
+
+async def _download_filepaths(
+    bounds,
+    start_ts,
+    end_ts,
+    access_token,
+    *,
+    variables,
+    scale,
+    cache_dir,
+    base_url,
+    **download_kws,
+):
+    # the token is shared by both steps, so that it is refreshed at most once
+    token = _AccessToken(access_token)
+
+    # 1. stations of the region, cached by the bounds and variables
+    lon_min, lat_min, lon_max, lat_max = bounds
+    public_data_params = {
+        "lat_ne": lat_max,
+        "lon_ne": lon_max,
+        "lat_sw": lat_min,
+        "lon_sw": lon_min,
+        "required_data": ",".join(variables),
+        "filter": "false",
+    }
+    public_data_filepath = path.join(
+        cache_dir,
+        "publicdata",
+        hashlib.sha256(repr(sorted(public_data_params.items())).encode()).hexdigest()[
+            :16
+        ]
+        + ".json",
+    )
+    num_downloaded = await _download_json(
+        {public_data_filepath: (f"{base_url}/getpublicdata", public_data_params)},
+        token,
+        **download_kws,
+    )
+    with open(public_data_filepath) as src:
+        station_records = json.load(src)["body"]
+
+    # 2. measurements of each station and time window
+    request_dict = {}
+    measure_filepath_dict = {}
+    for station_id, module_id, location in _get_station_modules(station_records):
+        for begin_ts, window_end_ts in _get_windows(start_ts, end_ts, scale):
+            measure_filepath = _get_measure_filepath(
+                cache_dir, station_id, module_id, begin_ts, window_end_ts
+            )
+            request_dict[measure_filepath] = (
+                f"{base_url}/getmeasure",
+                {
+                    "device_id": station_id,
+                    "module_id": module_id,
+                    "scale": scale,
+                    "type": ",".join(variables),
+                    "date_begin": begin_ts,
+                    "date_end": window_end_ts,
+                    "optimize": "false",
+                    "real_time": "false",
+                },
+            )
+            measure_filepath_dict[measure_filepath] = (station_id, module_id, location)
+    num_downloaded += await _download_json(request_dict, token, **download_kws)
+    return measure_filepath_dict, num_downloaded
+
+
+@profile_utils.profiled
+def download_filepaths(
+    bounds: tuple,
+    start_dt,
+    end_dt,
+    access_token: str | Callable[[], str],
+    *,
+    variables: list | None = None,
+    scale: str = "1hour",
+    dst_dir: str | None = None,
+    cache_dir: str | None = None,
+    base_url: str | None = None,
+    rate: float | None = None,
+    capacity: float | None = None,
+    max_concurrency: int | None = None,
+    max_retries: int | None = None,
+    backoff: float | None = None,
+) -> list:
+    """Download the measurements of the Netatmo stations of a region.
+
+    The stations are queried with a "getpublicdata" request and the measurements of
+    their outdoor module with "getmeasure" requests, split into time windows of at
+    most `MAX_MEASURES` values and sent concurrently. Responses are cached on disk,
+    keyed by station and time window, so that only the missing responses are
+    downloaded when the function is called again (e.g., after a failure).
+
+    Parameters
+    ----------
+    bounds : tuple
+        Bounds of the region (lon_min, lat_min, lon_max, lat_max).
+    start_dt, end_dt : str or datetime-like
+        Start and end of the time range (naive datetimes are treated as UTC).
+    access_token : str or callable
+        OAuth2 access token of the Netatmo API, or a token provider, i.e., a callable
+        without arguments that returns a new access token (e.g., a
+        `RefreshTokenProvider`). The provider is called before the first request and
+        whenever the API rejects the token (with a 401 or 403 status), so that an
+        expired token is refreshed during the download. A token passed as a string is
+        never refreshed.
+    variables : list of str, optional
+        Variables measured by the outdoor module, i.e., "temperature" and/or
+        "humidity". If None, only "temperature" is downloaded.
+    scale : str, default "1hour"
+        Time scale of the measurements, i.e., one of the keys of `SCALE_SECONDS`.
+    dst_dir : str, optional
+        Directory where the snapshots are dumped (see `dump_snapshots`). If None, the
+        "snapshots" subdirectory of `cache_dir` is used.
+    cache_dir : str, optional
+        Directory where the responses are cached. If None, the "netatmo" subdirectory
+        of `settings.ASSET_CACHE_DIR` is used.
+    base_url : str, optional
+        Base URL of the API, e.g., of a local mock server for testing. If None, the
+        value from `settings.NETATMO_API_URL` is used.
+    rate : numeric, optional
+        Maximum average number of requests per second. If None, the value from
+        `settings.NETATMO_RATE` is used.
+    capacity : numeric, optional
+        Maximum number of requests sent in a burst. If None, the value from
+        `settings.NETATMO_BURST` is used.
+    max_concurrency : int, optional
+        Maximum number of requests in flight. If None, the value from
+        `settings.NETATMO_MAX_CONCURRENCY` is used.
+    max_retries : int, optional
+        Maximum number of retries of a request that failed due to a connection
+        error, a timeout, rate limiting or a server error. If None, the value from
+        `settings.NETATMO_MAX_RETRIES` is used.
+    backoff : numeric, optional
+        Base delay (in seconds) before retrying a request, doubled at each retry. If
+        None, the value from `settings.NETATMO_BACKOFF` is used.
+
+    Returns
+    -------
+    snapshot_filepaths : list of str
+        JSON filepaths of the snapshots, sorted by time, to be processed with
+        `netatmo_utils.process_filepaths`.
+    """
+    if variables is None:
+        variables = ["temperature"]
+    if cache_dir is None:
+        cache_dir = path.join(settings.ASSET_CACHE_DIR, "netatmo")
+    if dst_dir is None:
+        dst_dir = path.join(cache_dir, "snapshots")
+    if base_url is None:
+        base_url = settings.NETATMO_API_URL
+    if rate is None:
+        rate = settings.NETATMO_RATE
+    if capacity is None:
+        capacity = settings.NETATMO_BURST
+    if max_concurrency is None:
+        max_concurrency = settings.NETATMO_MAX_CONCURRENCY
+    if max_retries is None:
+        max_retries = settings.NETATMO_MAX_RETRIES
+    if backoff is None:
+        backoff = settings.NETATMO_BACKOFF
+
+    measure_filepath_dict, num_downloaded = _run(
+        _download_filepaths(
+            bounds,
+            _get_timestamp(start_dt),
+            _get_timestamp(end_dt),
+            access_token,
+            variables=variables,
+            scale=scale,
+            cache_dir=cache_dir,
+            base_url=base_url.rstrip("/"),
+            rate=rate,
+            capacity=capacity,
+            max_concurrency=max_concurrency,
+            max_retries=max_retries,
+            backoff=backoff,
+        )
+    )
+    profile_utils.add_counts(
+        requests=num_downloaded,
+        cached=len(measure_filepath_dict) + 1 - num_downloaded,
+    )
+    return dump_snapshots(measure_filepath_dict, variables, dst_dir)
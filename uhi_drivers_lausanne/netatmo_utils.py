@@ -1,12 +1,19 @@
 """Netatmo utils."""
 import json
+import os
+from concurrent import futures
 from typing import Tuple
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import tqdm
 from shapely import geometry
 
+from uhi_drivers_lausanne import profile_utils
+
 NETATMO_CRS = "epsg:4326"
 # ECV_DICT = {
 #     "precipitation": "rain_live",
@@ -27,30 +34,14 @@ variable_columns = [
     "wind_strength",
     "wind_angle",
     "rain_live",
+    "humidity",
 ]
+# number of rows buffered before writing a row group in streaming mode
+ROW_GROUP_SIZE = 1_000_000
 
 
-def get_station_obs_dict(station_record: dict) -> dict:
-    """Get a dictionary of observations for a single station record.
-
-    Dictionaries have two metadata keys (i.e., station_id_col and "geometry") and a key
-    for each measured variable.
-
-    Parameters
-    ----------
-    station_record : dict
-        Input dictionary of station metadata and observations as returned by the Netatmo
-        API.
-
-    Returns
-    -------
-    obs_dict: dict
-        Dictionary of station metadata and observations.
-    """
-    obs_dict = {
-        "id": station_record["_id"],
-        "geometry": geometry.Point(*station_record["place"]["location"]),
-    }
+def _get_obs_value_dict(station_record: dict) -> dict:
+    """Get a dictionary of the measured variables of a single station record."""
 
     # observations = {}
     # NOTE: in the "modules" and "module_types" of station_record, there is the info
@@ -73,6 +64,7 @@ def get_station_obs_dict(station_record: dict) -> dict:
         "NAModule3": lambda record: {"rain_live": record["rain_live"]},
     }
 
+    obs_dict = {}
     module_types = station_record["module_types"]
     for module_key, module_value_dict in station_record["measures"].items():
         obs_dict.update(
@@ -82,6 +74,32 @@ def get_station_obs_dict(station_record: dict) -> dict:
     return obs_dict
 
 
+def get_station_obs_dict(station_record: dict) -> dict:
+    """Get a dictionary of observations for a single station record.
+
+    Dictionaries have two metadata keys (i.e., station_id_col and "geometry") and a key
+    for each measured variable.
+
+    Parameters
+    ----------
+    station_record : dict
+        Input dictionary of station metadata and observations as returned by the Netatmo
+        API.
+
+    Returns
+    -------
+    obs_dict: dict
+        Dictionary of station metadata and observations.
+    """
+    obs_dict = {
+        "id": station_record["_id"],
+        "geometry": geometry.Point(*station_record["place"]["location"]),
+    }
+    obs_dict.update(_get_obs_value_dict(station_record))
+
+    return obs_dict
+
+
 def process_response(response_json: dict) -> Tuple[int, gpd.GeoSeries, pd.DataFrame]:
     """Process the response from the Netatmo API.
 
@@ -113,6 +131,7 @@ def process_response(response_json: dict) -> Tuple[int, gpd.GeoSeries, pd.DataFr
     )
 
 
+@profile_utils.profiled
 def process_filepaths(data_filepaths: list) -> Tuple[pd.DataFrame, gpd.GeoSeries]:
     """Process list of JSON filepaths with Netatmo API responses.
 
@@ -131,6 +150,7 @@ def process_filepaths(data_filepaths: list) -> Tuple[pd.DataFrame, gpd.GeoSeries
     ts_df_dict = {}
     station_gser = gpd.GeoSeries(crs=NETATMO_CRS)
 
+    profile_utils.add_counts(files=len(data_filepaths))
     for data_filepath in tqdm.tqdm(data_filepaths):
         with open(data_filepath) as src:
             ts, _gser, _df = process_response(json.load(src))
@@ -145,3 +165,207 @@ def process_filepaths(data_filepaths: list) -> Tuple[pd.DataFrame, gpd.GeoSeries
     ts_df = ts_df.reset_index().sort_values(by=[variable_col, station_id_col, time_col])
     ts_df[time_col] = pd.to_datetime(ts_df[time_col], unit="s", errors="coerce")
     return ts_df.set_index([variable_col, station_id_col, time_col]), station_gser
+
+
+def _parse_filepath(data_filepath: str, variables: list) -> dict:
+    """Parse a JSON file with a Netatmo API response into column arrays.
+
+    Parameters
+    ----------
+    data_filepath : str
+        JSON filepath with a Netatmo API response.
+    variables : list of str
+        Variables to extract. Variables that are not measured by a station are set to
+        NaN.
+
+    Returns
+    -------
+    columns_dict : dict
+        Dictionary of column arrays, with the station IDs, longitudes, latitudes and a
+        float array for each variable, and the server timestamp of the response.
+    """
+    with open(data_filepath) as src:
+        response_json = json.load(src)
+    station_records = response_json["body"]
+    num_records = len(station_records)
+    station_ids = []
+    lon_arr = np.empty(num_records)
+    lat_arr = np.empty(num_records)
+    variable_arr_dict = {
+        variable: np.full(num_records, np.nan) for variable in variables
+    }
+    for i, station_record in enumerate(station_records):
+        station_ids.append(station_record["_id"])
+        lon_arr[i], lat_arr[i] = station_record["place"]["location"][:2]
+        for variable, value in _get_obs_value_dict(station_record).items():
+            if variable in variable_arr_dict and value is not None:
+                variable_arr_dict[variable][i] = value
+
+    return {
+        time_col: response_json["time_server"],
+        station_id_col: station_ids,
+        "lon": lon_arr,
+        "lat": lat_arr,
+        **variable_arr_dict,
+    }
+
+
+@profile_utils.profiled
+def stream_filepaths(
+    data_filepaths: list,
+    dst_filepath: str,
+    *,
+    variables: list | None = None,
+    row_group_size: int | None = None,
+    max_workers: int | None = None,
+) -> gpd.GeoSeries:
+    """Stream a list of JSON filepaths with Netatmo API responses into a Parquet file.
+
+    Contrary to `process_filepaths`, the responses are never held in memory all at
+    once: files are parsed in parallel into column arrays, which are buffered and
+    written to `dst_filepath` as row groups (in wide format, i.e., with a time, station
+    ID and a column for each variable). The Parquet file can then be read with
+    `read_ts_df`.
+
+    Parameters
+    ----------
+    data_filepaths : list of str
+        List of JSON filepaths with Netatmo API responses.
+    dst_filepath : str
+        Path to the Parquet file to write.
+    variables : list of str, optional
+        Variables to extract. If None, the value from `variable_columns` is used.
+    row_group_size : int, optional
+        Number of rows buffered before writing a row group. If None, the value from
+        `ROW_GROUP_SIZE` is used.
+    max_workers : int, optional
+        Maximum number of processes used to parse files. If None, it will default to
+        the number of processors on the machine.
+
+    Returns
+    -------
+    station_gser : geopandas.GeoSeries
+        Geoseries of station locations, indexed by station ID.
+    """
+    if variables is None:
+        variables = variable_columns
+    if row_group_size is None:
+        row_group_size = ROW_GROUP_SIZE
+    if max_workers is None:
+        max_workers = os.cpu_count()
+
+    schema = pa.schema(
+        [
+            (time_col, pa.timestamp("s")),
+            (station_id_col, pa.string()),
+        ]
+        + [(variable, pa.float64()) for variable in variables]
+    )
+    # as in `process_filepaths`, the first location found for each station is kept
+    station_location_dict = {}
+    columns_dicts = []
+    num_buffered_rows = 0
+
+    def write_row_group(writer):
+        writer.write_table(
+            pa.Table.from_pydict(
+                {
+                    time_col: np.concatenate(
+                        [
+                            np.full(
+                                len(columns_dict[station_id_col]),
+                                columns_dict[time_col],
+                                dtype="datetime64[s]",
+                            )
+                            for columns_dict in columns_dicts
+                        ]
+                    ),
+                    station_id_col: [
+                        station_id
+                        for columns_dict in columns_dicts
+                        for station_id in columns_dict[station_id_col]
+                    ],
+                    **{
+                        variable: np.concatenate(
+                            [columns_dict[variable] for columns_dict in columns_dicts]
+                        )
+                        for variable in variables
+                    },
+                },
+                schema=schema,
+            ),
+            row_group_size=row_group_size,
+        )
+
+    # submit files in bounded windows so that parsed files do not pile up in memory
+    # while the main process writes the row groups
+    with futures.ProcessPoolExecutor(
+        max_workers=max_workers
+    ) as executor, pq.ParquetWriter(dst_filepath, schema) as writer:
+        window_size = 4 * max_workers
+        with tqdm.tqdm(total=len(data_filepaths)) as pbar:
+            for start in range(0, len(data_filepaths), window_size):
+                for columns_dict in executor.map(
+                    _parse_filepath,
+                    data_filepaths[start : start + window_size],
+                    [variables] * window_size,
+                ):
+                    for station_id, lon, lat in zip(
+                        columns_dict[station_id_col],
+                        columns_dict["lon"],
+                        columns_dict["lat"],
+                    ):
+                        station_location_dict.setdefault(station_id, (lon, lat))
+                    columns_dicts.append(columns_dict)
+                    num_buffered_rows += len(columns_dict[station_id_col])
+                    if num_buffered_rows >= row_group_size:
+                        write_row_group(writer)
+                        columns_dicts = []
+                        num_buffered_rows = 0
+                    pbar.update()
+        if columns_dicts:
+            write_row_group(writer)
+
+    return gpd.GeoSeries(
+        gpd.points_from_xy(*zip(*station_location_dict.values()))
+        if station_location_dict
+        else [],
+        index=pd.Index(station_location_dict.keys(), name=station_id_col),
+        crs=NETATMO_CRS,
+    )
+
+
+def read_ts_df(
+    filepath: str,
+    *,
+    variables: list | None = None,
+    station_ids: list | None = None,
+) -> pd.DataFrame:
+    """Read a Parquet file written by `stream_filepaths`.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the Parquet file.
+    variables : list of str, optional
+        Variables to read. If None, all the variables in the file are read.
+    station_ids : list of str, optional
+        Station IDs to read. If None, all the stations in the file are read.
+
+    Returns
+    -------
+    ts_df : pandas.DataFrame
+        Dataframe of station observations, indexed by variable, station ID, and time,
+        as returned by `process_filepaths`.
+    """
+    columns = None if variables is None else [time_col, station_id_col] + variables
+    filters = None if station_ids is None else [(station_id_col, "in", station_ids)]
+    ts_df = pd.read_parquet(filepath, columns=columns, filters=filters)
+    # ensure the same time resolution as in `process_filepaths`
+    ts_df[time_col] = ts_df[time_col].astype("datetime64[ns]")
+    ts_df = (
+        ts_df.melt(id_vars=[time_col, station_id_col], var_name=variable_col)
+        .dropna(subset=value_col)
+        .sort_values(by=[variable_col, station_id_col, time_col])
+    )
+    return ts_df.set_index([variable_col, station_id_col, time_col])
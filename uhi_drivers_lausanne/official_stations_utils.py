@@ -1,11 +1,18 @@
 """Official stations utils."""
 
+import contextlib
+import os
 import tempfile
+from concurrent import futures
 from os import environ, path
 
 import boto3
 import geopandas as gpd
 import pandas as pd
+from boto3.s3 import transfer
+from botocore import config
+
+from uhi_drivers_lausanne import profile_utils, settings
 
 
 class SpacesClient:
@@ -20,6 +27,8 @@ class SpacesClient:
         region_name: str | None = None,
         profile_name: str | None = None,
         endpoint_url: str | None = None,
+        cache_dir: str | None = None,
+        max_connections: int | None = None,
     ) -> None:
         """Initialize the client.
 
@@ -42,6 +51,15 @@ class SpacesClient:
         endpoint_url : str, optional
             The complete URL to use for the constructed client. If no value is provided,
             the value set in the `S3_ENDPOINT_URL` environment variable will be used.
+        cache_dir : str, optional
+            Directory where the downloaded objects are stored, keyed by their ETag, so
+            that objects that did not change are not downloaded again. If None, the
+            objects are stored in a temporary directory that is removed along with
+            the client.
+        max_connections : int, optional
+            Maximum number of connections of the (shared) pool of the client, i.e.,
+            maximum number of concurrent requests. If None, the value from
+            `settings.SPACES_MAX_CONNECTIONS` is used.
 
         """
         # # load dotenv file
@@ -64,12 +82,113 @@ class SpacesClient:
             region_name=region_name,
             profile_name=profile_name,
         )
+        if max_connections is None:
+            max_connections = settings.SPACES_MAX_CONNECTIONS
+        # low-level clients are thread-safe, so a single client (and its connection
+        # pool) is shared by all the concurrent downloads
         self.client = self.session.client(
             "s3",
             endpoint_url=endpoint_url,
+            config=config.Config(max_pool_connections=max_connections),
         )
         self.bucket_name = bucket_name
+        self.max_connections = max_connections
+        if cache_dir is None:
+            self._tmp_dir = tempfile.TemporaryDirectory()
+            cache_dir = self._tmp_dir.name
+        self.cache_dir = cache_dir
+
+    def _get_cache_dir(self, key):
+        return path.join(self.cache_dir, self.bucket_name, key)
+
+    def _fetch(self, key, max_concurrency):
+        etag = self.client.head_object(Bucket=self.bucket_name, Key=key)["ETag"]
+        key_dir = self._get_cache_dir(key)
+        # keep the extension so that readers can infer the file format
+        filepath = path.join(key_dir, etag.strip('"') + path.splitext(key)[1])
+        if path.exists(filepath):
+            return filepath
+
+        os.makedirs(key_dir, exist_ok=True)
+        # partial downloads are kept out of `key_dir` so that removing the stale
+        # versions below never removes the download of another thread or process
+        tmp_dir = path.join(self.cache_dir, ".tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as dst:
+            try:
+                # large objects are downloaded with concurrent ranged GETs
+                self.client.download_fileobj(
+                    self.bucket_name,
+                    key,
+                    dst,
+                    Config=transfer.TransferConfig(
+                        multipart_threshold=settings.SPACES_MULTIPART_CHUNKSIZE,
+                        multipart_chunksize=settings.SPACES_MULTIPART_CHUNKSIZE,
+                        max_concurrency=max_concurrency,
+                    ),
+                )
+            except BaseException:
+                os.remove(dst.name)
+                raise
+        # atomic, so that other processes never see a partially written object
+        os.replace(dst.name, filepath)
+        # remove the stale versions of the object
+        for filename in os.listdir(key_dir):
+            if path.join(key_dir, filename) != filepath:
+                # another thread or process may have removed it already
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path.join(key_dir, filename))
+        return filepath
+
+    def fetch(self, key: str) -> str:
+        """Get the local path of an object, downloading it if it is not cached.
+
+        Parameters
+        ----------
+        key : str
+            Key of the object in the bucket.
+
+        Returns
+        -------
+        filepath : str
+            Local path of the object.
 
+        """
+        return self._fetch(key, self.max_connections)
+
+    @profile_utils.profiled
+    def fetch_many(self, keys: list, *, max_workers: int | None = None) -> dict:
+        """Get the local paths of many objects, downloading them concurrently.
+
+        Parameters
+        ----------
+        keys : list of str
+            Keys of the objects in the bucket.
+        max_workers : int, optional
+            Maximum number of objects downloaded at once. If None, the value of
+            `max_connections` of the client is used. The connections are shared
+            between the ranged GETs of the objects being downloaded.
+
+        Returns
+        -------
+        filepath_dict : dict
+            Mapping of each key to the local path of its object.
+
+        """
+        if max_workers is None:
+            max_workers = self.max_connections
+        max_concurrency = max(self.max_connections // max_workers, 1)
+        profile_utils.add_counts(objects=len(keys))
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_key = {
+                executor.submit(self._fetch, key, max_concurrency): key for key in keys
+            }
+            return {
+                future_to_key[future]: future.result()
+                for future in futures.as_completed(future_to_key)
+            }
+
+    @profile_utils.profiled
     def get_idaweb_df(self, key: str) -> pd.DataFrame:
         """Get IDAWEB data frame.
 
@@ -84,23 +203,33 @@ class SpacesClient:
             IDAWEB data frame.
 
         """
-        idaweb_df = pd.read_csv(
-            self.client.get_object(Bucket=self.bucket_name, Key=key).get("Body"),
+        # parse the txt file in chunks, converting each of them to numeric values so
+        # that the whole file is never held as strings
+        idaweb_dfs = []
+        with pd.read_csv(
+            self.fetch(key),
             sep=";",
             na_values="-",
-        )
-        # drop rows that correspond to station names in the txt file
-        idaweb_df = idaweb_df.drop(idaweb_df[idaweb_df["stn"] == "stn"].index)
-        # pivot, ensure numeric and set datetime index
-        idaweb_df = idaweb_df.pivot(
-            index="time",
-            columns="stn",
-            values=idaweb_df.columns.drop(["stn", "time"])[0],
-        ).apply(pd.to_numeric)
+            dtype=str,
+            chunksize=settings.IDAWEB_CHUNKSIZE,
+        ) as reader:
+            for chunk_df in reader:
+                # drop rows that correspond to station names in the txt file
+                chunk_df = chunk_df[chunk_df["stn"] != "stn"]
+                value_col = chunk_df.columns.drop(["stn", "time"])[0]
+                idaweb_dfs.append(
+                    chunk_df[["stn", "time"]].assign(
+                        **{value_col: pd.to_numeric(chunk_df[value_col])}
+                    )
+                )
+        idaweb_df = pd.concat(idaweb_dfs)
+        # pivot and set datetime index
+        idaweb_df = idaweb_df.pivot(index="time", columns="stn", values=value_col)
         idaweb_df.index = pd.to_datetime(idaweb_df.index)
 
         return idaweb_df
 
+    @profile_utils.profiled
     def get_vaudair_df(self, key: str, sheet_name: str | None = None) -> pd.DataFrame:
         """Get Vaud'air data frame.
 
@@ -117,20 +246,17 @@ class SpacesClient:
             Vaudair data frame.
 
         """
-        with tempfile.TemporaryDirectory() as tmp_dir:
-            tmp_filepath = path.join(tmp_dir, path.basename(key))
-            with open(tmp_filepath, "wb") as tmp_file:
-                self.client.download_fileobj(self.bucket_name, key, tmp_file)
-            vaudair_df = pd.read_excel(tmp_filepath, index_col=0, sheet_name=sheet_name)
-            if isinstance(vaudair_df, dict):
-                # read multiple sheets
-                vaudair_df = pd.concat(
-                    [df.iloc[2:] for df in vaudair_df.values()],
-                    axis="rows",
-                )
-            else:
-                vaudair_df = vaudair_df.iloc[2:]
-            vaudair_df = vaudair_df.apply(pd.to_numeric, axis=1)
+        vaudair_df = pd.read_excel(self.fetch(key), index_col=0, sheet_name=sheet_name)
+        if isinstance(vaudair_df, dict):
+            # read multiple sheets
+            vaudair_df = pd.concat(
+                [df.iloc[2:] for df in vaudair_df.values()],
+                axis="rows",
+            )
+        else:
+            vaudair_df = vaudair_df.iloc[2:]
+        # convert column-wise
+        vaudair_df = vaudair_df.apply(pd.to_numeric)
         vaudair_df.index = pd.to_datetime(vaudair_df.index.rename("time"))
 
         return vaudair_df
@@ -0,0 +1,333 @@
+"""Profiling utils.
+
+Record the wall time, peak memory, I/O and counts (e.g., of tiles or stations) of the
+pipeline stages, dump them as JSON (one line per run) for each Snakemake rule and
+aggregate them across runs so that regressions show up, i.e.::
+
+    python -m uhi_drivers_lausanne.profile_utils reports/profiles
+
+"""
+
+import argparse
+import contextlib
+import functools
+import glob
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+from collections.abc import Callable, Iterator
+from datetime import datetime
+from os import path
+
+import pandas as pd
+
+from uhi_drivers_lausanne import settings
+
+# `ru_maxrss` is in kilobytes on Linux but in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+# records of the stages run so far in this process
+_records = []
+# stack of the stages being run by each thread, to get the path of nested stages
+_local = threading.local()
+# start of the run, i.e., of the process (or notebook) that imports this module
+_run_start = time.perf_counter()
+_run_start_dt = datetime.now()
+
+
+def _get_max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+
+def _get_io_bytes():
+    # characters read and written by the process (including from/to the network), or
+    # None if the platform does not provide them
+    try:
+        with open("/proc/self/io") as src:
+            io_dict = dict(line.split(": ") for line in src.read().splitlines())
+        return int(io_dict["rchar"]), int(io_dict["wchar"])
+    except OSError:
+        return None, None
+
+
+def _get_stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextlib.contextmanager
+def stage(name: str, **counts) -> Iterator[dict]:
+    """Profile a stage of the pipeline.
+
+    Stages can be nested, in which case the record of the inner stage has the path of
+    the outer stages as prefix (e.g., "cws_qc/run_qc").
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    **counts : int
+        Initial counts of the stage (e.g., of tiles or stations). Counts can also be
+        added while the stage runs with `add_counts`.
+
+    Yields
+    ------
+    record : dict
+        Record of the stage, filled in when the stage exits with its wall time (in
+        seconds), the peak resident set size of the process and its increase during
+        the stage (in bytes) and the bytes read and written by the process (excluding
+        child processes).
+
+    """
+    stack = _get_stack()
+    record = {
+        "name": name,
+        "path": "/".join([_record["name"] for _record in stack] + [name]),
+        "start": datetime.now().isoformat(),
+        "counts": dict(counts),
+    }
+    max_rss_start = _get_max_rss()
+    read_start, written_start = _get_io_bytes()
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["wall_time"] = time.perf_counter() - start
+        stack.pop()
+        max_rss = _get_max_rss()
+        record["max_rss"] = max_rss
+        record["max_rss_increase"] = max_rss - max_rss_start
+        read_end, written_end = _get_io_bytes()
+        if read_start is not None:
+            record["bytes_read"] = read_end - read_start
+            record["bytes_written"] = written_end - written_start
+        _records.append(record)
+
+
+def add_counts(**counts) -> None:
+    """Add counts (e.g., of tiles or stations) to the innermost running stage.
+
+    Counts are ignored if no stage is running in the current thread.
+
+    Parameters
+    ----------
+    **counts : int
+        Counts to add, by name.
+
+    """
+    stack = _get_stack()
+    if stack:
+        stage_counts = stack[-1]["counts"]
+        for key, count in counts.items():
+            stage_counts[key] = stage_counts.get(key, 0) + int(count)
+
+
+def profiled(func: Callable | None = None, *, name: str | None = None) -> Callable:
+    """Decorate a function so that each call is profiled as a stage.
+
+    Parameters
+    ----------
+    func : callable
+        Function to profile.
+    name : str, optional
+        Name of the stage. If None, the qualified name of the function is used.
+
+    Returns
+    -------
+    wrapper : callable
+        Profiled function.
+
+    """
+    if func is None:
+        return functools.partial(profiled, name=name)
+    if name is None:
+        name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def get_records() -> list:
+    """Get the records of the stages run so far in this process.
+
+    Returns
+    -------
+    records : list of dict
+        Records of the stages, in the order in which they finished.
+
+    """
+    return list(_records)
+
+
+def dump(dst_filepath: str, *, rule: str | None = None, **metadata) -> None:
+    """Append the profile of this run to a JSON lines file.
+
+    Parameters
+    ----------
+    dst_filepath : str
+        Path to the JSON lines file, with one profile per run.
+    rule : str, optional
+        Name of the Snakemake rule. If None, the name of the file (without extension)
+        is used.
+    **metadata
+        Additional (JSON-serializable) metadata of the run.
+
+    """
+    if rule is None:
+        rule = path.splitext(path.basename(dst_filepath))[0]
+    bytes_read, bytes_written = _get_io_bytes()
+    run_dict = {
+        "rule": rule,
+        "start": _run_start_dt.isoformat(),
+        "host": socket.gethostname(),
+        "wall_time": time.perf_counter() - _run_start,
+        "max_rss": _get_max_rss(),
+        "bytes_read": bytes_read,
+        "bytes_written": bytes_written,
+        **metadata,
+        "stages": get_records(),
+    }
+    if dirname := path.dirname(dst_filepath):
+        os.makedirs(dirname, exist_ok=True)
+    with open(dst_filepath, "a") as dst:
+        dst.write(json.dumps(run_dict) + "\n")
+
+
+def get_profile_df(profile_dir: str) -> pd.DataFrame:
+    """Get a data frame of the profiles of all the runs and stages.
+
+    Parameters
+    ----------
+    profile_dir : str
+        Directory with the JSON lines files dumped by `dump`.
+
+    Returns
+    -------
+    profile_df : pandas.DataFrame
+        Data frame with a row for each run of each rule and stage (the whole run is
+        the "total" stage), with its wall time, peak resident set size, bytes read and
+        written and counts. Repeated calls of a stage within a run are aggregated.
+
+    """
+    rows = []
+    for profile_filepath in sorted(glob.glob(path.join(profile_dir, "*.jsonl"))):
+        with open(profile_filepath) as src:
+            for line in src:
+                run_dict = json.loads(line)
+                stage_dicts = [dict(run_dict, path="total", counts={})] + run_dict[
+                    "stages"
+                ]
+                for stage_dict in stage_dicts:
+                    rows.append(
+                        {
+                            "rule": run_dict["rule"],
+                            "run": run_dict["start"],
+                            "stage": stage_dict["path"],
+                            "calls": 1,
+                            "wall_time": stage_dict["wall_time"],
+                            "max_rss": stage_dict["max_rss"],
+                            "bytes_read": stage_dict.get("bytes_read"),
+                            "bytes_written": stage_dict.get("bytes_written"),
+                            **stage_dict["counts"],
+                        }
+                    )
+    profile_df = pd.DataFrame(rows)
+    if profile_df.empty:
+        return profile_df
+    agg_dict = {
+        column: "max" if column == "max_rss" else "sum"
+        for column in profile_df.columns.drop(["rule", "run", "stage"])
+    }
+    # runs are identified by their (ISO format) start, so they are sorted
+    # chronologically
+    return profile_df.groupby(["rule", "stage", "run"]).agg(agg_dict)
+
+
+def get_report_df(
+    profile_dir: str, *, regression_threshold: float | None = None
+) -> pd.DataFrame:
+    """Compare the last run of each rule and stage with the previous runs.
+
+    Parameters
+    ----------
+    profile_dir : str
+        Directory with the JSON lines files dumped by `dump`.
+    regression_threshold : numeric, optional
+        Ratio between the wall time (or peak resident set size) of the last run and
+        the median of the previous runs above which the stage is flagged as a
+        regression. If None, the value from `settings.PROFILE_REGRESSION_THRESHOLD` is
+        used.
+
+    Returns
+    -------
+    report_df : pandas.DataFrame
+        Data frame with a row for each rule and stage, with the number of runs, the
+        wall time and peak resident set size of the last run, their ratio to the median
+        of the previous runs and whether it is a regression.
+
+    """
+    if regression_threshold is None:
+        regression_threshold = settings.PROFILE_REGRESSION_THRESHOLD
+
+    def _get_stage_report(stage_df):
+        last_ser = stage_df.iloc[-1]
+        previous_df = stage_df.iloc[:-1]
+        report_ser = pd.Series(
+            {
+                "runs": len(stage_df),
+                "calls": last_ser["calls"],
+                "wall_time": last_ser["wall_time"],
+                "wall_time_ratio": last_ser["wall_time"]
+                / previous_df["wall_time"].median(),
+                "max_rss": last_ser["max_rss"],
+                "max_rss_ratio": last_ser["max_rss"] / previous_df["max_rss"].median(),
+            }
+        )
+        report_ser["regression"] = (
+            report_ser[["wall_time_ratio", "max_rss_ratio"]] > regression_threshold
+        ).any()
+        return report_ser
+
+    profile_df = get_profile_df(profile_dir)
+    if profile_df.empty:
+        return profile_df
+    return (
+        profile_df.groupby(level=["rule", "stage"])
+        .apply(_get_stage_report)
+        .astype({"runs": int, "calls": int, "regression": bool})
+    )
+
+
+def main(argv: list | None = None) -> None:
+    """Print the profile report of the pipeline runs."""
+    parser = argparse.ArgumentParser(
+        description="Aggregate the profiles of the pipeline runs and flag regressions."
+    )
+    parser.add_argument("profile_dir", help="directory with the profiles (JSON lines)")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=None,
+        help="ratio to the median of the previous runs flagged as a regression",
+    )
+    args = parser.parse_args(argv)
+    report_df = get_report_df(args.profile_dir, regression_threshold=args.threshold)
+    if report_df.empty:
+        print(f"No profiles found in {args.profile_dir}.")
+        return
+    with pd.option_context("display.max_rows", None, "display.width", None):
+        print(report_df)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,24 @@
 """Regression features."""
 
+import itertools
+import os
+from concurrent import futures
+from os import path
+
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+
+from uhi_drivers_lausanne import feature_utils, profile_utils, settings, ts_utils
 
 
 def get_station_features_gdf(
     stations_gdf_filepath: str,
-    features_filepaths: list,
+    features_filepaths: list | None = None,
     *,
+    feature_store: feature_utils.FeatureStore | None = None,
+    families: list | None = None,
     fillna: float | bool = 0,
 ) -> gpd.GeoDataFrame:
     """Get station features geo-data frame.
@@ -16,9 +27,15 @@ def get_station_features_gdf(
     ----------
     stations_gdf_filepath : str
         Path to stations geo-data frame.
-    features_filepaths : list of str
+    features_filepaths : list of str, optional
         List of paths to features data frames, with a common index column with the
-        stations geo-data frame.
+        stations geo-data frame. Ignored if `feature_store` is provided.
+    feature_store : feature_utils.FeatureStore, optional
+        Feature store from which the features are read instead of
+        `features_filepaths`.
+    families : list of str, optional
+        Feature families read from `feature_store`. If None, all the families in the
+        store are read.
     fillna : float or bool, default 0
         Value to replace NaNs with, by default 0. A value of False will not replace
         NaNs.
@@ -31,97 +48,389 @@ def get_station_features_gdf(
     """
     station_features_gdf = gpd.read_file(stations_gdf_filepath)
     station_index_name = station_features_gdf.columns.drop("geometry")[0]
-    # stations_gdf = stations_gdf.set_index(station_index_name)
-    station_features_gdf = pd.concat(
-        [
-            station_features_gdf.set_index(station_index_name),
+    station_features_gdf = station_features_gdf.set_index(station_index_name)
+    if feature_store is not None:
+        features_dfs = [
+            feature_store.get_features_df(station_features_gdf.index, families=families)
         ]
-        + [
+    else:
+        features_dfs = [
             pd.read_csv(features_filepath).set_index(station_index_name)
             for features_filepath in features_filepaths
-        ],
-        axis="columns",
+        ]
+    station_features_gdf = pd.concat(
+        [station_features_gdf] + features_dfs, axis="columns"
     )
     if fillna is not False:
         station_features_gdf = station_features_gdf.fillna(fillna)
     return station_features_gdf
 
 
-def _read_and_resample(
-    ts_df_filepath: str,
-    *,
-    start_dt: str | None = None,
-    end_dt: str | None = None,
-) -> pd.DataFrame:
-    """Read time series data frame and resample to hourly frequency.
+# number of nanoseconds in an hour, to floor integer timestamps to hours
+_HOUR_NS = 3_600_000_000_000
 
-    Parameters
-    ----------
-    ts_df_filepath : str
-        Path to time series data frame.
-    start_dt : str, optional
-        Start date and time, by default None (does not filter data)
-    end_dt : str, optional
-        End date and time, by default None (does not filter data)
 
+def _get_window_value(dt, tz):
+    """Get the integer nanoseconds of a window bound for data in the time zone `tz`."""
+    dt = pd.Timestamp(dt)
+    if tz is None:
+        # the integer timestamps of naive data are their wall times, so tz-aware
+        # bounds are taken in UTC
+        if dt.tz is not None:
+            dt = dt.tz_convert(None)
+    elif dt.tz is None:
+        dt = dt.tz_localize(tz)
+    return dt.value
 
-    Returns
-    -------
-    ts_df : pd.DataFrame
-        Time series data frame resampled to hourly frequency.
 
+def _get_window_hours(start_dt, end_dt, tz):
+    """Get the first and last hour (since the epoch) within the time window.
+
+    Naive bounds are interpreted in the time zone `tz` of the data, as in the slicing
+    of a `DatetimeIndex`.
     """
-    ts_df = pd.read_csv(ts_df_filepath)
-    ts_df["time"] = pd.to_datetime(ts_df["time"])
-    ts_df = ts_df.set_index("time").resample("H").mean()
+    # string bounds are treated as periods (e.g., "2023-08-15" ends at 23:59:59), as in
+    # the partial string slicing of a `DatetimeIndex`
+    first_hour, last_hour = None, None
     if start_dt is not None:
-        ts_df = ts_df.loc[start_dt:]
+        if isinstance(start_dt, str):
+            start_dt = pd.Period(start_dt).start_time
+        first_hour = -(-_get_window_value(start_dt, tz) // _HOUR_NS)
     if end_dt is not None:
-        ts_df = ts_df.loc[:end_dt]
-    return ts_df
+        if isinstance(end_dt, str):
+            end_dt = pd.Period(end_dt).end_time
+        last_hour = _get_window_value(end_dt, tz) // _HOUR_NS
+    return first_hour, last_hour
+
+
+def _get_hourly_sums(hours, station_codes, sums, counts, num_stations):
+    """Aggregate sums and counts by hour and station, sorted by hour and station.
+
+    Hours and station codes are broadcast against each other, so that wide arrays (a
+    row per timestamp and a column per station) can be aggregated without melting
+    them. Counts of None mean that each value counts once.
+    """
+    if np.size(hours) == 0:
+        return (
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=np.int64),
+            *np.zeros((2, 0)),
+        )
+    first_hour = hours.min()
+    keys = np.ravel((hours - first_hour) * num_stations + station_codes)
+    minlength = (hours.max() - first_hour + 1) * num_stations
+    hourly_sums = np.bincount(keys, weights=np.ravel(sums), minlength=minlength)
+    hourly_counts = np.bincount(
+        keys, weights=None if counts is None else np.ravel(counts), minlength=minlength
+    )
+    del keys
+    (keys,) = np.nonzero(hourly_counts)
+    return (
+        keys // num_stations + first_hour,
+        keys % num_stations,
+        hourly_sums[keys],
+        hourly_counts[keys],
+    )
+
+
+def _get_time_values(times):
+    """Get the integer (UTC) nanoseconds and the time zone of a datetime series."""
+    times = pd.DatetimeIndex(times)
+    return times.asi8, times.tz
+
+
+def _read_hourly_csv(ts_df_filepath, start_dt, end_dt, chunksize):
+    """Read the hourly means of a wide CSV file, aggregating it chunk by chunk."""
+    partial_sums = []
+    stations = None
+    tz = None
+    for chunk_df in pd.read_csv(ts_df_filepath, chunksize=chunksize):
+        times, tz = _get_time_values(pd.to_datetime(chunk_df["time"]))
+        if stations is None:
+            stations = chunk_df.columns.drop("time").to_numpy(dtype=object)
+            # the time zone of the data is only known once the first chunk is parsed
+            first_hour, last_hour = _get_window_hours(start_dt, end_dt, tz)
+        # filter the time window while reading (`NaT` is the minimum integer)
+        hours = times // _HOUR_NS
+        in_window = times != pd.NaT.value
+        if first_hour is not None:
+            in_window &= hours >= first_hour
+        if last_hour is not None:
+            in_window &= hours <= last_hour
+        values = chunk_df[stations].to_numpy(dtype=float)[in_window]
+        del chunk_df
+        # aggregate the (wide) chunk by hour and station, so that only the (much
+        # smaller) partial sums of the valid values are melted and kept
+        valid = ~np.isnan(values)
+        partial_sums.append(
+            _get_hourly_sums(
+                hours[in_window, np.newaxis],
+                np.arange(len(stations)),
+                np.where(valid, values, 0),
+                valid,
+                len(stations),
+            )
+        )
+    if stations is None:
+        stations = np.array([], dtype=object)
+    # hours may span several chunks, so the partial sums are aggregated again
+    return (
+        *_get_hourly_sums(
+            *[np.concatenate(arrs) for arrs in zip(*partial_sums)], len(stations)
+        ),
+        stations,
+        tz,
+    )
+
+
+def _read_hourly_parquet(ts_df_filepath, start_dt, end_dt):
+    """Read the hourly means of a Parquet dataset written by `ts_utils.write_ts_df`."""
+    tz = (
+        ds.dataset(ts_df_filepath, format="parquet", partitioning=ts_utils.PARTITIONING)
+        .schema.field(ts_utils.time_col)
+        .type.tz
+    )
+    first_hour, last_hour = _get_window_hours(start_dt, end_dt, tz)
+
+    def get_timestamp(value):
+        # bound in the time zone of the data, so that the month partitions are also
+        # filtered in its time zone
+        if tz is None:
+            return pd.Timestamp(value)
+        return pd.Timestamp(value, tz="UTC").tz_convert(tz)
+
+    ts_df = ts_utils.read_ts_df(
+        ts_df_filepath,
+        start_dt=None if first_hour is None else get_timestamp(first_hour * _HOUR_NS),
+        end_dt=None
+        if last_hour is None
+        else get_timestamp((last_hour + 1) * _HOUR_NS - 1),
+        columns=[ts_utils.time_col, ts_utils.station_col, "T"],
+    )
+    stations = (
+        ts_df[ts_utils.station_col].cat.categories.astype(str).to_numpy(dtype=object)
+    )
+    times, tz = _get_time_values(ts_df[ts_utils.time_col])
+    station_codes = ts_df[ts_utils.station_col].cat.codes.to_numpy(dtype=np.int64)
+    values = ts_df["T"].to_numpy(dtype=float)
+    del ts_df
+    valid = ~np.isnan(values)
+    times, station_codes, values = times[valid], station_codes[valid], values[valid]
+    # duplicated time-station pairs (if any) are first averaged, as in
+    # `ts_utils.read_wide_ts_df`. Pairs are keyed by the rank of their time, which is
+    # cheap to get since the datasets are sorted by time
+    sorted_times = times[np.argsort(times, kind="stable")]
+    is_new_time = np.diff(sorted_times, prepend=sorted_times[:1] - 1) != 0
+    unique_times = sorted_times[is_new_time]
+    pair_keys = np.searchsorted(unique_times, times) * len(stations) + station_codes
+    if (np.diff(np.sort(pair_keys)) == 0).any():
+        pair_keys, pair_codes = np.unique(pair_keys, return_inverse=True)
+        values = np.bincount(pair_codes, weights=values) / np.bincount(pair_codes)
+        times = unique_times[pair_keys // len(stations)]
+        station_codes = pair_keys % len(stations)
+    return (
+        *_get_hourly_sums(
+            times // _HOUR_NS,
+            station_codes,
+            values,
+            None,
+            len(stations),
+        ),
+        stations,
+        tz,
+    )
+
+
+def _read_hourly(ts_df_filepath, start_dt, end_dt, chunksize):
+    """Read the hourly means (by station) of a time series file within a window.
 
+    Naive bounds of the window are interpreted in the time zone of the file.
 
+    Returns
+    -------
+    hours, station_codes, means : numpy.ndarray
+        Hour (since the epoch) and station code of each non-NaN hourly mean, sorted by
+        hour and station.
+    stations : numpy.ndarray
+        Station ids, in the order of the columns of the wide time series.
+    tz : datetime.tzinfo or None
+        Time zone of the timestamps.
+
+    """
+    if path.splitext(ts_df_filepath)[1] == ".csv":
+        hours, station_codes, sums, counts, stations, tz = _read_hourly_csv(
+            ts_df_filepath, start_dt, end_dt, chunksize
+        )
+    else:
+        hours, station_codes, sums, counts, stations, tz = _read_hourly_parquet(
+            ts_df_filepath, start_dt, end_dt
+        )
+    return hours, station_codes, sums / counts, stations, tz
+
+
+@profile_utils.profiled
 def get_long_ts_df(
     ts_df_filepaths: list[str],
     station_index_name: str,
     *,
     start_dt: str | None = None,
     end_dt: str | None = None,
+    chunksize: int | None = None,
+    max_workers: int | None = None,
 ) -> pd.DataFrame:
-    """Get time series data frame in long format.
+    """Get hourly time series data frame in long format.
+
+    The time window is filtered while reading, the hourly means are computed by
+    flooring the integer timestamps to hours and aggregating the sums and counts with
+    `numpy.bincount`, and the means are written directly into preallocated long-format
+    arrays, so that neither the full wide data frame nor its stacked copies are
+    materialized. Files are processed in parallel.
 
     Parameters
     ----------
     ts_df_filepaths : list of str
-        Paths to time series data frame (in wide format).
+        Paths to time series data frame, either CSV files (in wide format) or Parquet
+        datasets as written by `ts_utils.write_ts_df`.
     station_index_name : str
         Name of the column in the time series data frame that contains the station
         index.
     start_dt : str, optional
-        Start date and time, by default None (does not filter data)
+        Start date and time, by default None (does not filter data). If naive, it is
+        interpreted in the time zone of each file.
     end_dt : str, optional
-        End date and time, by default None (does not filter data)
+        End date and time, by default None (does not filter data). If naive, it is
+        interpreted in the time zone of each file.
+    chunksize : int, optional
+        Number of rows of the CSV files parsed at once. If None, the value from
+        `settings.TS_CSV_CHUNKSIZE` is used.
+    max_workers : int, optional
+        Maximum number of processes used to read the files. If None, it will default
+        to the number of files (bounded by the number of processors on the machine).
 
     Returns
     -------
     ts_df : pd.DataFrame
-        Time series data frame in long format.
+        Time series data frame in long format, with the hourly mean temperature ("T")
+        of each station and hour (rows are sorted by hour and station within each
+        file). Station-hours without measurements are dropped.
 
     """
-    #
-    return pd.concat(
-        [
-            _read_and_resample(ts_df_filepath, start_dt=start_dt, end_dt=end_dt)
-            .stack(dropna=True)
-            .rename_axis(["time", station_index_name])
-            .reset_index(name="T")
-            for ts_df_filepath in ts_df_filepaths
-        ],
-        axis="rows",
+    if chunksize is None:
+        chunksize = settings.TS_CSV_CHUNKSIZE
+    if max_workers is None:
+        max_workers = min(len(ts_df_filepaths), os.cpu_count())
+
+    # parsing is CPU-bound, so each file is read in its own process, which only sends
+    # back the (much smaller) hourly means
+    with futures.ProcessPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        results = list(
+            executor.map(
+                _read_hourly,
+                ts_df_filepaths,
+                itertools.repeat(start_dt),
+                itertools.repeat(end_dt),
+                itertools.repeat(chunksize),
+            )
+        )
+
+    # fill the preallocated long-format arrays file by file, keeping the index of each
+    # file (as when concatenating the data frame of each file)
+    num_rows = sum(len(result[0]) for result in results)
+    profile_utils.add_counts(files=len(ts_df_filepaths), rows=num_rows)
+    time_arr = np.empty(num_rows, dtype=np.int64)
+    station_arr = np.empty(num_rows, dtype=object)
+    value_arr = np.empty(num_rows)
+    index_arr = np.empty(num_rows, dtype=np.int64)
+    tz = None
+    start = 0
+    for hours, station_codes, means, stations, file_tz in results:
+        end = start + len(hours)
+        np.multiply(hours, _HOUR_NS, out=time_arr[start:end])
+        station_arr[start:end] = stations[station_codes]
+        value_arr[start:end] = means
+        index_arr[start:end] = np.arange(len(hours))
+        tz = tz or file_tz
+        start = end
+
+    time_index = pd.DatetimeIndex(time_arr.view("datetime64[ns]"))
+    if tz is not None:
+        time_index = time_index.tz_localize("UTC").tz_convert(tz)
+    return pd.DataFrame(
+        {"time": time_index, station_index_name: station_arr, "T": value_arr},
+        index=index_arr,
     )
 
 
-def get_uhi_df(ts_df: pd.DataFrame) -> pd.DataFrame:
+def get_uhi_ser(
+    ts_df: pd.DataFrame,
+    *,
+    reference: str = "min",
+    rural_stations: list | None = None,
+    q: float | None = None,
+    by: str | list | None = None,
+    station_col: str = "station_id",
+) -> pd.Series:
+    """Get urban heat island (UHI) series.
+
+    Obtain the UHI magnitude at each station and timestamp by subtracting a reference
+    temperature at each timestamp from the temperature at each station and timestamp.
+
+    Parameters
+    ----------
+    ts_df : pd.DataFrame
+        Time series data frame in long format.
+    reference : {"min", "rural", "percentile"}, default "min"
+        Reference temperature at each timestamp, i.e., the minimum temperature, the
+        mean temperature of the stations in `rural_stations` or the `q` quantile of the
+        temperatures.
+    rural_stations : list, optional
+        Stations used as reference. Required if `reference` is "rural".
+    q : float, optional
+        Quantile (from 0 to 1) used as reference. Required if `reference` is
+        "percentile".
+    by : str or list of str, optional
+        Additional column(s) of `ts_df` by which the reference is computed separately,
+        e.g., "source" to get the UHI of each source with respect to its own stations.
+    station_col : str, default "station_id"
+        Column of `ts_df` with the station ids. Only used if `reference` is "rural".
+
+    Returns
+    -------
+    uhi_ser : pd.Series
+        Urban heat island series, aligned with `ts_df`.
+
+    """
+    if by is None:
+        by = []
+    elif isinstance(by, str):
+        by = [by]
+    keys = ["time"] + by
+    if reference == "min":
+        reference_ser = ts_df.groupby(keys)["T"].transform("min")
+    elif reference == "rural":
+        if rural_stations is None:
+            raise ValueError("`rural_stations` must be provided for a rural reference.")
+        # NaN temperatures outside the rural stations so that they are ignored by the
+        # mean, and then broadcast the rural mean to all the stations of the group
+        reference_ser = (
+            ts_df["T"]
+            .where(ts_df[station_col].isin(rural_stations))
+            .groupby([ts_df[key] for key in keys])
+            .transform("mean")
+        )
+    elif reference == "percentile":
+        if q is None:
+            raise ValueError("`q` must be provided for a percentile reference.")
+        reference_ser = ts_df.groupby(keys)["T"].transform("quantile", q)
+    else:
+        raise ValueError(
+            f"Unknown reference: {reference}. Must be one of 'min', 'rural' or "
+            "'percentile'."
+        )
+    return (ts_df["T"] - reference_ser).rename("UHI")
+
+
+def get_uhi_df(ts_df: pd.DataFrame, **get_uhi_ser_kws) -> pd.DataFrame:
     """Get urban heat island (UHI) data frame.
 
     Obtain the UHI magnitude at each station and timestamp by subtracting the minimum
@@ -131,21 +440,20 @@ def get_uhi_df(ts_df: pd.DataFrame) -> pd.DataFrame:
     ----------
     ts_df : pd.DataFrame
         Time series data frame in long format.
+    **get_uhi_ser_kws
+        Keyword arguments to pass to `get_uhi_ser`, e.g., to use another reference
+        temperature or compute it separately by source.
 
     Returns
     -------
     uhi_df : pd.DataFrame
-        Urban heat island data frame.
+        Urban heat island data frame, sorted by time.
 
     """
-    return (
-        ts_df.drop("time", axis="columns")
-        .groupby(ts_df["time"])
-        .apply(
-            lambda group_df: group_df.assign(
-                **{"UHI": group_df["T"] - group_df["T"].min()}
-            ).drop("T", axis="columns")
-        )
-        .droplevel(-1)
-        .reset_index()
+    uhi_df = ts_df.assign(UHI=get_uhi_ser(ts_df, **get_uhi_ser_kws)).drop(
+        "T", axis="columns"
     )
+    # rows are sorted by time (preserving the original order within each timestamp) and
+    # rows without time are dropped, as in a `groupby` by time
+    uhi_df = uhi_df[uhi_df["time"].notna()].sort_values(by="time", kind="stable")
+    return uhi_df[["time"] + list(uhi_df.columns.drop("time"))].reset_index(drop=True)
@@ -6,3 +6,48 @@ STATION_OUTLIER_THRESHOLD = 0.2
 STATION_INDOOR_CORR_THRESHOLD = 0.9
 ATMOSPHERIC_LAPSE_RATE = 0.0065
 UNRELIABLE_THRESHOLD = 0.2
+QC_CHUNKSIZE = 1024
+BUDDY_RADIUS = 1000  # in units of the station CRS, e.g., meters
+BUDDY_MIN_NEIGHBORS = 3
+BUDDY_Z_THRESHOLD = 3
+BUDDY_MIN_SCALE = 0.5
+STATION_BUDDY_THRESHOLD = 0.2
+
+# time series
+TS_CSV_CHUNKSIZE = 10_000  # number of CSV rows parsed at once
+
+# LiDAR
+LIDAR_CHUNKSIZE = 1_000_000  # number of points read at once
+
+# buildings
+BLDG_CHUNKSIZE = 256  # number of stations processed at once
+
+# distance rasters
+DISTANCE_RES = 10  # in units of the CRS, e.g., meters
+
+# grid mode
+GRID_CHUNKSIZE = 128  # side (in cells) of the chunks processed at once
+
+# S3 (Spaces)
+SPACES_MAX_CONNECTIONS = 10
+SPACES_MULTIPART_CHUNKSIZE = 8 * 2**20  # 8 MiB
+IDAWEB_CHUNKSIZE = 100_000  # number of rows parsed at once
+
+# Netatmo API
+NETATMO_API_URL = "https://api.netatmo.com/api"
+NETATMO_TOKEN_URL = "https://api.netatmo.com/oauth2/token"
+NETATMO_RATE = 500 / 3600  # requests per second (user limit of 500 per hour)
+NETATMO_BURST = 50  # requests sent at once (user limit of 50 per 10 seconds)
+NETATMO_MAX_CONCURRENCY = 8  # number of requests in flight
+NETATMO_MAX_RETRIES = 5
+NETATMO_BACKOFF = 1  # in seconds, doubled at each retry
+
+# cache of remote assets
+ASSET_CACHE_DIR = "data/cache"
+ASSET_CACHE_MAX_SIZE = 50 * 2**30  # 50 GiB
+# seconds since the last access before an asset can be evicted
+ASSET_CACHE_MIN_AGE = 3600
+
+# profiling
+# ratio to the median of the previous runs above which a stage is flagged as regression
+PROFILE_REGRESSION_THRESHOLD = 1.25
@@ -1,9 +1,26 @@
 """STAC utils."""
+import contextlib
+import fcntl
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
 import warnings
+from concurrent import futures
+from os import path
+from urllib import request
 
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import pystac_client
-from shapely import geometry
+import rasterio as rio
+from rasterio import windows
+from shapely import geometry, wkt
+
+from uhi_drivers_lausanne import profile_utils, settings
 
 CLIENT_URL = "https://data.geo.admin.ch/api/stac/v0.9"
 # CLIENT_CRS = "EPSG:4326"  # CRS used by the client
@@ -18,18 +35,154 @@ SWISSALTI3D_CRS = "EPSG:2056"
 SWISSALTI3D_NODATA = -9999
 
 
+@contextlib.contextmanager
+def _file_lock(lock_filepath):
+    """Hold an exclusive (inter-process) lock on a file."""
+    with open(lock_filepath, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 class SwissTopoClient:
     """swisstopo client."""
 
-    def __init__(self):
-        """Initialize a swisstopo client."""
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            client = pystac_client.Client.open(CLIENT_URL)
-        client.add_conforms_to("ITEM_SEARCH")
-        client.add_conforms_to("COLLECTIONS")
-        self._client = client
+    def __init__(self, *, index_dir: str | None = None, offline: bool = False):
+        """Initialize a swisstopo client.
+
+        Parameters
+        ----------
+        index_dir : str, optional
+            Directory where the items found for each collection and datetime are
+            stored (as GeoParquet) so that later queries within the extents already
+            searched are answered locally. If None, every query is sent to the STAC
+            API.
+        offline : bool, default False
+            Whether to answer queries from the item index in `index_dir` only, without
+            ever connecting to the STAC API.
+
+        """
+        if offline and index_dir is None:
+            raise ValueError("An `index_dir` must be provided in offline mode.")
+        self.index_dir = index_dir
+        self.offline = offline
+        # the client is opened lazily so that queries answered from the item index do
+        # not pay its startup cost
+        self._client = None
+
+    @property
+    def client(self) -> pystac_client.Client:
+        """STAC API client."""
+        if self._client is None:
+            if self.offline:
+                raise ValueError("Cannot connect to the STAC API in offline mode.")
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                client = pystac_client.Client.open(CLIENT_URL)
+            client.add_conforms_to("ITEM_SEARCH")
+            client.add_conforms_to("COLLECTIONS")
+            self._client = client
+        return self._client
+
+    def _search(self, collection, extent_geom, datetime, collection_extents_crs):
+        search = self.client.search(
+            collections=[collection], intersects=extent_geom, datetime=datetime
+        )
+        return gpd.GeoDataFrame(
+            [
+                (
+                    item.id,
+                    [asset.href for asset in item.assets.values()],
+                    geometry.box(*item.bbox),
+                )
+                # iterate over the result pages so that items are not all requested
+                # up front
+                for page in search.pages()
+                for item in page
+            ],
+            crs=collection_extents_crs,
+            columns=["id", "hrefs", "geometry"],
+        )
+
+    def _get_indexed_items(
+        self, collection, extent_geom, datetime, collection_extents_crs
+    ):
+        index_filepath = path.join(
+            self.index_dir, f"{collection}_{datetime.replace('/', '-')}.parquet"
+        )
+        # the extent searched so far is stored along with the index (None means that
+        # the whole collection has been searched)
+        extent_filepath = f"{index_filepath}.extent"
 
+        def _read_index():
+            if not path.exists(index_filepath):
+                return None, geometry.GeometryCollection()
+            item_gdf = gpd.read_parquet(index_filepath)
+            with open(extent_filepath) as src:
+                extent_wkt = src.read()
+            return item_gdf, wkt.loads(extent_wkt) if extent_wkt else None
+
+        def _query(item_gdf):
+            if extent_geom is None:
+                return item_gdf
+            return item_gdf.iloc[
+                sorted(item_gdf.sindex.query(extent_geom, predicate="intersects"))
+            ]
+
+        item_gdf, searched_geom = _read_index()
+        if searched_geom is None or (
+            extent_geom is not None and searched_geom.contains(extent_geom)
+        ):
+            return _query(item_gdf)
+        if self.offline:
+            raise ValueError(
+                f"The item index of {collection} ({datetime}) does not cover the "
+                "queried extent."
+            )
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        with _file_lock(f"{index_filepath}.lock"):
+            # another process may have updated the index while we waited
+            item_gdf, searched_geom = _read_index()
+            if searched_geom is not None and (
+                extent_geom is None or not searched_geom.contains(extent_geom)
+            ):
+                if collection_extents_crs is None:
+                    collection_extents_crs = (
+                        item_gdf.crs
+                        if item_gdf is not None
+                        else self.client.get_collection(collection).extra_fields["crs"][
+                            0
+                        ]
+                    )
+                # only search the part of the extent that has not been searched yet
+                new_item_gdf = self._search(
+                    collection,
+                    None
+                    if extent_geom is None
+                    else extent_geom.difference(searched_geom),
+                    datetime,
+                    collection_extents_crs,
+                )
+                if item_gdf is not None:
+                    new_item_gdf = pd.concat(
+                        [item_gdf, new_item_gdf], ignore_index=True
+                    ).drop_duplicates(subset="id")
+                item_gdf = new_item_gdf.reset_index(drop=True)
+                searched_geom = (
+                    None if extent_geom is None else searched_geom.union(extent_geom)
+                )
+                # write atomically so that readers never see a partial index
+                item_gdf.to_parquet(f"{index_filepath}.tmp")
+                with open(f"{extent_filepath}.tmp", "w") as dst:
+                    dst.write("" if searched_geom is None else searched_geom.wkt)
+                os.replace(f"{extent_filepath}.tmp", extent_filepath)
+                os.replace(f"{index_filepath}.tmp", index_filepath)
+        return _query(item_gdf)
+
+    @profile_utils.profiled
     def gdf_from_collection(
         self,
         collection,
@@ -41,28 +194,402 @@ class SwissTopoClient:
     ):
         """Get geo-data frame of tiles of a collection."""
 
-        def _get_url(item):
-            return [
-                href for href in item.assets.values() if href.href.endswith(extension)
-            ][0].href
+        def _get_url(hrefs):
+            return [href for href in hrefs if href.endswith(extension)][0]
 
-        if collection_extents_crs is None:
-            collection_extents_crs = self._client.get_collection(
-                collection
-            ).extra_fields["crs"][0]
-        search = self._client.search(
-            collections=[collection], intersects=extent_geom, datetime=datetime
-        )
+        if self.index_dir is None:
+            if collection_extents_crs is None:
+                collection_extents_crs = self.client.get_collection(
+                    collection
+                ).extra_fields["crs"][0]
+            item_gdf = self._search(
+                collection, extent_geom, datetime, collection_extents_crs
+            )
+        else:
+            item_gdf = self._get_indexed_items(
+                collection, extent_geom, datetime, collection_extents_crs
+            )
 
         # return pd.DataFrame(
         #     [(get_tif(item), str(item.bbox)) for item in list(search.items())],
         #     columns=[f"{collection}_filepath", "geometry"],
         # )
         return gpd.GeoDataFrame(
-            [
-                (_get_url(item), geometry.box(*item.bbox))
-                for item in list(search.items())
-            ],
-            crs=collection_extents_crs,
-            columns=[collection, "geometry"],
+            {
+                collection: [_get_url(hrefs) for hrefs in item_gdf["hrefs"]],
+                "geometry": item_gdf["geometry"].values,
+            },
+            crs=item_gdf.crs,
+        )
+
+
+class AssetCache:
+    """Content-addressed on-disk cache of remote assets.
+
+    Assets are stored under the SHA-256 digest of their content and indexed by URL
+    (and ETag) in a SQLite database, so that repeated requests for an URL are served
+    from disk without any network I/O. The least recently used assets are evicted
+    once the total size exceeds `max_size`. Downloads are written atomically and
+    guarded by file locks, so that the cache can be shared by concurrent processes
+    (e.g., parallel Snakemake jobs).
+    """
+
+    def __init__(
+        self, cache_dir: str | None = None, *, max_size: int | None = None
+    ) -> None:
+        """Initialize the cache.
+
+        Parameters
+        ----------
+        cache_dir : str, optional
+            Directory of the cache, created if it does not exist. If None, the value
+            from `settings.ASSET_CACHE_DIR` is used.
+        max_size : int, optional
+            Maximum size of the cache (in bytes). If None, the value from
+            `settings.ASSET_CACHE_MAX_SIZE` is used.
+
+        """
+        if cache_dir is None:
+            cache_dir = settings.ASSET_CACHE_DIR
+        if max_size is None:
+            max_size = settings.ASSET_CACHE_MAX_SIZE
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        for dir_name in ["blobs", "locks", "tmp"]:
+            os.makedirs(path.join(cache_dir, dir_name), exist_ok=True)
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS assets (url TEXT PRIMARY KEY, etag TEXT, "
+                "digest TEXT NOT NULL, size INTEGER NOT NULL, "
+                "last_access REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return contextlib.closing(
+            sqlite3.connect(path.join(self.cache_dir, "index.db"), timeout=60)
         )
+
+    def _lock(self, name):
+        return _file_lock(path.join(self.cache_dir, "locks", f"{name}.lock"))
+
+    def _get_blob_filepath(self, digest):
+        return path.join(self.cache_dir, "blobs", digest[:2], digest)
+
+    def _lookup(self, url):
+        with self._connect() as con, con:
+            row = con.execute(
+                "SELECT etag, digest FROM assets WHERE url = ?", (url,)
+            ).fetchone()
+            if row is not None:
+                con.execute(
+                    "UPDATE assets SET last_access = ? WHERE url = ?",
+                    (time.time(), url),
+                )
+        return row
+
+    def _download(self, url):
+        with tempfile.NamedTemporaryFile(
+            dir=path.join(self.cache_dir, "tmp"), delete=False
+        ) as dst:
+            try:
+                with request.urlopen(url) as src:
+                    sha256 = hashlib.sha256()
+                    while chunk := src.read(shutil.COPY_BUFSIZE):
+                        sha256.update(chunk)
+                        dst.write(chunk)
+                    etag = src.headers.get("ETag")
+            except BaseException:
+                os.remove(dst.name)
+                raise
+        digest = sha256.hexdigest()
+        blob_filepath = self._get_blob_filepath(digest)
+        os.makedirs(path.dirname(blob_filepath), exist_ok=True)
+        # atomic, so that other processes never see a partially written asset
+        os.replace(dst.name, blob_filepath)
+        with self._connect() as con, con:
+            con.execute(
+                "INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?)",
+                (url, etag, digest, os.path.getsize(blob_filepath), time.time()),
+            )
+        return digest
+
+    def _get_etag(self, url):
+        with request.urlopen(request.Request(url, method="HEAD")) as response:
+            return response.headers.get("ETag")
+
+    def get(self, url: str, *, revalidate: bool = False) -> str:
+        """Get the local path of an asset, downloading it if it is not cached.
+
+        Parameters
+        ----------
+        url : str
+            URL of the asset.
+        revalidate : bool, default False
+            Whether to check (with a HEAD request) that the ETag of the cached asset
+            still matches the remote one, and download it again otherwise. If False,
+            cached assets are served without any network I/O.
+
+        Returns
+        -------
+        filepath : str
+            Local path of the asset.
+
+        """
+        row = self._lookup(url)
+        # the blob may have been evicted by another process since it was indexed, in
+        # which case it is downloaded again
+        if (
+            row is not None
+            and path.exists(self._get_blob_filepath(row[1]))
+            and (not revalidate or self._get_etag(url) == row[0])
+        ):
+            self.hits += 1
+            return self._get_blob_filepath(row[1])
+
+        # lock the url so that concurrent processes do not download the same asset
+        with self._lock(hashlib.sha256(url.encode()).hexdigest()):
+            # another process may have downloaded the asset while we waited
+            _row = self._lookup(url)
+            if (
+                _row is not None
+                and _row != row
+                and path.exists(self._get_blob_filepath(_row[1]))
+            ):
+                self.hits += 1
+                return self._get_blob_filepath(_row[1])
+            self.misses += 1
+            digest = self._download(url)
+        self.evict()
+        return self._get_blob_filepath(digest)
+
+    @property
+    def size(self) -> int:
+        """Total size of the cached assets (in bytes)."""
+        with self._connect() as con:
+            return con.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM "
+                "(SELECT DISTINCT digest, size FROM assets)"
+            ).fetchone()[0]
+
+    def evict(self) -> None:
+        """Evict the least recently used assets until the size is below the cap.
+
+        Assets accessed within the last `settings.ASSET_CACHE_MIN_AGE` seconds are
+        never evicted, so that the paths just returned by `get` (e.g., in a parallel
+        process) remain valid while they are read, even if the cap is exceeded.
+        """
+        with self._lock("evict"), self._connect() as con, con:
+            size = self.size
+            for url, digest, asset_size in con.execute(
+                "SELECT url, digest, size FROM assets WHERE last_access < ? "
+                "ORDER BY last_access",
+                (time.time() - settings.ASSET_CACHE_MIN_AGE,),
+            ).fetchall():
+                if size <= self.max_size:
+                    break
+                con.execute("DELETE FROM assets WHERE url = ?", (url,))
+                # the same content may be referenced by several urls
+                if (
+                    con.execute(
+                        "SELECT 1 FROM assets WHERE digest = ?", (digest,)
+                    ).fetchone()
+                    is None
+                ):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self._get_blob_filepath(digest))
+                    size -= asset_size
+
+
+def _read_padded_window(src, row_start, row_stop, col_start, col_stop):
+    """Read a window, with NaN for the pixels outside the raster or nodata."""
+    window_arr = np.full((row_stop - row_start, col_stop - col_start), np.nan)
+    row_slice = slice(max(row_start, 0), min(row_stop, src.height))
+    col_slice = slice(max(col_start, 0), min(col_stop, src.width))
+    if row_slice.start < row_slice.stop and col_slice.start < col_slice.stop:
+        window_arr[
+            row_slice.start - row_start : row_slice.stop - row_start,
+            col_slice.start - col_start : col_slice.stop - col_start,
+        ] = src.read(1, window=windows.Window.from_slices(row_slice, col_slice))
+    if src.nodata is not None:
+        window_arr[window_arr == src.nodata] = np.nan
+    return window_arr
+
+
+def _read_station_windows(src, rows, cols, halo):
+    """Read the window of side `2 * halo + 1` pixels around each station pixel."""
+    side = 2 * halo + 1
+    window_arr = np.empty((len(rows), side, side))
+    # read a single window for the stations that fall in the same internal block of
+    # the raster, so that each block is read (and decompressed) at most once
+    block_height, block_width = src.block_shapes[0]
+    block_ids = (rows // block_height) * (src.width // block_width + 1) + (
+        cols // block_width
+    )
+    for block_id in np.unique(block_ids):
+        station_pos = np.flatnonzero(block_ids == block_id)
+        row_start = rows[station_pos].min() - halo
+        col_start = cols[station_pos].min() - halo
+        block_arr = _read_padded_window(
+            src,
+            row_start,
+            rows[station_pos].max() + halo + 1,
+            col_start,
+            cols[station_pos].max() + halo + 1,
+        )
+        window_arr[station_pos] = np.lib.stride_tricks.sliding_window_view(
+            block_arr, (side, side)
+        )[rows[station_pos] - halo - row_start, cols[station_pos] - halo - col_start]
+    return window_arr
+
+
+def _sample_tile(url, cache, x, y, interpolation, slope, tpi_radius):
+    """Sample the elevation (and neighborhood statistics) of stations in a tile."""
+    with rio.open(url if cache is None else cache.get(url)) as src:
+        # fractional pixel coordinates of all the stations at once with the inverse
+        # affine transform
+        col_arr, row_arr = ~src.transform * (x, y)
+        rows = np.floor(row_arr).astype(int)
+        cols = np.floor(col_arr).astype(int)
+        x_res, y_res = src.res
+        tpi_halo = 0 if tpi_radius is None else int(np.ceil(tpi_radius / x_res))
+        halo = max(int(interpolation == "bilinear" or slope), tpi_halo)
+        window_arr = _read_station_windows(src, rows, cols, halo)
+
+    stats = {}
+    station_range = np.arange(len(window_arr))
+    if interpolation == "bilinear":
+        # interpolate between the centers of the four pixels around each station
+        row_arr = row_arr - 0.5
+        col_arr = col_arr - 0.5
+        row_starts = np.floor(row_arr).astype(int)
+        col_starts = np.floor(col_arr).astype(int)
+        row_weights = row_arr - row_starts
+        col_weights = col_arr - col_starts
+        # position of the top-left pixel within the window
+        row_starts = row_starts - rows + halo
+        col_starts = col_starts - cols + halo
+        stats["elevation"] = sum(
+            window_arr[station_range, row_starts + i, col_starts + j]
+            * (row_weights if i else 1 - row_weights)
+            * (col_weights if j else 1 - col_weights)
+            for i in range(2)
+            for j in range(2)
+        )
+    else:
+        stats["elevation"] = window_arr[:, halo, halo]
+    if slope:
+        # Horn's method on the 3x3 pixels around each station
+        a, b, c, d, _, f, g, h, i = (
+            window_arr[:, halo - 1 : halo + 2, halo - 1 : halo + 2]
+            .reshape(len(window_arr), 9)
+            .T
+        )
+        dz_dx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * x_res)
+        dz_dy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8 * y_res)
+        stats["slope"] = np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+    if tpi_radius is not None:
+        # elevation with respect to the mean of the pixels within `tpi_radius`
+        ring_y, ring_x = np.ogrid[-tpi_halo : tpi_halo + 1, -tpi_halo : tpi_halo + 1]
+        dist_arr = np.hypot(ring_x * x_res, ring_y * y_res)
+        tpi_mask = (dist_arr <= tpi_radius) & (dist_arr > 0)
+        stats["tpi"] = stats["elevation"] - np.nanmean(window_arr[:, tpi_mask], axis=1)
+    return stats
+
+
+@profile_utils.profiled
+def sample_elevation(
+    station_gser: gpd.GeoSeries,
+    tile_gdf: gpd.GeoDataFrame,
+    *,
+    url_col: str | None = None,
+    cache: AssetCache | None = None,
+    interpolation: str = "nearest",
+    slope: bool = False,
+    tpi_radius: float | None = None,
+    max_workers: int | None = None,
+) -> pd.DataFrame:
+    """Sample the elevation of stations from swissALTI3D tiles.
+
+    The station coordinates are transformed to the CRS of the tiles at once and mapped
+    to pixels with the inverse affine transform of each tile, from which only the
+    window of pixels around each station is read. Tiles are processed concurrently.
+
+    Parameters
+    ----------
+    station_gser : geopandas.GeoSeries
+        Station locations, indexed by the station id.
+    tile_gdf : geopandas.GeoDataFrame
+        Geo-data frame of tiles, as returned by `SwissTopoClient.gdf_from_collection`.
+    url_col : str, optional
+        Column of `tile_gdf` with the tile URLs. If None, the value from
+        `SWISSALTI3D_COLLECTION` is used.
+    cache : AssetCache, optional
+        Cache of remote assets from which the tiles are served. If None, the tiles are
+        read remotely, i.e., only the required parts of the tiles are requested (with
+        HTTP range requests).
+    interpolation : {"nearest", "bilinear"}, default "nearest"
+        Interpolation of the elevation at the station locations.
+    slope : bool, default False
+        Whether to compute the slope (in degrees) at the pixel of each station, using
+        Horn's method.
+    tpi_radius : numeric, optional
+        Radius (in units of the CRS of the tiles) of the neighborhood used to compute
+        the topographic position index (TPI), i.e., the difference between the
+        station elevation and the mean elevation of its neighborhood. If None, the
+        TPI is not computed.
+    max_workers : int, optional
+        Maximum number of threads used to process tiles. If None, the default of
+        `concurrent.futures.ThreadPoolExecutor` is used.
+
+    Returns
+    -------
+    elev_df : pandas.DataFrame
+        Data frame with the elevation (and the slope and TPI if requested) of each
+        station. Stations outside the tiles or over nodata pixels get NaN values.
+
+    """
+    if url_col is None:
+        url_col = SWISSALTI3D_COLLECTION
+    if interpolation not in ["nearest", "bilinear"]:
+        raise ValueError(
+            f"Unknown interpolation {interpolation}, must be 'nearest' or 'bilinear'."
+        )
+
+    # transform all the station coordinates at once
+    station_gser = station_gser.to_crs(SWISSALTI3D_CRS)
+    tile_ser = (
+        gpd.GeoDataFrame(geometry=station_gser.to_crs(tile_gdf.crs))
+        .sjoin(tile_gdf[[url_col, "geometry"]], predicate="within")[url_col]
+        .groupby(level=0)
+        .first()
+    )
+    profile_utils.add_counts(stations=len(station_gser), tiles=tile_ser.nunique())
+    station_x = station_gser.x.to_numpy()
+    station_y = station_gser.y.to_numpy()
+    station_pos_ser = pd.Series(np.arange(len(station_gser)), index=station_gser.index)
+
+    columns = ["elevation"] + ["slope"] * slope + ["tpi"] * (tpi_radius is not None)
+    elev_df = pd.DataFrame(np.nan, index=station_gser.index, columns=columns)
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_pos = {}
+        for url, tile_station_ser in tile_ser.groupby(tile_ser):
+            pos = station_pos_ser[tile_station_ser.index].to_numpy()
+            future_to_pos[
+                executor.submit(
+                    _sample_tile,
+                    url,
+                    cache,
+                    station_x[pos],
+                    station_y[pos],
+                    interpolation,
+                    slope,
+                    tpi_radius,
+                )
+            ] = pos
+        for future in futures.as_completed(future_to_pos):
+            pos = future_to_pos[future]
+            for column, values in future.result().items():
+                elev_df.iloc[pos, elev_df.columns.get_loc(column)] = values
+    return elev_df
@@ -0,0 +1,493 @@
+"""Time series storage utils."""
+import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from uhi_drivers_lausanne import profile_utils
+
+time_col = "time"
+station_col = "station_id"
+source_col = "source"
+month_col = "month"
+MONTH_FORMAT = "%Y-%m"
+# number of timestamps whose bitmask is unpacked at once when counting valid values
+_COUNT_CHUNKSIZE = 4096
+
+PARTITIONING = ds.partitioning(
+    pa.schema([(source_col, pa.string()), (month_col, pa.string())]), flavor="hive"
+)
+
+
+@profile_utils.profiled
+def write_ts_df(
+    ts_df: pd.DataFrame,
+    dst_dir: str,
+    *,
+    source: str | None = None,
+    station_col: str = "station_id",
+    value_col: str = "T",
+) -> None:
+    """Write time series data frame as a Parquet dataset partitioned by source/month.
+
+    Station ids are stored as a dictionary-encoded (categorical) column. Existing
+    partitions of `dst_dir` that are written again are replaced, so that several
+    sources can be written (separately) to the same dataset.
+
+    Parameters
+    ----------
+    ts_df : pd.DataFrame
+        Time series data frame, either in wide format (time index, one column per
+        station) or in long format (with a `time` column and a station id column).
+    dst_dir : str
+        Path to the directory of the Parquet dataset.
+    source : str, optional
+        Source of the time series (e.g., "official" or "cws"). Required unless `ts_df`
+        is in long format and has a `source` column.
+    station_col : str, default "station_id"
+        Name of the station id column. In wide format, the columns are stored in a
+        column with this name.
+    value_col : str, default "T"
+        Name of the value column. Only used if `ts_df` is in wide format.
+
+    """
+    if isinstance(ts_df.index, pd.DatetimeIndex):
+        # wide to long format, keeping NaNs so that the wide data frame can be
+        # recovered with the same shape
+        ts_df = (
+            ts_df.rename_axis(index=time_col, columns=None)
+            .reset_index()
+            .melt(id_vars=time_col, var_name=station_col, value_name=value_col)
+        )
+    else:
+        ts_df = ts_df.copy()
+    if source is not None:
+        ts_df[source_col] = source
+    elif source_col not in ts_df.columns:
+        raise ValueError(
+            f"`source` must be provided if `ts_df` has no `{source_col}` column."
+        )
+    ts_df[time_col] = pd.to_datetime(ts_df[time_col])
+    ts_df[station_col] = ts_df[station_col].astype(str).astype("category")
+    ts_df[month_col] = ts_df[time_col].dt.strftime(MONTH_FORMAT)
+    # sort by time so that the row group statistics can be used to skip row groups
+    ts_df = ts_df.sort_values(time_col, kind="stable")
+    table = pa.Table.from_pandas(ts_df, preserve_index=False)
+    ds.write_dataset(
+        table,
+        dst_dir,
+        format="parquet",
+        partitioning=PARTITIONING,
+        existing_data_behavior="delete_matching",
+    )
+
+
+@profile_utils.profiled
+def read_ts_df(
+    src_dir: str,
+    *,
+    start_dt: str | datetime.datetime | None = None,
+    end_dt: str | datetime.datetime | None = None,
+    sources: list | None = None,
+    station_ids: list | None = None,
+    station_col: str = "station_id",
+    columns: list | None = None,
+) -> pd.DataFrame:
+    """Read time series data frame (in long format) from a Parquet dataset.
+
+    The time and source filters are pushed down to the Parquet reader, so that only the
+    relevant partitions and row groups are read.
+
+    Parameters
+    ----------
+    src_dir : str
+        Path to the directory of the Parquet dataset, as written by `write_ts_df`.
+    start_dt, end_dt : str or datetime.datetime, optional
+        Start and end date and time (both inclusive), by default None (does not filter
+        data).
+    sources : list of str, optional
+        Sources to read, by default None (reads all sources).
+    station_ids : list, optional
+        Station ids to read, by default None (reads all stations).
+    station_col : str, default "station_id"
+        Name of the station id column.
+    columns : list of str, optional
+        Columns to read, by default None (reads all columns).
+
+    Returns
+    -------
+    ts_df : pd.DataFrame
+        Time series data frame in long format, with the station ids as categorical.
+
+    """
+    dataset = ds.dataset(src_dir, format="parquet", partitioning=PARTITIONING)
+    filters = []
+    if start_dt is not None:
+        start_dt = pd.Timestamp(start_dt)
+        filters += [
+            ds.field(month_col) >= start_dt.strftime(MONTH_FORMAT),
+            ds.field(time_col) >= start_dt,
+        ]
+    if end_dt is not None:
+        end_dt = pd.Timestamp(end_dt)
+        filters += [
+            ds.field(month_col) <= end_dt.strftime(MONTH_FORMAT),
+            ds.field(time_col) <= end_dt,
+        ]
+    if sources is not None:
+        filters.append(ds.field(source_col).isin(sources))
+    if station_ids is not None:
+        filters.append(ds.field(station_col).isin(list(map(str, station_ids))))
+    _filter = None
+    for _filter_i in filters:
+        _filter = _filter_i if _filter is None else _filter & _filter_i
+    if columns is None:
+        columns = [column for column in dataset.schema.names if column != month_col]
+    ts_df = dataset.to_table(columns=columns, filter=_filter).to_pandas()
+    if station_col in ts_df.columns:
+        ts_df[station_col] = ts_df[station_col].cat.remove_unused_categories()
+    return ts_df
+
+
+@profile_utils.profiled
+def read_wide_ts_df(
+    src_dir: str,
+    *,
+    station_col: str = "station_id",
+    value_col: str = "T",
+    **read_ts_df_kws,
+) -> pd.DataFrame:
+    """Read time series data frame (in wide format) from a Parquet dataset.
+
+    Parameters
+    ----------
+    src_dir : str
+        Path to the directory of the Parquet dataset, as written by `write_ts_df`.
+    station_col : str, default "station_id"
+        Name of the station id column.
+    value_col : str, default "T"
+        Name of the value column.
+    **read_ts_df_kws
+        Keyword arguments to pass to `read_ts_df`, e.g., to filter by time or source.
+
+    Returns
+    -------
+    ts_df : pd.DataFrame
+        Time series data frame in wide format, with a time index and one column per
+        station.
+
+    """
+    ts_df = read_ts_df(
+        src_dir,
+        station_col=station_col,
+        columns=[time_col, station_col, value_col],
+        **read_ts_df_kws,
+    )
+    # scatter the values into a (time, station) array using the categorical codes, with
+    # sums and counts so that duplicated time-station pairs (if any) are averaged
+    time_codes, times = pd.factorize(ts_df[time_col], sort=True)
+    station_codes = ts_df[station_col].cat.codes.to_numpy()
+    stations = ts_df[station_col].cat.categories
+    flat_codes = time_codes * len(stations) + station_codes
+    values = ts_df[value_col].to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    minlength = len(times) * len(stations)
+    sums = np.bincount(flat_codes[valid], weights=values[valid], minlength=minlength)
+    counts = np.bincount(flat_codes[valid], minlength=minlength)
+    with np.errstate(invalid="ignore"):
+        arr = (sums / counts).reshape(len(times), len(stations))
+    return pd.DataFrame(
+        arr,
+        index=pd.DatetimeIndex(times, name=time_col),
+        columns=pd.Index(stations.astype(str), name=station_col),
+    )
+
+
+class CompactTSArray:
+    """Memory-compact wide time series of measurements.
+
+    The measurements are stored as a (timestamp, station) array of float32 values or of
+    int16 values scaled by `scale`, together with a bitmask of valid values packed
+    along the station axis, a categorical station index and a regular time axis
+    (defined by its start and frequency). Chunks of timestamps can be decoded into
+    float64 arrays (with NaN for non-valid values) on demand, so that the full
+    float64 array never needs to be materialized.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Two-dimensional array of encoded measurements, with timestamps as rows.
+    valid_bits : numpy.ndarray
+        Bitmask of valid measurements, as returned by `numpy.packbits` along the
+        station axis (i.e., axis 1).
+    stations : list-like
+        Station ids, one for each column of `values`.
+    start : pandas.Timestamp
+        First timestamp.
+    freq : str or pandas.DateOffset
+        Frequency of the timestamps.
+    scale : numeric, optional
+        Scale of the int16 encoding, i.e., a measurement `x` is stored as
+        `round(x / scale)`. Required if `values` is an integer array, ignored otherwise.
+
+    """
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        valid_bits: np.ndarray,
+        stations,
+        start: pd.Timestamp,
+        freq,
+        *,
+        scale: float | None = None,
+    ):
+        """Initialize the compact time series array."""
+        if np.issubdtype(values.dtype, np.integer) and scale is None:
+            raise ValueError("`scale` must be provided for integer values.")
+        self.values = values
+        self.valid_bits = valid_bits
+        self.columns = pd.CategoricalIndex(stations, name=station_col)
+        self.start = pd.Timestamp(start)
+        self.freq = pd.tseries.frequencies.to_offset(freq)
+        self.scale = scale
+
+    @classmethod
+    def from_df(
+        cls,
+        ts_df: pd.DataFrame,
+        *,
+        freq=None,
+        dtype: str = "float32",
+        scale: float | None = None,
+    ) -> "CompactTSArray":
+        """Create a compact time series array from a wide data frame.
+
+        Parameters
+        ----------
+        ts_df : pandas.DataFrame
+            Time series of measurements (rows) for each station (columns), with a time
+            index.
+        freq : str or pandas.DateOffset, optional
+            Frequency of the time axis. If None, the frequency of the index of `ts_df`
+            is used (or inferred). Missing timestamps are filled with non-valid values.
+        dtype : {"float32", "int16"}, default "float32"
+            Data type of the stored values.
+        scale : numeric, optional
+            Scale of the int16 encoding. Required if `dtype` is "int16".
+
+        Returns
+        -------
+        compact_ts_arr : CompactTSArray
+            Compact time series array.
+
+        """
+        if freq is None:
+            freq = ts_df.index.freq or pd.infer_freq(ts_df.index)
+        time_index = pd.date_range(ts_df.index.min(), ts_df.index.max(), freq=freq)
+        if not ts_df.index.equals(time_index):
+            ts_df = ts_df.reindex(time_index)
+        compact_ts_arr = cls._empty(
+            len(time_index), ts_df.columns, time_index[0], freq, dtype, scale
+        )
+        compact_ts_arr.set_arr(ts_df.to_numpy(dtype=float))
+        return compact_ts_arr
+
+    @classmethod
+    def from_long_df(
+        cls,
+        ts_df: pd.DataFrame,
+        freq,
+        *,
+        station_col: str = "station_id",
+        value_col: str = "T",
+        dtype: str = "float32",
+        scale: float | None = None,
+    ) -> "CompactTSArray":
+        """Create a compact time series array from a long data frame.
+
+        The values are written directly into the compact array, without creating an
+        intermediate wide float64 data frame.
+
+        Parameters
+        ----------
+        ts_df : pandas.DataFrame
+            Time series data frame in long format, with a `time` column, a station id
+            column and a value column. Timestamps must be aligned with `freq`.
+            Duplicated time-station pairs (if any) are averaged.
+        freq : str or pandas.DateOffset
+            Frequency of the time axis.
+        station_col : str, default "station_id"
+            Name of the station id column.
+        value_col : str, default "T"
+            Name of the value column.
+        dtype : {"float32", "int16"}, default "float32"
+            Data type of the stored values.
+        scale : numeric, optional
+            Scale of the int16 encoding. Required if `dtype` is "int16".
+
+        Returns
+        -------
+        compact_ts_arr : CompactTSArray
+            Compact time series array.
+
+        """
+        # work with the columns as arrays of the valid rows only, since indexing the
+        # long data frame (or its columns) creates large copies
+        values = ts_df[value_col].to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        values = values[valid]
+        station_ser = ts_df[station_col]
+        if isinstance(station_ser.dtype, pd.CategoricalDtype):
+            station_codes = station_ser.cat.codes.to_numpy()[valid]
+            # drop the unused categories
+            used = np.bincount(station_codes, minlength=len(station_ser.cat.categories))
+            stations = station_ser.cat.categories[used > 0]
+            station_codes = (np.cumsum(used > 0) - 1)[station_codes]
+        else:
+            station_codes, stations = pd.factorize(
+                station_ser.to_numpy()[valid], sort=True
+            )
+        time_index = pd.DatetimeIndex(ts_df[time_col]).as_unit("ns")
+        offset = pd.tseries.frequencies.to_offset(freq)
+        if isinstance(offset, pd.offsets.Tick):
+            # fixed frequency, so that the positions can be computed arithmetically (and
+            # in place) from the nanosecond timestamps
+            time_codes = time_index.asi8[valid]
+            start = time_codes.min()
+            end = time_codes.max()
+            time_codes -= start
+            if (time_codes % offset.nanos).any():
+                time_codes[:] = -1
+            time_codes //= offset.nanos
+            time_index = pd.date_range(
+                pd.Timestamp(start, tz=time_index.tz),
+                pd.Timestamp(end, tz=time_index.tz),
+                freq=freq,
+            )
+        else:
+            times = time_index[valid]
+            time_index = pd.date_range(times.min(), times.max(), freq=freq)
+            time_codes = time_index.get_indexer(times)
+        if (time_codes == -1).any():
+            raise ValueError(f"Timestamps must be aligned with the {freq} frequency.")
+
+        compact_ts_arr = cls._empty(
+            len(time_index), stations, time_index[0], freq, dtype, scale
+        )
+        valid_arr = np.zeros(compact_ts_arr.shape, dtype=bool)
+        valid_arr[time_codes, station_codes] = True
+        if valid_arr.sum() < len(values):
+            # average the duplicated time-station pairs
+            flat_codes, inverse = np.unique(
+                time_codes * len(stations) + station_codes, return_inverse=True
+            )
+            values = np.bincount(inverse, weights=values) / np.bincount(inverse)
+            time_codes, station_codes = np.divmod(flat_codes, len(stations))
+        compact_ts_arr.values[time_codes, station_codes] = compact_ts_arr._encode(
+            values
+        )
+        compact_ts_arr.valid_bits = np.packbits(valid_arr, axis=1)
+        return compact_ts_arr
+
+    @classmethod
+    def _empty(cls, n_timestamps, stations, start, freq, dtype, scale):
+        values = np.zeros((n_timestamps, len(stations)), dtype=dtype)
+        valid_bits = np.zeros((n_timestamps, -(-len(stations) // 8)), dtype=np.uint8)
+        return cls(values, valid_bits, stations, start, freq, scale=scale)
+
+    def _encode(self, arr: np.ndarray) -> np.ndarray:
+        if self.scale is None:
+            return arr.astype(self.values.dtype)
+        # non-valid values are stored as zero
+        return np.round(np.nan_to_num(arr) / self.scale).astype(self.values.dtype)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """Get the number of timestamps and stations."""
+        return self.values.shape
+
+    def __len__(self) -> int:
+        """Get the number of timestamps."""
+        return len(self.values)
+
+    @property
+    def index(self) -> pd.DatetimeIndex:
+        """Get the time index."""
+        return pd.date_range(
+            self.start, periods=len(self), freq=self.freq, name=time_col
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """Get the number of bytes of the values and the bitmask."""
+        return self.values.nbytes + self.valid_bits.nbytes
+
+    def get_valid_arr(self, start: int = 0, stop: int | None = None) -> np.ndarray:
+        """Get the boolean array of valid measurements for a chunk of timestamps."""
+        return np.unpackbits(
+            self.valid_bits[start:stop], axis=1, count=self.shape[1]
+        ).view(bool)
+
+    def get_arr(self, start: int = 0, stop: int | None = None) -> np.ndarray:
+        """Decode a chunk of timestamps into a float64 array, with NaN if not valid.
+
+        Parameters
+        ----------
+        start, stop : int, optional
+            Positions of the first (inclusive) and last (exclusive) timestamps of the
+            chunk, by default the whole time axis.
+
+        Returns
+        -------
+        arr : numpy.ndarray
+            Two-dimensional array of measurements, with timestamps as rows.
+
+        """
+        arr = self.values[start:stop].astype(float)
+        if self.scale is not None:
+            arr *= self.scale
+        arr[~self.get_valid_arr(start, stop)] = np.nan
+        return arr
+
+    def set_arr(self, arr: np.ndarray, start: int = 0):
+        """Encode a float array (with NaN if not valid) into a chunk of timestamps.
+
+        Parameters
+        ----------
+        arr : numpy.ndarray
+            Two-dimensional array of measurements, with timestamps as rows.
+        start : int, default 0
+            Position of the first timestamp of the chunk.
+
+        """
+        stop = start + len(arr)
+        self.values[start:stop] = self._encode(arr)
+        self.valid_bits[start:stop] = np.packbits(~np.isnan(arr), axis=1)
+
+    def count(self) -> pd.Series:
+        """Count the valid measurements of each station."""
+        counts = np.zeros(self.shape[1], dtype=int)
+        # unpack the bitmask in chunks to bound memory
+        for start in range(0, len(self), _COUNT_CHUNKSIZE):
+            counts += self.get_valid_arr(start, start + _COUNT_CHUNKSIZE).sum(axis=0)
+        return pd.Series(counts, index=self.columns)
+
+    def copy(self) -> "CompactTSArray":
+        """Copy the compact time series array."""
+        return CompactTSArray(
+            self.values.copy(),
+            self.valid_bits.copy(),
+            self.columns,
+            self.start,
+            self.freq,
+            scale=self.scale,
+        )
+
+    def to_df(self) -> pd.DataFrame:
+        """Convert to a wide (float64) data frame."""
+        return pd.DataFrame(
+            self.get_arr(), index=self.index, columns=self.columns.astype(str)
+        )